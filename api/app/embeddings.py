@@ -1,13 +1,139 @@
 # app/embeddings.py
 
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
 from sentence_transformers import SentenceTransformer
 
 # Example model; pick any suitable HF model (e.g. 'all-MiniLM-L6-v2', 'distilbert-base-uncased', etc.)
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+MODEL_NAME = os.getenv("TEXT_EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+DEFAULT_BATCH_SIZE = int(os.getenv("TEXT_EMBED_BATCH_SIZE", "64"))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "4096"))
+QUERY_CACHE_TTL_SECONDS = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "3600"))
+
+_model: Optional[SentenceTransformer] = None
+_model_lock = threading.Lock()
+
+
+def get_model() -> SentenceTransformer:
+    """The shared SentenceTransformer, loaded on first use rather than at import."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = SentenceTransformer(MODEL_NAME)
+    return _model
+
+
+def normalize_query(text: str) -> str:
+    # MiniLM is uncased, so case and spacing don't change the embedding.
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class QueryEmbeddingCache:
+    """Bounded LRU of normalized query text -> embedding, with entries expiring after `ttl` seconds."""
+
+    def __init__(self, max_items: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL_SECONDS):
+        self.max_items = max(1, max_items)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[List[float]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= now:
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[0])
+
+    def put(self, key: str, embedding: List[float]):
+        with self._lock:
+            self._entries[key] = (tuple(embedding), time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "items": len(self._entries),
+                "max_items": self.max_items,
+                "ttl_seconds": self.ttl,
+                "model_loaded": _model is not None,
+            }
+
+
+query_cache = QueryEmbeddingCache()
+
 
 def generate_embedding(text: str):
     """
     Returns a list (or np.array) representing the embedding for the given text.
     """
-    embedding = model.encode(text)
+    embedding = get_model().encode(text)
     return embedding.tolist()
+
+
+def embed_query(text: str) -> List[float]:
+    """Embedding for a search query, served from `query_cache` when it was seen recently."""
+    key = normalize_query(text)
+    embedding = query_cache.get(key)
+    if embedding is None:
+        embedding = generate_embedding(key)
+        query_cache.put(key, embedding)
+    return embedding
+
+
+def prewarm_queries(queries: Iterable[str], batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """Embed common queries in one batch and seed the cache with them. Returns how many were added."""
+    keys = [k for k in dict.fromkeys(normalize_query(q) for q in queries) if k and k not in query_cache]
+    if not keys:
+        return 0
+    for key, vector in zip(keys, generate_embeddings(keys, batch_size=batch_size)):
+        query_cache.put(key, vector.tolist())
+    return len(keys)
+
+
+def generate_embeddings(texts: List[str], batch_size: int = DEFAULT_BATCH_SIZE,
+                        multi_process: bool = False):
+    """
+    Embed many texts at once, `batch_size` sentences per forward pass.
+    Returns a float32 array of shape (len(texts), dim). With `multi_process`,
+    encoding is spread over one worker process per CPU (or per GPU).
+    """
+    model = get_model()
+    if multi_process:
+        pool = model.start_multi_process_pool()
+        try:
+            return model.encode_multi_process(texts, pool, batch_size=batch_size)
+        finally:
+            model.stop_multi_process_pool(pool)
+    return model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
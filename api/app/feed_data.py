@@ -4,10 +4,33 @@ import pandas as pd
 from vespa.package import ApplicationPackage, Field, Document, Schema
 from vespa.deployment import VespaDocker
 from vespa.query import Vespa
-from app.embeddings import generate_embedding
+from app.embeddings import DEFAULT_BATCH_SIZE, generate_embeddings
 import json
 
-def feed_data():
+# Shared with the main API; installed from api2/ (pip install -e api2).
+from vespa_feeder import BulkFeeder
+
+# Columns whose values (not just an "X" flag) go into the feature text.
+VALUE_COLUMNS = ["Pat", "Age", "Category"]
+
+def build_feature_texts(df: pd.DataFrame) -> pd.Series:
+    """
+    One text per row, e.g. "Pat=0 Age=12 Category=... VSD ASD": "col=value"
+    for VALUE_COLUMNS and the name of every column flagged "X", in column
+    order. Built column by column with masks instead of row by row.
+    """
+    values = df.astype(str)
+    flagged = values.eq("X")
+    text = pd.Series("", index=df.index)
+    for col in df.columns:
+        if col in VALUE_COLUMNS:
+            piece = (f"{col}=" + values[col] + " ").where(~flagged[col], col + " ")
+        else:
+            piece = flagged[col].map({True: col + " ", False: ""})
+        text = text + piece
+    return text.str.rstrip()
+
+def feed_data(batch_size: int = DEFAULT_BATCH_SIZE, multi_process: bool = False):
     # Load the CSV
     df = pd.read_csv("./data/hvsmr_clinical.csv")
 
@@ -36,38 +59,37 @@ def feed_data():
     # Connect to the app
     vespa_app = Vespa(url="http://localhost", port=8080)
 
-    # Feed each row
-    for idx, row in df.iterrows():
-        # Build a simple text representation from your columns. 
-        # e.g. "VSD present, Mild Dilation, Age=10, etc."
-        # For demonstration, we’ll just join columns that have 'X' or numeric:
-        features_list = []
-        for col in df.columns:
-            if pd.notna(row[col]) and str(row[col]) == "X":
-                features_list.append(col)
-            elif col in ["Pat", "Age", "Category"]:
-                features_list.append(f"{col}={row[col]}")
-
-        text_for_embedding = " ".join(features_list)
-        vector = generate_embedding(text_for_embedding)  # dimension must match your schema
+    # Build every row's text at once, then embed them in batches
+    texts = build_feature_texts(df)
+    vectors = generate_embeddings(texts.tolist(), batch_size=batch_size,
+                                  multi_process=multi_process)  # dimension must match your schema
+    categories = df["Category"].astype(str)
+    ages = df["Age"].astype(int)
 
-        # Build doc
-        doc_id = f"id-hvsmr-{idx}"
-        doc_data = {
-            "id": doc_id,
-            "fields": {
+    def documents():
+        for i, idx in enumerate(df.index):
+            doc_id = f"id-hvsmr-{idx}"
+            yield doc_id, {
                 "id": doc_id,
-                "category": str(row["Category"]),
-                "age": int(row["Age"]),
-                "features_text": text_for_embedding,
-                "embedding": vector
+                "category": categories[idx],
+                "age": int(ages[idx]),
+                "features_text": texts[idx],
+                "embedding": vectors[i].tolist()
             }
-        }
 
-        # Feed document
-        vespa_app.feed_data_point(schema="hvsmr", data_id=doc_id, fields=doc_data["fields"])
+    def report(result):
+        if not result.ok:
+            print(f"Failed to feed {result.doc_id}: {result.error}")
 
-    print("Data feed complete!")
+    # Feed documents concurrently (retries 429/503 with backoff)
+    stats = BulkFeeder(vespa_app, schema="hvsmr", on_result=report).feed(documents())
+    print(f"Data feed complete! {stats['succeeded']} fed, {stats['failed']} failed")
 
 if __name__ == "__main__":
-    feed_data()
+    import argparse
+    parser = argparse.ArgumentParser(description="Embed hvsmr_clinical.csv and feed it to Vespa.")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--multi-process", action="store_true",
+                        help="encode with one worker process per CPU/GPU")
+    args = parser.parse_args()
+    feed_data(batch_size=args.batch_size, multi_process=args.multi_process)
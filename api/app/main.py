@@ -1,41 +1,77 @@
 # app/main.py
 
-from fastapi import FastAPI, Query
+import os
+import threading
+from fastapi import FastAPI, HTTPException, Query
+from starlette.concurrency import run_in_threadpool
 from typing import List, Optional
 from vespa.query import Vespa
 from pydantic import BaseModel
+from app.embeddings import embed_query, get_model, prewarm_queries, query_cache
+
+# Shared with the main API; installed from api2/ (pip install -e api2).
+from vespa_query import VespaQueryClient, VespaQueryError
 
 app = FastAPI()
 
 # Connect to Vespa
 vespa_app = Vespa(url="http://localhost", port=8080)
+vespa_query = VespaQueryClient(os.getenv("VESPA_URL", "http://localhost:8080"))
+
+# Optional file with one common query per line, embedded at startup.
+PREWARM_QUERIES_FILE = os.getenv("PREWARM_QUERIES_FILE")
+
+@app.on_event("startup")
+def warm_text_embedder():
+    # Load MiniLM (and seed the query cache) in the background so startup isn't blocked.
+    def _run():
+        try:
+            get_model()
+            if PREWARM_QUERIES_FILE and os.path.exists(PREWARM_QUERIES_FILE):
+                with open(PREWARM_QUERIES_FILE) as f:
+                    added = prewarm_queries(line for line in f if line.strip())
+                print(f"Pre-warmed {added} queries from {PREWARM_QUERIES_FILE}")
+        except Exception as e:
+            print(f"Text embedder warmup failed: {e}")
+
+    threading.Thread(target=_run, name="warmup-text-embedder", daemon=True).start()
+
+@app.on_event("shutdown")
+async def close_clients():
+    await vespa_query.aclose()
 
 class QueryRequest(BaseModel):
     query_text: str
 
 @app.post("/search")
-def search_documents(req: QueryRequest):
+async def search_documents(req: QueryRequest):
     """
     Given a query text, generate an embedding, and search for nearest docs in Vespa.
     """
-    from app.embeddings import generate_embedding
-    query_vec = generate_embedding(req.query_text)
+    query_vec = await run_in_threadpool(embed_query, req.query_text)
 
     # We'll use Vespa's ANN search on 'embedding' field.
-    hits = vespa_app.query(
-        body={
-            "yql": "select * from sources * where ([{\"targetNumHits\":10}]nearestNeighbor(embedding, query_embedding));",
-            "hits": 10,
-            "input.query_embedding": query_vec,
-            "ranking.features.query(query_embedding)": query_vec,
-            "ranking.profile": "default"
-        },
-        schema="hvsmr"
-    )
-
-    return hits.json
+    try:
+        return await vespa_query.query(
+            body={
+                "yql": "select * from sources * where ([{\"targetNumHits\":10}]nearestNeighbor(embedding, query_embedding));",
+                "hits": 10,
+                "input.query_embedding": query_vec,
+                "ranking.features.query(query_embedding)": query_vec,
+                "ranking.profile": "default"
+            },
+            endpoint="search",
+            schema="hvsmr"
+        )
+    except VespaQueryError as e:
+        raise HTTPException(status_code=502, detail=f"Vespa query error: {str(e)}")
 
 
 @app.get("/healthcheck")
 def healthcheck():
     return {"status": "ok"}
+
+@app.get("/stats/query-cache")
+def query_cache_stats():
+    """Query-embedding cache hit/miss counters."""
+    return query_cache.stats()
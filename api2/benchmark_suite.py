@@ -0,0 +1,345 @@
+# benchmark_suite.py
+#
+# Offline CPU benchmarks for the pieces behind /upload and the ingestion:
+#
+#   embedding   - NIfTIToEmbedding end to end per volume size, and the model
+#                 forward pass per batch size
+#   preprocess  - NIfTI decoding and the resize/scale preprocessing
+#   documents   - CSV rows to clinical_data documents (create_knowledge_base)
+#   meshing     - tensor_to_3d_points, mesh_labels and plot_smooth_heart on
+#                 synthetic label volumes
+#   search      - the /upload neighbour query through VespaQueryClient, with
+#                 Vespa replaced by an in-process stub
+#
+# Everything runs on synthetic data, so no dataset, GPU or Vespa is needed.
+# Results are written as JSON; `compare` checks them against a stored baseline
+# and exits non-zero when a case got slower than the threshold allows.
+#
+#   python benchmark_suite.py run --out bench.json
+#   python benchmark_suite.py run --quick --baseline baseline.json
+#   python benchmark_suite.py compare bench.json baseline.json --threshold 0.15
+
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterable, List
+
+import numpy as np
+import torch
+
+GROUPS = ("embedding", "preprocess", "documents", "meshing", "search")
+DEFAULT_THRESHOLD = float(os.getenv("BENCHMARK_THRESHOLD", "0.15"))
+
+# (full, quick) parameter sets.
+VOLUME_SHAPES = ([(64, 64, 32), (128, 128, 64), (256, 256, 128)], [(64, 64, 32), (128, 128, 64)])
+BATCH_SIZES = ([1, 2, 4], [1, 2])
+LABEL_SHAPES = ([(96, 96, 72), (160, 160, 120)], [(96, 96, 72)])
+CSV_ROWS = (5000, 500)
+
+
+def measure(fn: Callable[[], Any], repeat: int = 5, warmup: int = 1) -> Dict[str, Any]:
+    """Wall-clock statistics of `repeat` calls of `fn` after `warmup` untimed ones, in ms."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000.0)
+    samples = np.array(samples)
+    return {
+        "p50_ms": float(np.median(samples)),
+        "min_ms": float(samples.min()),
+        "mean_ms": float(samples.mean()),
+        "runs": repeat,
+    }
+
+
+def _volume(shape, seed: int = 0, dtype=np.float32) -> np.ndarray:
+    # Fortran order, like the arrays nibabel returns.
+    rng = np.random.default_rng(seed)
+    return (rng.random(shape, dtype=np.float32) * 1000.0).astype(dtype, order="F")
+
+
+def synthetic_labels(shape, num_labels: int = 8, seed: int = 0):
+    """(labels, intensities): `num_labels` overlapping ellipsoids painted into a volume, heart-sized."""
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n, dtype=np.float32) for n in shape],
+                                indexing="ij"), axis=-1)
+    seg = np.zeros(shape, dtype=np.float64)  # get_fdata() gives floats
+    for label in range(1, num_labels + 1):
+        centre = rng.uniform(-0.4, 0.4, 3).astype(np.float32)
+        radii = rng.uniform(0.15, 0.45, 3).astype(np.float32)
+        seg[(((grid - centre) / radii) ** 2).sum(axis=-1) <= 1.0] = label
+    intensity = (seg * 100.0 + rng.normal(0, 20, shape)).astype(np.float32)
+    return seg, intensity
+
+
+# --- groups ---
+
+def bench_embedding(quick: bool, repeat: int) -> Dict[str, Dict]:
+    from model_registry import build_eager
+
+    embedder = build_eager("cpu")
+    results = {}
+    for shape in VOLUME_SHAPES[quick]:
+        data = _volume(shape)
+        results[f"embed_volume/{'x'.join(map(str, shape))}"] = {
+            **measure(lambda: embedder.embed_volume(data), repeat), "params": {"shape": shape}}
+    for batch_size in BATCH_SIZES[quick]:
+        x = torch.rand((batch_size, 1, 128, 128, 64))
+        stats = measure(lambda: embedder.embed_batch(x), repeat)
+        stats["per_volume_ms"] = stats["p50_ms"] / batch_size
+        results[f"forward/batch{batch_size}"] = {**stats, "params": {"batch_size": batch_size}}
+    return results
+
+
+def bench_preprocess(quick: bool, repeat: int) -> Dict[str, Dict]:
+    import nibabel as nib
+    from nifti_loader import build_preprocess, read_nifti_float32
+
+    results = {}
+    shape = VOLUME_SHAPES[quick][-1]
+    name = "x".join(map(str, shape))
+    data = _volume(shape)[np.newaxis, ...]
+    backends = ["fast"]
+    try:
+        build_preprocess("monai")
+        backends.append("monai")
+    except ImportError:
+        results[f"preprocess_monai/{name}"] = {"skipped": "monai is not installed"}
+    for backend in backends:
+        preprocess = build_preprocess(backend)
+        results[f"preprocess_{backend}/{name}"] = {
+            **measure(lambda: preprocess(data), repeat), "params": {"shape": shape}}
+
+    # Decoding an int16 .nii, the usual on-disk type for these volumes.
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "volume.nii")
+        nib.save(nib.Nifti1Image(_volume(shape, dtype=np.int16), np.eye(4)), path)
+        results[f"read_fast/{name}"] = {
+            **measure(lambda: read_nifti_float32(path), repeat), "params": {"shape": shape}}
+        results[f"read_get_fdata/{name}"] = {
+            **measure(lambda: nib.load(path).get_fdata().astype(np.float32), repeat),
+            "params": {"shape": shape}}
+    return results
+
+
+def bench_documents(quick: bool, repeat: int) -> Dict[str, Dict]:
+    import pandas as pd
+    from create_knowledge_base import clinical_rows
+
+    n = CSV_ROWS[quick]
+    rng = np.random.default_rng(0)
+    # Shaped like hvsmr_clinical.csv: ids, numbers with gaps, free text.
+    age = rng.uniform(0, 40, n)
+    age[rng.random(n) < 0.1] = np.nan
+    df = pd.DataFrame({
+        "Pat": np.arange(n),
+        "Age": age,
+        "Category": rng.choice(["TGA", "DORV", "VSD", "normal"], n),
+        "Diagnosis": rng.choice(["dextrocardia, VSD", "TGA s/p arterial switch", ""], n),
+        "Notes": [f"note {i}" if i % 3 else None for i in range(n)],
+    })
+    return {f"clinical_rows/{n}": {**measure(lambda: list(clinical_rows(df)), repeat),
+                                   "params": {"rows": n}}}
+
+
+def bench_meshing(quick: bool, repeat: int) -> Dict[str, Dict]:
+    from heart_mesh import mesh_labels, tensor_to_3d_points
+
+    try:
+        from smooth_heart_vis import plot_smooth_heart
+    except ImportError as e:
+        plot_smooth_heart, missing = None, str(e)
+    results = {}
+    for shape in LABEL_SHAPES[quick]:
+        seg, intensity = synthetic_labels(shape)
+        name = "x".join(map(str, shape))
+        params = {"shape": shape}
+        results[f"tensor_to_3d_points/{name}"] = {
+            **measure(lambda: tensor_to_3d_points(seg, intensity), repeat), "params": params}
+        results[f"mesh_labels/{name}"] = {**measure(lambda: mesh_labels(seg), repeat), "params": params}
+        if plot_smooth_heart is None:
+            results[f"plot_smooth_heart/{name}"] = {"skipped": missing}
+        else:
+            results[f"plot_smooth_heart/{name}"] = {
+                **measure(lambda: plot_smooth_heart(seg, export_html=None, show=False), repeat),
+                "params": params}
+    return results
+
+
+def _stub_vespa(hits: int = 3):
+    """httpx transport answering every /search/ like Vespa, with `hits` canned documents."""
+    import httpx
+
+    rng = np.random.default_rng(0)
+    children = [{
+        "id": f"id:clinical_data:clinical_data::clinical_{i}",
+        "relevance": float(rng.random()),
+        "fields": {"pat": str(i), "data": ",".join(["x"] * 40),
+                   "model_version": "stub"},
+    } for i in range(hits)]
+
+    def handler(request):
+        # Decode the body like Vespa would, so payload size counts.
+        json.loads(request.content)
+        return httpx.Response(200, json={"root": {"fields": {"totalCount": hits}, "children": children}})
+
+    return httpx.MockTransport(handler)
+
+
+def bench_search(quick: bool, repeat: int) -> Dict[str, Dict]:
+    from vespa_query import VespaQueryClient
+
+    client = VespaQueryClient("http://vespa.stub", hedge_ms=None, transport=_stub_vespa())
+    embedding = np.random.default_rng(0).random(512, dtype=np.float32).tolist()
+    # The body /upload sends.
+    body = {
+        "yql": "select * from sources * where ([{\"targetNumHits\":3}]nearestNeighbor(image_embedding, query_vec));",
+        "hits": 3,
+        "input.query_vec": embedding,
+        "ranking.features.query(query_vec)": embedding,
+        "ranking.profile": "default",
+    }
+    concurrency = 16
+    loop = asyncio.new_event_loop()
+    try:
+        single = measure(lambda: loop.run_until_complete(client.query(body, endpoint="upload")),
+                         repeat * 20, warmup=5)
+
+        async def burst():
+            await asyncio.gather(*(client.query(body, endpoint="upload") for _ in range(concurrency)))
+
+        burst_stats = measure(lambda: loop.run_until_complete(burst()), repeat, warmup=1)
+        burst_stats["queries_per_sec"] = concurrency / (burst_stats["p50_ms"] / 1000.0)
+        loop.run_until_complete(client.aclose())
+    finally:
+        loop.close()
+    return {
+        "vespa_stub_query/sequential": {**single, "params": {"hits": 3}},
+        f"vespa_stub_query/concurrent{concurrency}": {**burst_stats, "params": {"concurrency": concurrency}},
+    }
+
+
+BENCHMARKS = {
+    "embedding": bench_embedding,
+    "preprocess": bench_preprocess,
+    "documents": bench_documents,
+    "meshing": bench_meshing,
+    "search": bench_search,
+}
+
+
+def run(groups: Iterable[str] = GROUPS, quick: bool = False, repeat: int = 5) -> Dict[str, Any]:
+    """Run `groups` and return {"meta": ..., "results": {"group/case": stats}}."""
+    results = {}
+    for group in groups:
+        started = time.perf_counter()
+        try:
+            cases = BENCHMARKS[group](quick, repeat)
+        except ImportError as e:
+            cases = {"*": {"skipped": str(e)}}
+        for case, stats in cases.items():
+            results[f"{group}/{case}"] = stats
+        print(f"[bench] {group}: {len(cases)} cases in {time.perf_counter() - started:.1f}s")
+    return {
+        "meta": {
+            "created": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "numpy": np.__version__,
+            "quick": quick,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any],
+            threshold: float = DEFAULT_THRESHOLD) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Cases whose median time rose by more than `threshold` (a fraction) over
+    the baseline are "regressions", ones that fell by as much "improvements".
+    Cases missing on either side or skipped are listed as "unmatched".
+    """
+    report = {"regressions": [], "improvements": [], "unchanged": [], "unmatched": []}
+    base_results = baseline.get("results", {})
+    for case, stats in current.get("results", {}).items():
+        base = base_results.get(case)
+        if not base or "p50_ms" not in base or "p50_ms" not in stats:
+            report["unmatched"].append({"case": case})
+            continue
+        ratio = stats["p50_ms"] / base["p50_ms"] if base["p50_ms"] > 0 else float("inf")
+        entry = {"case": case, "baseline_ms": base["p50_ms"], "current_ms": stats["p50_ms"], "ratio": ratio}
+        if ratio > 1.0 + threshold:
+            report["regressions"].append(entry)
+        elif ratio < 1.0 - threshold:
+            report["improvements"].append(entry)
+        else:
+            report["unchanged"].append(entry)
+    report["unmatched"] += [{"case": c} for c in base_results if c not in current.get("results", {})]
+    return report
+
+
+def _print_report(report: Dict[str, List[Dict[str, Any]]], threshold: float):
+    for kind in ("regressions", "improvements", "unchanged"):
+        for e in report[kind]:
+            flag = {"regressions": "SLOWER", "improvements": "faster", "unchanged": ""}[kind]
+            print(f"{e['case']:<55} {e['baseline_ms']:10.2f} -> {e['current_ms']:10.2f} ms  "
+                  f"x{e['ratio']:.2f} {flag}")
+    if report["unmatched"]:
+        print(f"{len(report['unmatched'])} cases without a counterpart: "
+              f"{', '.join(e['case'] for e in report['unmatched'])}")
+    print(f"{len(report['regressions'])} regressions past {threshold:.0%}")
+
+
+def _load(path: str) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Offline CPU benchmarks with baseline comparison.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("run")
+    p.add_argument("--groups", default=",".join(GROUPS), help=f"comma-separated subset of {GROUPS}")
+    p.add_argument("--quick", action="store_true", help="smaller sizes, for CI")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    p.add_argument("--out", default=None, help="write results JSON here")
+    p.add_argument("--baseline", default=None, help="compare against this results JSON")
+    p.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    p = sub.add_parser("compare")
+    p.add_argument("current")
+    p.add_argument("baseline")
+    p.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        current = run([g for g in args.groups.split(",") if g], args.quick, args.repeat)
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(current, f, indent=2)
+            print(f"Results written to {args.out}")
+        else:
+            print(json.dumps(current["results"], indent=2))
+        baseline = _load(args.baseline) if args.baseline else None
+    else:
+        current, baseline = _load(args.current), _load(args.baseline)
+
+    if baseline is not None:
+        report = compare(current, baseline, args.threshold)
+        _print_report(report, args.threshold)
+        sys.exit(1 if report["regressions"] else 0)
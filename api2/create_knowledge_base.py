@@ -4,18 +4,23 @@ import gzip
 import shutil
 import base64
 import pandas as pd
+from typing import Optional
 from fastapi import FastAPI, HTTPException
 
-# Import the image embedder from your embeddings file.
-from embeddings import NIfTIToEmbedding
+# Shared image embedder (built once per process by the model registry).
+from model_registry import get_embedder
+from ingest_pipeline import IngestItem, IngestPipeline, PipelineConfig
+from zip_volumes import ZipVolumeSource
+from ingest_manifest import IngestManifest, image_fingerprint, row_hash
+from vespa_feeder import BulkFeeder
+from vector_index import get_index
+from mesh_store import get_mesh_store, precompute as precompute_meshes
 
 # Define file/folder paths
 DATA_ZIP = "./data/cropped.zip"
 EXTRACTED_FOLDER = "./data/collapsed"
 CLINICAL_CSV = "./data/hvsmr_clinical.csv"  # adjust path if needed
-
-# Instantiate the image embedder (uses the provided 3D CNN + transformer architecture)
-image_embedder = NIfTIToEmbedding()
+MANIFEST_PATH = "./data/ingest_manifest.json"
 
 # --- VESPA CLIENT PLACEHOLDER ---
 # Replace this with your actual vespa_app instance.
@@ -30,7 +35,11 @@ image_embedder = NIfTIToEmbedding()
 # --- UTILITY FUNCTIONS ---
 
 def decompress_zip():
-    """Extract the zip file to EXTRACTED_FOLDER if not already done."""
+    """
+    Extract the zip file to EXTRACTED_FOLDER if not already done.
+    Ingestion no longer needs this (see zip_volumes.ZipVolumeSource); it is
+    kept for tools that want the volumes on disk.
+    """
     if not os.path.exists(EXTRACTED_FOLDER):
         os.makedirs(EXTRACTED_FOLDER, exist_ok=True)
         with zipfile.ZipFile(DATA_ZIP, 'r') as zip_ref:
@@ -71,6 +80,17 @@ def decompress_nii_files():
                                 print(f"Error decompressing {file_path}: {e}")
                         break  # Found the matching pattern, no need to check others.
 
+def clinical_rows(df: pd.DataFrame):
+    """
+    (pat_id, clinical string) per CSV row: the patient identifier ("Pat"
+    column, else the row index) and the row's values comma-joined with NaNs
+    left empty, which is the document's "data" field.
+    """
+    has_pat = "Pat" in df.columns
+    for index, row in zip(df.index, df.itertuples(index=False, name=None)):
+        pat_id = str(row[df.columns.get_loc("Pat")]) if has_pat else str(index)
+        yield pat_id, ",".join("" if pd.isna(val) else str(val) for val in row)
+
 # --- THE FASTAPI ENDPOINT ---
 
 # def ingest_data_from_zip(vespa_app, model):
@@ -150,22 +170,25 @@ def decompress_nii_files():
 #             print(f"Error feeding data point for patient {pat_id}: {e}")
 
 #     return {"message": "Data ingested successfully", "num_docs": num_docs}
-def ingest_data_from_zip(vespa_app, model):
-    # 1. Ensure the zipped data exists and decompress it.
+def ingest_data_from_zip(vespa_app, model, config: Optional[PipelineConfig] = None,
+                         dry_run: bool = False, force: bool = False):
+    """
+    Embed and feed every patient in CLINICAL_CSV whose clinical row, image or
+    embedder version changed since the last run (or that failed to feed).
+    The manifest at MANIFEST_PATH is checkpointed as documents are fed, so an
+    interrupted run picks up where it stopped. `dry_run` only reports what
+    would be (re)ingested; `force` ignores the manifest.
+    """
+    # 1. Ensure the zipped data exists and index its volumes. Members are
+    #    decoded in memory by the load stage; nothing is extracted to disk.
     if not os.path.exists(DATA_ZIP):
         raise HTTPException(status_code=404, detail="Zip data file not found")
     try:
-        decompress_zip()
+        volumes = ZipVolumeSource(DATA_ZIP)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error decompressing zip: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error reading zip: {str(e)}")
 
-    # 2. Decompress all .nii.gz files into .nii files in their respective folders.
-    try:
-        decompress_nii_files()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error decompressing NIfTI files: {str(e)}")
-
-    # 3. Load the clinical CSV file.
+    # 2. Load the clinical CSV file.
     if not os.path.exists(CLINICAL_CSV):
         raise HTTPException(status_code=404, detail="Clinical CSV file not found")
     try:
@@ -173,49 +196,60 @@ def ingest_data_from_zip(vespa_app, model):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error reading CSV: {str(e)}")
 
-    # 4. Iterate over each patient (row) in the CSV.
-    num_docs = 0
-    for index, row in df.iterrows():
-        # Make sure we have a patient identifier (string).
-        pat_id = str(row["Pat"]) if "Pat" in df.columns else str(index)
-
-        # Convert row to a single comma-separated string, ignoring NaNs.
-        row_values = ["" if pd.isna(val) else str(val) for val in row]
-        clinical_string = ",".join(row_values)
-
-        # 5. Compute the image embedding using the decompressed ".nii" file.
-        image_path = os.path.join(EXTRACTED_FOLDER, "cropped", f"pat{pat_id}_cropped.nii")
-        if not os.path.exists(image_path):
-            print(f"Warning: Image file not found for patient {pat_id} at {image_path}. Skipping.")
+    # Shared image embedder (uses the provided 3D CNN + transformer architecture)
+    image_embedder = get_embedder("default")
+    manifest = IngestManifest(MANIFEST_PATH)
+
+    # 3. Build one work item per patient (row) in the CSV.
+    items = {}
+    candidates = {}
+    for pat_id, clinical_string in clinical_rows(df):
+        # The image is the "cropped/pat{pat}_cropped.nii" volume inside the zip.
+        image_source = volumes.member("cropped", f"pat{pat_id}_cropped.nii")
+        if image_source is None:
+            print(f"Warning: Image file not found for patient {pat_id} in {DATA_ZIP}. Skipping.")
             continue
 
-        try:
-            # image_embedder returns a numpy array of shape (512,).
-            embedding_list = image_embedder(image_path).flatten().tolist()
-        except Exception as e:
-            print(f"Error processing image for patient {pat_id}: {e}")
-            continue
-
-        # 6. Construct the document. Notice we embed the image_embedding
-        #    in the "type/values" format that Vespa expects for a
-        #    tensor<float>(d[512]) field:
-        doc_fields = {
-            "pat": pat_id,
-            "data": clinical_string,
-            "image_embedding": {
-                "type": "tensor<float>(d[512])",
-                "values": embedding_list
-            }
+        # The pipeline adds "image_embedding" as a hex-encoded
+        # tensor<float>(d[512]) value.
+        items[pat_id] = IngestItem(
+            pat_id=pat_id,
+            doc_id=f"clinical_{pat_id}",
+            fields={"pat": pat_id, "data": clinical_string},
+            image_source=image_source,
+        )
+        candidates[pat_id] = {
+            "pat_id": pat_id,
+            "row_hash": row_hash(clinical_string),
+            "image_hash": image_fingerprint(image_source),
+            "model_version": image_embedder.version,
         }
 
-        # 7. Feed the document to Vespa using a unique doc_id.
-        doc_id = f"clinical_{pat_id}"
-        print(f"Feeding document: {doc_id} (embedding length = {len(embedding_list)})")
+    # 4. Diff against the manifest.
+    plan = manifest.plan(candidates.values())
+    todo = list(items) if force else plan["new"] + plan["changed"] + plan["failed"]
+    summary = {name: len(pats) for name, pats in plan.items()}
+    print(f"[ingest] plan: {summary}, {len(todo)} to process")
+    if dry_run:
+        return {"message": "Dry run, nothing ingested", "dry_run": True, "plan": plan,
+                "num_to_process": len(todo)}
+
+    # 5. Load/preprocess, embed in batches and bulk-feed, recording each
+    #    outcome in the manifest.
+    def record(item, error):
+        c = candidates[item.pat_id]
+        manifest.mark(item.pat_id, c["row_hash"], c["image_hash"], c["model_version"], error=error)
 
-        try:
-            vespa_app.feed_data_point("clinical_data", doc_id, doc_fields)
-            num_docs += 1
-        except Exception as e:
-            print(f"Error feeding data point for patient {pat_id}: {e}")
-
-    return {"message": "Data ingested successfully", "num_docs": num_docs}
+    try:
+        feeder = BulkFeeder(vespa_app, "clinical_data")
+        result = IngestPipeline(image_embedder, feeder, config, on_done=record,
+                                index=get_index()).run(
+            items[pat_id] for pat_id in todo)
+    finally:
+        manifest.checkpoint()
+
+    # 6. Precompute the viewer meshes from each patient's segmentation
+    #    (skipped for segmentations that haven't changed).
+    meshes = precompute_meshes(volumes, get_mesh_store(), items, force=force)
+    print(f"[ingest] meshes: {meshes}")
+    return {"message": "Data ingested successfully", "plan": summary, "meshes": meshes, **result}
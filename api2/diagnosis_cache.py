@@ -0,0 +1,229 @@
+# diagnosis_cache.py
+#
+# Cache for LLM diagnoses. The prompt only depends on which of the clinical
+# flags are set, so a diagnosis is keyed by that bitmask plus a digest of the
+# prompt/model; there are few distinct keys in practice. A TTL'd in-memory
+# LRU sits in front of a SQLite table that survives restarts, and identical
+# concurrent requests share one LLM call. The async API (aget/aput,
+# get_or_compute) serves memory hits inline and does its SQLite reads and
+# writes on the default executor, so disk I/O never blocks the event loop.
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+DEFAULT_MEMORY_ITEMS = int(os.getenv("DIAGNOSIS_CACHE_ITEMS", "1024"))
+DEFAULT_DISK_ITEMS = int(os.getenv("DIAGNOSIS_CACHE_DISK_ITEMS", "100000"))
+DEFAULT_TTL_SECONDS = float(os.getenv("DIAGNOSIS_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# Set DIAGNOSIS_CACHE_PATH="" to keep the cache in memory only.
+DEFAULT_PATH = os.getenv("DIAGNOSIS_CACHE_PATH", "./data/diagnosis_cache.sqlite")
+
+# (diagnosis text, citation links)
+Diagnosis = Tuple[str, List[str]]
+
+# Handed to get_or_compute's waiters when the computing caller is cancelled.
+_RETRY = object()
+
+
+class DiagnosisCache:
+    def __init__(self, path: Optional[str] = DEFAULT_PATH, max_items: int = DEFAULT_MEMORY_ITEMS,
+                 max_disk_items: int = DEFAULT_DISK_ITEMS, ttl: float = DEFAULT_TTL_SECONDS):
+        self.path = path or None
+        self.max_items = max(1, max_items)
+        self.max_disk_items = max(1, max_disk_items)
+        self.ttl = ttl
+        # _lock guards the memory tier and counters and is never held across
+        # SQLite calls, which take _db_lock (and run off the event loop in the
+        # async methods).
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._memory: "OrderedDict[str, Tuple[Diagnosis, float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0,
+                          "expirations": 0, "evictions": 0, "errors": 0}
+        self._db = None
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS diagnoses ("
+                             "key TEXT PRIMARY KEY, text TEXT, links TEXT, expires REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS diagnoses_expires ON diagnoses (expires)")
+            self._db.commit()
+
+    def _remember(self, key: str, value: Diagnosis, expires: float):
+        # Caller holds self._lock.
+        self._memory[key] = (value, expires)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def _get_memory(self, key: str, now: float) -> Optional[Diagnosis]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            if entry[1] > now:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return entry[0]
+            del self._memory[key]
+            self._counters["expirations"] += 1
+            return None
+
+    def _get_disk(self, key: str, now: float) -> Optional[Diagnosis]:
+        with self._db_lock:
+            row = self._db.execute("SELECT text, links, expires FROM diagnoses WHERE key = ?",
+                                   (key,)).fetchone()
+            if row is not None and row[2] <= now:
+                self._db.execute("DELETE FROM diagnoses WHERE key = ?", (key,))
+                self._db.commit()
+        if row is None:
+            return None
+        with self._lock:
+            if row[2] <= now:
+                self._counters["expirations"] += 1
+                return None
+            value = (row[0], json.loads(row[1]))
+            self._counters["disk_hits"] += 1
+            self._remember(key, value, row[2])
+            return value
+
+    def _put_disk(self, key: str, value: Diagnosis, expires: float):
+        with self._db_lock:
+            self._db.execute("INSERT OR REPLACE INTO diagnoses VALUES (?, ?, ?, ?)",
+                             (key, value[0], json.dumps(value[1]), expires))
+            # Drop expired rows, then the soonest-to-expire ones beyond the size bound.
+            self._db.execute("DELETE FROM diagnoses WHERE expires <= ?", (time.time(),))
+            self._db.execute("DELETE FROM diagnoses WHERE key IN (SELECT key FROM diagnoses "
+                             "ORDER BY expires DESC LIMIT -1 OFFSET ?)", (self.max_disk_items,))
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[Diagnosis]:
+        """Blocking lookup; async code should use `aget`."""
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is not None or self._db is None:
+            return value
+        return self._get_disk(key, now)
+
+    def put(self, key: str, value: Diagnosis):
+        """Blocking store; async code should use `aput`."""
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, value, expires)
+        if self._db is not None:
+            self._put_disk(key, value, expires)
+
+    async def aget(self, key: str) -> Optional[Diagnosis]:
+        """`get` for the event loop: memory hits inline, SQLite on the default executor."""
+        now = time.time()
+        value = self._get_memory(key, now)
+        if value is not None or self._db is None:
+            return value
+        return await asyncio.get_running_loop().run_in_executor(None, self._get_disk, key, now)
+
+    async def aput(self, key: str, value: Diagnosis):
+        """`put` for the event loop: the SQLite write runs on the default executor."""
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, value, expires)
+        if self._db is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._put_disk, key, value, expires)
+
+    def _settle(self, key: str, future: asyncio.Future, value: Any = None,
+                error: Optional[BaseException] = None):
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+            # Don't warn about an unretrieved exception when nobody else was waiting.
+            future.exception()
+        else:
+            future.set_result(value)
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Diagnosis]]) -> Diagnosis:
+        """
+        Cached diagnosis for `key`, or await `compute()` once to produce it.
+        Concurrent callers with the same key wait on the first one. Failed
+        computations are not cached; if the first caller is cancelled, one of
+        the waiters computes instead.
+        """
+        while True:
+            value = await self.aget(key)
+            if value is not None:
+                return value
+            with self._lock:
+                future = self._inflight.get(key)
+                owner = future is None
+                if owner:
+                    future = asyncio.get_running_loop().create_future()
+                    self._inflight[key] = future
+                    self._counters["misses"] += 1
+                else:
+                    self._counters["coalesced"] += 1
+            if not owner:
+                value = await asyncio.shield(future)
+                if value is _RETRY:
+                    continue
+                return value
+
+            try:
+                value = await compute()
+            except asyncio.CancelledError:
+                # Our caller went away, not the computation's other waiters:
+                # wake them to retry rather than hand them our cancellation.
+                self._settle(key, future, _RETRY)
+                raise
+            except BaseException as e:
+                with self._lock:
+                    self._counters["errors"] += 1
+                self._settle(key, future, error=e)
+                raise
+            # Waiters get the value before the (best-effort) cache write.
+            self._settle(key, future, value)
+            try:
+                await self.aput(key, value)
+            except Exception as e:
+                print(f"Diagnosis cache write failed for {key}: {e}")
+            return value
+
+    def stats(self) -> Dict[str, Any]:
+        if self._db is not None:
+            with self._db_lock:
+                disk_items = self._db.execute("SELECT COUNT(*) FROM diagnoses").fetchone()[0]
+        else:
+            disk_items = None
+        with self._lock:
+            hits = self._counters["memory_hits"] + self._counters["disk_hits"]
+            lookups = hits + self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_rate": hits / lookups if lookups else None,
+                "memory_items": len(self._memory),
+                "disk_items": disk_items,
+                "ttl_seconds": self.ttl,
+                "path": self.path,
+            }
+
+
+_cache: Optional[DiagnosisCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_diagnosis_cache() -> DiagnosisCache:
+    """Shared per-process cache (DIAGNOSIS_CACHE_* env vars)."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = DiagnosisCache()
+    return _cache
@@ -0,0 +1,283 @@
+# embedder_export.py
+#
+# TorchScript and ONNX builds of the image embedder, each also as an int8
+# dynamically-quantized variant. The 16384->512 Linear and the
+# TransformerEncoder's feed-forward layers dominate CPU inference, and dynamic
+# quantization stores their weights as int8 and quantizes activations on the
+# fly; the Conv3d layers stay fp32.
+#
+#   <dir>/manifest.json          model version, files, parity results
+#   <dir>/embedder.ts            traced + frozen fp32 TorchScript
+#   <dir>/embedder-int8.ts       torch dynamic quantization, traced
+#   <dir>/embedder.onnx          fp32 ONNX (dynamic batch axis)
+#   <dir>/embedder-int8.onnx     ONNX Runtime dynamic quantization
+#
+# The model registry serves one of these when EMBEDDER_BACKEND is set to a
+# backend other than "eager". Every export is checked against eager fp32: the
+# cosine similarity between embeddings of the same inputs must stay within
+# the backend's tolerance, or the export fails.
+#
+#   python embedder_export.py export --checkpoint embedder.pt
+#   python embedder_export.py bench
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+from torch import nn
+
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import QuantType, quantize_dynamic as ort_quantize_dynamic
+except ImportError:  # optional, only needed for the onnx backends
+    ort = None
+
+from model_registry import (DEFAULT_CHECKPOINT, WARMUP_SHAPE, build_eager, model_fingerprint,
+                            resolve_checkpoint)
+
+DEFAULT_DIR = os.getenv("EMBEDDER_EXPORT_DIR", "./models/embedder")
+ONNX_OPSET = 17
+
+BACKENDS = ("eager", "torchscript", "torchscript-int8", "onnx", "onnx-int8")
+FILES = {
+    "torchscript": "embedder.ts",
+    "torchscript-int8": "embedder-int8.ts",
+    "onnx": "embedder.onnx",
+    "onnx-int8": "embedder-int8.onnx",
+}
+# Largest allowed 1 - cosine(eager fp32, backend) over the parity inputs.
+TOLERANCES = {
+    "torchscript": 1e-5,
+    "torchscript-int8": float(os.getenv("EMBEDDER_INT8_TOLERANCE", "0.02")),
+    "onnx": 1e-4,
+    "onnx-int8": float(os.getenv("EMBEDDER_INT8_TOLERANCE", "0.02")),
+}
+
+
+def _disable_transformer_fastpath():
+    # The fused TransformerEncoder fast path reads Linear.weight as a tensor,
+    # which quantized Linear layers don't have, and it isn't traceable or
+    # exportable; the regular path computes the same thing.
+    mha = getattr(torch.backends, "mha", None)
+    if mha is not None and hasattr(mha, "set_fastpath_enabled"):
+        mha.set_fastpath_enabled(False)
+
+
+def load_eager(checkpoint: Optional[str] = None) -> nn.Module:
+    """The eval-mode fp32 embedder on the CPU, with `checkpoint`'s weights if given."""
+    return build_eager("cpu", checkpoint).model
+
+
+def quantize_int8(model: nn.Module) -> nn.Module:
+    """Dynamic int8 quantization of every Linear layer."""
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+class OnnxRuntimeModel:
+    """An ONNX Runtime session behaving like the embedder module: (N, 1, 128, 128, 64) -> (N, 512)."""
+
+    def __init__(self, path: str, threads: Optional[int] = None):
+        if ort is None:
+            raise RuntimeError("onnxruntime is not installed")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        volume = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        return torch.from_numpy(self.session.run(None, {self.input_name: volume})[0])
+
+
+def load_backend(backend: str, export_dir: str = DEFAULT_DIR):
+    """
+    (model, manifest) for an exported backend. `model` is called like the
+    eager module; `manifest["version"]` is the fingerprint of the weights it
+    was exported from.
+    """
+    if backend not in FILES:
+        raise ValueError(f"Unknown embedder backend: {backend}")
+    with open(os.path.join(export_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    path = os.path.join(export_dir, FILES[backend])
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found; run embedder_export.py export")
+    return _open(backend, path), manifest
+
+
+def _open(backend: str, path: str):
+    if backend.startswith("onnx"):
+        return OnnxRuntimeModel(path)
+    model = torch.jit.load(path, map_location="cpu")
+    model.eval()
+    return model
+
+
+def _parity_inputs(n: int = 4, seed: int = 0) -> torch.Tensor:
+    # Preprocessed volumes are scaled to [0, 1].
+    generator = torch.Generator().manual_seed(seed)
+    return torch.rand((n, 1) + WARMUP_SHAPE, generator=generator)
+
+
+@torch.no_grad()
+def parity(reference: nn.Module, candidate, inputs: torch.Tensor) -> Dict[str, float]:
+    """Cosine similarity between reference and candidate embeddings of `inputs`, one volume at a time."""
+    cosines = []
+    for volume in inputs:
+        a = reference(volume[None]).reshape(-1).double()
+        b = torch.as_tensor(candidate(volume[None])).reshape(-1).double()
+        cosines.append(float(torch.nn.functional.cosine_similarity(a, b, dim=0)))
+    return {"min_cosine": min(cosines), "mean_cosine": float(np.mean(cosines))}
+
+
+@torch.no_grad()
+def export(checkpoint: Optional[str] = None, export_dir: str = DEFAULT_DIR,
+           backends=tuple(FILES)) -> Dict:
+    """
+    Export `backends` for the checkpoint's weights (the registry's seeded
+    initialisation without one) and check each against eager
+    fp32. Raises ValueError when a backend drifts past its tolerance.
+    """
+    _disable_transformer_fastpath()
+    os.makedirs(export_dir, exist_ok=True)
+    checkpoint = resolve_checkpoint(checkpoint)
+    model = load_eager(checkpoint)
+    version = model_fingerprint(model)
+    example = torch.zeros((1, 1) + WARMUP_SHAPE)
+    inputs = _parity_inputs()
+    manifest = {"version": version, "checkpoint": checkpoint, "created": time.time(),
+                "torch": torch.__version__, "files": {}, "parity": {}}
+
+    for backend in backends:
+        path = os.path.join(export_dir, FILES[backend])
+        started = time.perf_counter()
+        if backend == "torchscript":
+            torch.jit.freeze(torch.jit.trace(model, example)).save(path)
+        elif backend == "torchscript-int8":
+            torch.jit.freeze(torch.jit.trace(quantize_int8(model), example)).save(path)
+        elif backend == "onnx":
+            torch.onnx.export(model, example, path, input_names=["volume"], output_names=["embedding"],
+                              dynamic_axes={"volume": {0: "batch"}, "embedding": {0: "batch"}},
+                              opset_version=ONNX_OPSET, do_constant_folding=True)
+        elif backend == "onnx-int8":
+            if ort is None:
+                raise RuntimeError("onnxruntime is needed for the onnx-int8 export")
+            fp32_path = os.path.join(export_dir, FILES["onnx"])
+            if not os.path.exists(fp32_path):
+                raise FileNotFoundError("onnx-int8 is quantized from the fp32 ONNX export; export 'onnx' first")
+            ort_quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8,
+                                 op_types_to_quantize=["MatMul", "Gemm"])
+        export_seconds = time.perf_counter() - started
+
+        result = parity(model, _open(backend, path), inputs)
+        result["export_seconds"] = export_seconds
+        result["bytes"] = os.path.getsize(path)
+        manifest["files"][backend] = FILES[backend]
+        manifest["parity"][backend] = result
+        print(f"{backend}: min cosine {result['min_cosine']:.6f}, {result['bytes'] / 1e6:.1f} MB")
+        if 1.0 - result["min_cosine"] > TOLERANCES[backend]:
+            raise ValueError(f"{backend} export drifted past tolerance: min cosine {result['min_cosine']:.6f}")
+
+    with open(os.path.join(export_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _rss_mb() -> float:
+    # Peak resident set size of this process (kilobytes on Linux).
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+@torch.no_grad()
+def bench_backend(backend: str, export_dir: str = DEFAULT_DIR, batch_size: int = 1,
+                  runs: int = 10, checkpoint: Optional[str] = None) -> Dict:
+    """Load `backend` and time `runs` forward passes of `batch_size` volumes."""
+    baseline_rss = _rss_mb()
+    started = time.perf_counter()
+    if backend == "eager":
+        model = load_eager(checkpoint)
+    else:
+        model, _ = load_backend(backend, export_dir)
+    load_seconds = time.perf_counter() - started
+    loaded_rss = _rss_mb()
+
+    x = _parity_inputs(batch_size)
+    model(x)  # warm-up
+    latencies = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        model(x)
+        latencies.append(time.perf_counter() - started)
+    latencies = np.array(latencies) * 1000.0
+    return {
+        "backend": backend,
+        "batch_size": batch_size,
+        "load_seconds": load_seconds,
+        "latency_ms_p50": float(np.percentile(latencies, 50)),
+        "latency_ms_p90": float(np.percentile(latencies, 90)),
+        "rss_mb_loaded": loaded_rss - baseline_rss,
+        "rss_mb_peak": _rss_mb(),
+    }
+
+
+def bench(backends=BACKENDS, **kwargs) -> Dict[str, Dict]:
+    """
+    `bench_backend` for each backend in its own process, so the RSS figures
+    aren't inflated by the backends measured before it.
+    """
+    results = {}
+    for backend in backends:
+        args = [sys.executable, os.path.abspath(__file__), "bench-one", backend]
+        for key, value in kwargs.items():
+            if value is not None:
+                args += [f"--{key.replace('_', '-')}", str(value)]
+        out = subprocess.run(args, capture_output=True, text=True)
+        if out.returncode != 0:
+            results[backend] = {"backend": backend, "error": out.stderr.strip().splitlines()[-1:]}
+            continue
+        results[backend] = json.loads(out.stdout.strip().splitlines()[-1])
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Export and benchmark the image embedder backends.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("export")
+    p.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    p.add_argument("--export-dir", default=DEFAULT_DIR)
+    p.add_argument("--backends", default=",".join(FILES))
+    for name in ("bench", "bench-one"):
+        p = sub.add_parser(name)
+        if name == "bench-one":
+            p.add_argument("backend", choices=BACKENDS)
+        else:
+            p.add_argument("--backends", default=",".join(BACKENDS))
+        p.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+        p.add_argument("--export-dir", default=DEFAULT_DIR)
+        p.add_argument("--batch-size", type=int, default=1)
+        p.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.checkpoint, args.export_dir, tuple(b for b in args.backends.split(",") if b))
+    elif args.command == "bench-one":
+        print(json.dumps(bench_backend(args.backend, args.export_dir, args.batch_size,
+                                       args.runs, args.checkpoint)))
+    else:
+        results = bench(tuple(b for b in args.backends.split(",") if b), checkpoint=args.checkpoint,
+                        export_dir=args.export_dir, batch_size=args.batch_size, runs=args.runs)
+        for backend, r in results.items():
+            if "error" in r:
+                print(f"{backend:<18} failed: {r['error']}")
+                continue
+            print(f"{backend:<18} p50 {r['latency_ms_p50']:8.1f} ms  p90 {r['latency_ms_p90']:8.1f} ms  "
+                  f"+{r['rss_mb_loaded']:7.1f} MB loaded  {r['rss_mb_peak']:7.1f} MB peak RSS")
@@ -0,0 +1,245 @@
+# embedding_cache.py
+#
+# Content-addressed cache for image embeddings. Entries are keyed by a hash of
+# the decoded float32 voxels plus the embedder's model version and
+# preprocessing backend, so re-uploads of the same study and re-runs of the
+# ingestion skip the forward pass.
+#
+# Two tiers: a bounded in-memory LRU, and an optional on-disk store of .npy
+# files that are read back memory-mapped, pruned least-recently-used first
+# beyond EMBEDDING_CACHE_MAX_BYTES. Concurrent requests for the same key are
+# collapsed into a single computation.
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+
+DEFAULT_MEMORY_ITEMS = int(os.getenv("EMBEDDING_CACHE_ITEMS", "1024"))
+# Set EMBEDDING_CACHE_DIR="" to keep the cache in memory only.
+DEFAULT_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "./data/embedding_cache")
+DEFAULT_MAX_DISK_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(1 << 30)))
+
+
+def volume_key(data: np.ndarray, model_version: Optional[str], preprocess: Optional[str] = None) -> str:
+    """
+    Hash of a decoded volume's shape and float32 voxel bytes, salted with the
+    model version and the preprocessing backend (nifti_loader.build_preprocess)
+    that produced the embedder's input.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    if not data.flags.c_contiguous:
+        # NIfTI data is usually Fortran-ordered; its transpose is a C-ordered view of the same bytes.
+        data = data.T if data.flags.f_contiguous else np.ascontiguousarray(data)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{model_version}|{preprocess}".encode())
+    h.update(repr(data.shape).encode())
+    h.update(memoryview(data).cast("B"))
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, max_items: int = DEFAULT_MEMORY_ITEMS,
+                 cache_dir: Optional[str] = DEFAULT_CACHE_DIR,
+                 max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES):
+        self.max_items = max(0, max_items)
+        self.cache_dir = cache_dir or None
+        self.max_disk_bytes = max(0, max_disk_bytes)
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        # Disk entries (key -> file size), least recently used first.
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._inflight: Dict[str, Future] = {}
+        self._counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "evictions": 0,
+            "disk_writes": 0,
+            "disk_evictions": 0,
+            "errors": 0,
+        }
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _path(self, key: str) -> str:
+        # Shard by prefix so a large store doesn't put everything in one directory.
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def _scan_disk(self):
+        """Index what earlier runs left on disk, oldest modification first."""
+        entries = []
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".npy"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.name[:-len(".npy")], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._prune_disk()
+
+    def _prune_disk(self):
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            with self._lock:
+                if self._disk_bytes <= self.max_disk_bytes or not self._disk:
+                    return
+                key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                self._counters["disk_evictions"] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _remember(self, key: str, value: np.ndarray):
+        # Caller holds self._lock.
+        if self.max_items == 0:
+            return
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def _load_disk(self, key: str) -> Optional[np.ndarray]:
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            value = np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            # Truncated or corrupt entry: treat as a miss, it will be rewritten.
+            return None
+        with self._lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+        try:
+            # Recency for the next process's _scan_disk.
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def _store_disk(self, key: str, value: np.ndarray):
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, value)
+        os.replace(tmp, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._counters["disk_writes"] += 1
+            self._disk_bytes += size - self._disk.pop(key, 0)
+            self._disk[key] = size
+        self._prune_disk()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Look `key` up in memory, then on disk. Returns None on a miss."""
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+                return value
+        value = self._load_disk(key)
+        if value is not None:
+            with self._lock:
+                self._counters["disk_hits"] += 1
+                self._remember(key, value)
+        return value
+
+    def put(self, key: str, value) -> np.ndarray:
+        value = np.asarray(value, dtype=np.float32).reshape(-1)
+        with self._lock:
+            self._remember(key, value)
+        self._store_disk(key, value)
+        return value
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> np.ndarray:
+        """
+        Return the cached embedding for `key`, or call `compute()` once to
+        produce it. Callers racing on the same key wait for the first one.
+        Values are stored and returned as flat float32 vectors.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+                self._counters["misses"] += 1
+            else:
+                self._counters["coalesced"] += 1
+        if not owner:
+            return future.result()
+
+        try:
+            value = np.asarray(compute(), dtype=np.float32).reshape(-1)
+        except BaseException as e:
+            with self._lock:
+                self._counters["errors"] += 1
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        try:
+            value = self.put(key, value)
+        except Exception as e:
+            # E.g. the disk tier is full; the embedding itself is still good.
+            print(f"Embedding cache store failed: {e}")
+        with self._lock:
+            del self._inflight[key]
+        future.set_result(value)
+        return value
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._counters["memory_hits"] + self._counters["disk_hits"] + self._counters["misses"]
+            hits = self._counters["memory_hits"] + self._counters["disk_hits"]
+            return {
+                **self._counters,
+                "hit_rate": hits / lookups if lookups else None,
+                "memory_items": len(self._memory),
+                "max_items": self.max_items,
+                "in_flight": len(self._inflight),
+                "cache_dir": self.cache_dir,
+                "disk_items": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "max_disk_bytes": self.max_disk_bytes,
+            }
+
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> EmbeddingCache:
+    """Shared per-process cache (sized from EMBEDDING_CACHE_ITEMS / EMBEDDING_CACHE_DIR)."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache()
+    return _cache
@@ -0,0 +1,178 @@
+# embedding_migration.py
+#
+# Re-embeds the clinical_data documents whose `model_version` is not the
+# current embedder's, and only those. A model upgrade is: point
+# EMBEDDER_CHECKPOINT at the new weights, restart, and run this (POST
+# /admin/reembed, or the CLI). The job visits Vespa for stale documents,
+# re-embeds their volumes from the data zip through the ingestion pipeline and
+# re-feeds them with their existing clinical fields. Documents keep serving
+# their old vectors until their replacement is fed, so nothing goes offline;
+# until the job finishes, neighbour search compares new-model queries with a
+# mix of old and new vectors.
+#
+#   python embedding_migration.py [--dry-run]
+
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from create_knowledge_base import DATA_ZIP, MANIFEST_PATH
+from ingest_manifest import IngestManifest, image_fingerprint, row_hash
+from ingest_pipeline import IngestItem, IngestPipeline, PipelineConfig
+from model_registry import get_embedder
+from vector_index import get_index
+from vespa_feeder import BulkFeeder
+from zip_volumes import ZipVolumeSource
+
+# Fewer decode workers than a full ingest, so the API keeps its CPU.
+DEFAULT_LOAD_WORKERS = int(os.getenv("REEMBED_LOAD_WORKERS", "2"))
+DEFAULT_FEED_CONCURRENCY = int(os.getenv("REEMBED_FEED_CONCURRENCY", "16"))
+
+
+def find_stale(vespa_app, version: str, schema: str = "clinical_data",
+               content_cluster: str = "clinical_data") -> List[Dict[str, Any]]:
+    """
+    {"doc_id", "fields"} of every document not embedded with `version`
+    (including ones fed before model_version existed). `fields` holds the
+    document's fields other than the embedding.
+    """
+    stale = []
+    for slice_ in vespa_app.visit(content_cluster_name=content_cluster, schema=schema,
+                                  wanted_document_count=1000):
+        for response in slice_:
+            for doc in response.documents:
+                fields = doc.get("fields", {})
+                if fields.get("model_version") == version:
+                    continue
+                stale.append({
+                    "doc_id": doc["id"].rsplit("::", 1)[-1],
+                    "fields": {k: v for k, v in fields.items()
+                               if k not in ("image_embedding", "model_version")},
+                })
+    return stale
+
+
+class ReembedJob:
+    def __init__(self, vespa_app, embedder=None, zip_path: str = DATA_ZIP,
+                 manifest_path: Optional[str] = MANIFEST_PATH, config: Optional[PipelineConfig] = None):
+        self.vespa_app = vespa_app
+        self.embedder = embedder or get_embedder("default")
+        self.zip_path = zip_path
+        self.manifest_path = manifest_path
+        self.config = config or PipelineConfig(load_workers=DEFAULT_LOAD_WORKERS,
+                                               feed_concurrency=DEFAULT_FEED_CONCURRENCY)
+        self.state = "pending"
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.stale = 0
+        self.missing: List[str] = []
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def _items(self, stale: List[Dict[str, Any]]) -> List[IngestItem]:
+        volumes = ZipVolumeSource(self.zip_path)
+        items = []
+        for doc in stale:
+            pat_id = str(doc["fields"].get("pat", doc["doc_id"].replace("clinical_", "", 1)))
+            source = volumes.member("cropped", f"pat{pat_id}_cropped.nii")
+            if source is None:
+                self.missing.append(pat_id)
+                continue
+            items.append(IngestItem(pat_id=pat_id, doc_id=doc["doc_id"], fields=doc["fields"],
+                                    image_source=source))
+        return items
+
+    def run(self, dry_run: bool = False) -> Dict[str, Any]:
+        """Find and (unless `dry_run`) re-embed the stale documents; returns `status()`."""
+        self.started_at = time.time()
+        self.state = "scanning"
+        try:
+            stale = find_stale(self.vespa_app, self.embedder.version)
+            self.stale = len(stale)
+            items = self._items(stale)
+            print(f"[reembed] {self.stale} documents not on model {self.embedder.version}, "
+                  f"{len(self.missing)} without a volume")
+            if dry_run or not items:
+                self.state = "done"
+                return self.status()
+
+            self.state = "reembedding"
+            manifest = IngestManifest(self.manifest_path) if self.manifest_path else None
+
+            def record(item, error):
+                # Keep the ingest manifest in step, so the next ingest doesn't redo these.
+                if manifest is not None and "data" in item.fields:
+                    manifest.mark(item.pat_id, row_hash(item.fields["data"]),
+                                  image_fingerprint(item.image_source), self.embedder.version, error=error)
+
+            try:
+                feeder = BulkFeeder(self.vespa_app, "clinical_data")
+                self.result = IngestPipeline(self.embedder, feeder, self.config, on_done=record,
+                                             index=get_index()).run(items)
+            finally:
+                if manifest is not None:
+                    manifest.checkpoint()
+            self.state = "done"
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            print(f"[reembed] failed: {e}")
+        finally:
+            self.finished_at = time.time()
+        return self.status()
+
+    def start(self, dry_run: bool = False) -> threading.Thread:
+        """`run` on a daemon thread."""
+        self._thread = threading.Thread(target=self.run, args=(dry_run,), name="reembed", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def status(self) -> Dict[str, Any]:
+        result = self.result or {}
+        return {
+            "state": self.state,
+            "model_version": self.embedder.version,
+            "stale": self.stale,
+            "missing_volumes": list(self.missing),
+            "reembedded": result.get("num_docs"),
+            "errors": result.get("errors"),
+            "error": self.error,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+_job: Optional[ReembedJob] = None
+_job_lock = threading.Lock()
+
+
+def start_reembed(vespa_app, dry_run: bool = False) -> ReembedJob:
+    """Start a background re-embed unless one is already running; returns the current job."""
+    global _job
+    with _job_lock:
+        if _job is None or not _job.running:
+            _job = ReembedJob(vespa_app)
+            _job.start(dry_run)
+        return _job
+
+
+def current_job() -> Optional[ReembedJob]:
+    return _job
+
+
+if __name__ == "__main__":
+    import argparse
+    from vespa.application import Vespa
+    parser = argparse.ArgumentParser(description="Re-embed documents produced by an older embedder.")
+    parser.add_argument("--vespa-url", default="http://localhost")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--dry-run", action="store_true", help="only count the stale documents")
+    args = parser.parse_args()
+
+    print(ReembedJob(Vespa(url=args.vespa_url, port=args.port)).run(dry_run=args.dry_run))
@@ -0,0 +1,284 @@
+# embedding_store.py
+#
+# Compact on-disk store for the 512-d image embeddings. Vectors are kept as
+# memory-mapped int8 codes with one float32 scale per vector (or as float16),
+# which is what candidate search scans; the float32 originals sit in a second
+# memory-mapped file and are only paged in to rescore the shortlist.
+#
+#   <store>/meta.json     dim, dtype, metric, count
+#   <store>/ids.json      document ids, row order
+#   <store>/codes.npy     (n, dim) int8 or float16
+#   <store>/scales.npy    (n,) float32, int8 stores only
+#   <store>/full.npy      (n, dim) float32, for reranking
+#   <store>/norms.npy     (n,) float32, angular stores only: the original
+#                         vector lengths (full.npy holds unit vectors)
+#
+# Also converts to and from the Vespa JSON feed format. Exports are partial
+# updates of the embedding field, so feeding one back leaves the documents'
+# other fields alone.
+
+import json
+import os
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+DTYPES = ("int8", "float16")
+# Rows scored per block during candidate search, so dequantizing never
+# materializes a full float32 copy of the store.
+_BLOCK_ROWS = 8192
+
+
+def vespa_tensor(vector) -> Dict[str, str]:
+    """
+    Dense tensor<float> field value as Vespa's hex short form: 8 hex digits
+    (big-endian float32) per cell. Much smaller and faster to serialize than
+    a JSON list of Python floats.
+    """
+    return {"values": np.asarray(vector, dtype=">f4").reshape(-1).tobytes().hex().upper()}
+
+
+def tensor_from_vespa(value) -> np.ndarray:
+    """Inverse of `vespa_tensor`; also accepts list "values" and cells forms."""
+    if isinstance(value, dict):
+        if "values" in value:
+            value = value["values"]
+        elif "cells" in value:
+            cells = sorted(value["cells"], key=lambda c: int(c["address"]["d"]))
+            value = [c["value"] for c in cells]
+    if isinstance(value, str):
+        return np.frombuffer(bytes.fromhex(value), dtype=">f4").astype(np.float32)
+    return np.asarray(value, dtype=np.float32)
+
+
+def quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Symmetric per-vector int8 (codes, scales), or (float16 codes, None)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class EmbeddingStore:
+    def __init__(self, path: str):
+        """Open an existing store; arrays are memory-mapped read-only."""
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, "ids.json")) as f:
+            self.ids: List[str] = json.load(f)
+        self.dim = self.meta["dim"]
+        self.dtype = self.meta["dtype"]
+        self.metric = self.meta["metric"]
+        self.codes = np.load(os.path.join(path, "codes.npy"), mmap_mode="r")
+        scales_path = os.path.join(path, "scales.npy")
+        self.scales = np.load(scales_path, mmap_mode="r") if os.path.exists(scales_path) else None
+        self.full = np.load(os.path.join(path, "full.npy"), mmap_mode="r")
+        norms_path = os.path.join(path, "norms.npy")
+        self.norms = np.load(norms_path, mmap_mode="r") if os.path.exists(norms_path) else None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, path: str, ids: List[str], vectors, dtype: str = "int8",
+              metric: str = "angular") -> "EmbeddingStore":
+        if dtype not in DTYPES:
+            raise ValueError(f"dtype must be one of {DTYPES}")
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or len(vectors) != len(ids):
+            raise ValueError("Expected one (dim,) vector per id")
+        norms = None
+        if metric == "angular":
+            # Unit vectors: dot product == cosine, and int8 scales stay comparable.
+            # The lengths are kept so exports give back the original vectors.
+            norms = np.linalg.norm(vectors, axis=1).astype(np.float32)
+            vectors = vectors / np.maximum(norms[:, np.newaxis], 1e-12)
+        codes, scales = quantize(vectors, dtype)
+
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "codes.npy"), codes)
+        scales_path = os.path.join(path, "scales.npy")
+        if scales is not None:
+            np.save(scales_path, scales)
+        elif os.path.exists(scales_path):
+            os.remove(scales_path)
+        np.save(os.path.join(path, "full.npy"), vectors)
+        norms_path = os.path.join(path, "norms.npy")
+        if norms is not None:
+            np.save(norms_path, norms)
+        elif os.path.exists(norms_path):
+            os.remove(norms_path)
+        with open(os.path.join(path, "ids.json"), "w") as f:
+            json.dump(list(ids), f)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"dim": int(vectors.shape[1]), "dtype": dtype, "metric": metric,
+                       "count": len(ids)}, f)
+        return cls(path)
+
+    def _query(self, vector) -> np.ndarray:
+        q = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if self.metric == "angular":
+            q = q / max(float(np.linalg.norm(q)), 1e-12)
+        return q
+
+    def candidates(self, vector, n: int) -> np.ndarray:
+        """Row indices of the `n` best approximate scores over the quantized codes."""
+        q = self._query(vector)
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), _BLOCK_ROWS):
+            block = np.asarray(self.codes[start:start + _BLOCK_ROWS], dtype=np.float32)
+            scores[start:start + len(block)] = block @ q
+        if self.scales is not None:
+            scores *= self.scales
+        n = min(n, len(self))
+        top = np.argpartition(-scores, n - 1)[:n] if n < len(self) else np.arange(len(self))
+        return top
+
+    def search(self, vector, k: int = 3, rerank: int = 10) -> List[Tuple[str, float]]:
+        """
+        Top-k (id, score) by scanning the quantized codes for `k * rerank`
+        candidates, then rescoring only those at full precision.
+        """
+        if len(self) == 0:
+            return []
+        q = self._query(vector)
+        rows = np.sort(self.candidates(q, max(k, k * rerank)))
+        scores = np.asarray(self.full[rows]) @ q
+        order = np.argsort(-scores)[:k]
+        return [(self.ids[rows[i]], float(scores[i])) for i in order]
+
+    def exact_search(self, vector, k: int = 3) -> List[Tuple[str, float]]:
+        """Full-precision brute force, the reference for `evaluate`."""
+        q = self._query(vector)
+        scores = np.asarray(self.full) @ q
+        order = np.argsort(-scores)[:k]
+        return [(self.ids[i], float(scores[i])) for i in order]
+
+    def original(self, row: int) -> np.ndarray:
+        """The vector `row` was built from (before angular normalization)."""
+        vector = np.asarray(self.full[row], dtype=np.float32)
+        if self.norms is not None:
+            vector = vector * self.norms[row]
+        return vector
+
+    def resident_bytes(self) -> Dict[str, int]:
+        """Bytes scanned per query (codes + scales) vs. the float32 originals."""
+        scanned = self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+        return {"quantized": int(scanned), "float32": int(self.full.nbytes)}
+
+    # --- Vespa feed format ---
+
+    def iter_feed(self, schema: str = "clinical_data", field: str = "image_embedding",
+                  namespace: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Vespa JSON feed operations assigning `field` of every stored document.
+        Partial updates, since a "put" would replace the whole document.
+        """
+        namespace = namespace or schema
+        for i, doc_id in enumerate(self.ids):
+            yield {"update": f"id:{namespace}:{schema}::{doc_id}",
+                   "fields": {field: {"assign": vespa_tensor(self.original(i))}}}
+
+    def export_feed(self, out_path: str, **kwargs) -> int:
+        """Write `iter_feed` as JSON lines (the format vespa feed accepts). Returns the doc count."""
+        count = 0
+        with open(out_path, "w") as f:
+            for op in self.iter_feed(**kwargs):
+                f.write(json.dumps(op) + "\n")
+                count += 1
+        return count
+
+    @classmethod
+    def import_feed(cls, feed_path: str, path: str, field: str = "image_embedding",
+                    **kwargs) -> "EmbeddingStore":
+        """Build a store from a Vespa JSON feed (JSON lines or a JSON array of operations)."""
+        with open(feed_path) as f:
+            text = f.read()
+        stripped = text.lstrip()
+        ops = json.loads(stripped) if stripped.startswith("[") else (
+            json.loads(line) for line in text.splitlines() if line.strip())
+        ids, vectors = [], []
+        for op in _feed_docs(ops):
+            value = op.get("fields", {}).get(field)
+            if value is None:
+                continue
+            ids.append(op["id"].rsplit("::", 1)[-1])
+            vectors.append(tensor_from_vespa(value))
+        return cls.build(path, ids, np.stack(vectors) if vectors else np.zeros((0, 512), np.float32),
+                         **kwargs)
+
+
+def _feed_docs(ops: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """Normalize "put"/"update" feed operations and visit dumps to {"id", "fields"}."""
+    for op in ops:
+        doc_id = op.get("put") or op.get("id") or op.get("update")
+        if not doc_id:
+            continue
+        fields = op.get("fields", {})
+        if "update" in op:
+            # Only assignments carry a whole value.
+            fields = {name: value["assign"] for name, value in fields.items()
+                      if isinstance(value, dict) and "assign" in value}
+        yield {"id": doc_id, "fields": fields}
+
+
+def evaluate(store: EmbeddingStore, queries, k: int = 10, rerank: int = 10) -> Dict[str, Any]:
+    """Recall@k of quantized search + rerank against full-precision brute force, plus memory savings."""
+    queries = np.asarray(queries, dtype=np.float32).reshape(-1, store.dim)
+    recalls, latencies_ms = [], []
+    for q in queries:
+        started = time.perf_counter()
+        approx = {doc_id for doc_id, _ in store.search(q, k, rerank)}
+        latencies_ms.append((time.perf_counter() - started) * 1000.0)
+        truth = {doc_id for doc_id, _ in store.exact_search(q, k)}
+        recalls.append(len(approx & truth) / max(1, len(truth)))
+    memory = store.resident_bytes()
+    return {
+        "dtype": store.dtype,
+        "size": len(store),
+        "k": k,
+        "rerank": rerank,
+        "recall_at_k": float(np.mean(recalls)) if recalls else None,
+        "latency_ms_p50": float(np.percentile(latencies_ms, 50)) if latencies_ms else None,
+        "memory_reduction": memory["float32"] / memory["quantized"] if memory["quantized"] else None,
+        **{f"{name}_bytes": n for name, n in memory.items()},
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Quantized embedding store tools.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("import", help="build a store from a Vespa JSON feed")
+    p.add_argument("feed")
+    p.add_argument("store")
+    p.add_argument("--dtype", choices=DTYPES, default="int8")
+    p = sub.add_parser("export", help="write a store as a Vespa JSON-lines feed")
+    p.add_argument("store")
+    p.add_argument("feed")
+    p.add_argument("--schema", default="clinical_data")
+    p = sub.add_parser("eval", help="recall@k and memory of a store, using its own vectors as queries")
+    p.add_argument("store")
+    p.add_argument("-k", type=int, default=10)
+    p.add_argument("--rerank", type=int, default=10)
+    p.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        store = EmbeddingStore.import_feed(args.feed, args.store, dtype=args.dtype)
+        print(f"Imported {len(store)} vectors into {args.store} ({args.dtype})")
+    elif args.command == "export":
+        n = EmbeddingStore(args.store).export_feed(args.feed, schema=args.schema)
+        print(f"Exported {n} documents to {args.feed}")
+    else:
+        store = EmbeddingStore(args.store)
+        rng = np.random.default_rng(0)
+        rows = rng.choice(len(store), size=min(args.queries, len(store)), replace=False)
+        # Perturbed stored vectors, so queries aren't trivially their own nearest neighbour.
+        queries = np.asarray(store.full[rows]) + 0.05 * rng.standard_normal((len(rows), store.dim))
+        print(evaluate(store, queries, args.k, args.rerank))
@@ -1,21 +1,23 @@
-import nibabel as nib
-from nibabel.fileholders import FileHolder
-import io
 import base64
 import numpy as np
 import torch
 from torch import nn
-from monai.transforms import Compose, Resize, ScaleIntensity, ToTensor
+from nifti_stream import volume_from_buffer
+from nifti_loader import DEFAULT_BACKEND as PREPROCESS_BACKEND, build_preprocess, read_nifti_float32
+from embedding_cache import volume_key
 
 class NIfTIToEmbedding:
-    def __init__(self, device='cuda' if torch.cuda.is_available() else 'cpu'):
+    def __init__(self, device='cuda' if torch.cuda.is_available() else 'cpu', model=None):
         self.device = device
-        self.model = self._build_model().to(device)
-        self.preprocess = Compose([
-            Resize(spatial_size=(128, 128, 64)),
-            ScaleIntensity(minv=0.0, maxv=1.0),
-            ToTensor(dtype=torch.float32)
-        ])
+        # `model` replaces the eager network, e.g. an exported TorchScript or
+        # ONNX Runtime build (see embedder_export.py).
+        self.model = model if model is not None else self._build_model().to(device)
+        self.preprocess_backend = PREPROCESS_BACKEND
+        self.preprocess = build_preprocess(self.preprocess_backend)
+        # Optional EmbeddingCache plus the version string its keys are salted
+        # with; both are set by the model registry for shared instances.
+        self.cache = None
+        self.version = None
 
     def _build_model(self):
         return nn.Sequential(
@@ -44,41 +46,69 @@ class NIfTIToEmbedding:
             nn.Flatten()
         )
 
+    def read_nifti(self, path):
+        """Decode a .nii file from disk to a float32 voxel array (no preprocessing)."""
+        return read_nifti_float32(path)
+
+    def decode_base64(self, base64_string: str):
+        """Decode a base64 .nii payload to a float32 voxel array (no preprocessing)."""
+        try:
+            # Decode base64 -> bytes, then view the voxels in place rather
+            # than going through a float64 get_fdata() copy.
+            nifti_data = base64.b64decode(base64_string)
+            return np.asarray(volume_from_buffer(memoryview(nifti_data)), dtype=np.float32)
+        except Exception as e:
+            raise ValueError(f"Error decoding or loading NIfTI from base64: {e}")
+
+    def decode_buffer(self, buf):
+        """Decode an in-memory .nii buffer (bytes/bytearray/memoryview) to a float32 voxel array."""
+        try:
+            return np.asarray(volume_from_buffer(memoryview(buf)), dtype=np.float32)
+        except Exception as e:
+            raise ValueError(f"Error loading NIfTI from buffer: {e}")
+
     def load_nifti(self, path):
         """Load from disk."""
-        img = nib.load(path)
-        data = img.get_fdata().astype(np.float32)
-        return self.preprocess(data[np.newaxis, ...])  # add channel
+        return self.preprocess(self.read_nifti(path)[np.newaxis, ...])  # add channel
 
     def load_nifti_from_base64(self, base64_string: str):
         """Load from base64."""
-        try:
-            # Decode base64 -> bytes
-            nifti_data = base64.b64decode(base64_string)
+        return self.preprocess(self.decode_base64(base64_string)[np.newaxis, ...])  # add channel
 
-            file_map = nib.Nifti1Image.make_file_map()
-            # Just set the "image" key
-            file_map["image"].fileobj = io.BytesIO(nifti_data)
+    def load_nifti_from_buffer(self, buf):
+        """Load from an in-memory .nii buffer without copying it."""
+        return self.preprocess(self.decode_buffer(buf)[np.newaxis, ...])  # add channel
 
-            # Create the image from file_map
-            img = nib.Nifti1Image.from_file_map(file_map)
+    @torch.no_grad()
+    def embed_batch(self, x: torch.Tensor):
+        """Get embeddings for a preprocessed batch of shape (N, 1, 128, 128, 64)."""
+        return self.model(x.to(self.device)).cpu().numpy()
 
-            data = img.get_fdata().astype(np.float32)
-            return self.preprocess(data[np.newaxis, ...])  # add channel
-        except Exception as e:
-            raise ValueError(f"Error decoding or loading NIfTI from base64: {e}")
+    def embed_volume(self, data, embed_fn=None):
+        """
+        Get the (512,) embedding of one decoded volume, going through
+        `self.cache` when one is attached. `embed_fn` maps a preprocessed
+        (1, 128, 128, 64) tensor to its embedding; it defaults to a
+        batch-of-one forward pass (the upload path passes the inference queue).
+        """
+        if embed_fn is None:
+            embed_fn = lambda volume: self.embed_batch(volume.unsqueeze(0))
+
+        def compute():
+            return np.asarray(embed_fn(self.preprocess(data[np.newaxis, ...])),
+                              dtype=np.float32).reshape(-1)
+
+        if self.cache is None:
+            return compute()
+        return self.cache.get_or_compute(volume_key(data, self.version, self.preprocess_backend), compute)
 
-    @torch.no_grad()
     def __call__(self, nii_path: str):
         """Get embedding from file path."""
-        x = self.load_nifti(nii_path).unsqueeze(0).to(self.device)
-        return self.model(x).cpu().numpy()
+        return self.embed_volume(self.read_nifti(nii_path))[np.newaxis, :]
 
-    @torch.no_grad()
     def embedding_from_base64(self, base64_string: str):
         """Get embedding directly from base64."""
-        x = self.load_nifti_from_base64(base64_string).unsqueeze(0).to(self.device)
-        return self.model(x).cpu().numpy()
+        return self.embed_volume(self.decode_base64(base64_string))[np.newaxis, :]
 
 # Usage Example:
 # from_disk = NIfTIToEmbedding()("/path/to/your_file.nii")
@@ -0,0 +1,139 @@
+# inference_queue.py
+#
+# Dynamic micro-batching in front of the image embedder. Concurrent /upload
+# requests each submit one preprocessed volume; a single worker thread gathers
+# whatever arrives within `max_wait_ms` (up to `max_batch_size` items), runs
+# one batched forward pass and hands each row of the result back to its caller.
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Dict, Optional
+
+import numpy as np
+import torch
+
+from model_registry import get_embedder
+
+DEFAULT_MAX_BATCH_SIZE = int(os.getenv("INFERENCE_MAX_BATCH_SIZE", "8"))
+DEFAULT_MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", "10"))
+
+# How many recent samples we keep for the percentile stats.
+_STATS_WINDOW = 1024
+
+
+def _percentile(samples, q: float) -> Optional[float]:
+    if not samples:
+        return None
+    return float(np.percentile(np.fromiter(samples, dtype=np.float64), q))
+
+
+class InferenceQueue:
+    def __init__(self, embedder, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_wait_ms: float = DEFAULT_MAX_WAIT_MS):
+        self.embedder = embedder
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = deque(maxlen=_STATS_WINDOW)
+        self._queue_waits_ms = deque(maxlen=_STATS_WINDOW)
+        self._batch_ms = deque(maxlen=_STATS_WINDOW)
+        self._num_batches = 0
+        self._num_items = 0
+        self._num_errors = 0
+        self._worker = threading.Thread(target=self._run, name="inference-queue", daemon=True)
+        self._worker.start()
+
+    def submit(self, volume: torch.Tensor) -> Future:
+        """
+        Enqueue one preprocessed volume of shape (1, 128, 128, 64).
+        Returns a Future resolving to its (512,) embedding.
+        """
+        future: Future = Future()
+        self._queue.put((volume, future, time.perf_counter()))
+        return future
+
+    def embed(self, volume: torch.Tensor, timeout: Optional[float] = None) -> np.ndarray:
+        """Blocking convenience wrapper around `submit`."""
+        return self.submit(volume).result(timeout=timeout)
+
+    def _collect(self):
+        # Block for the first item, then keep gathering until the batch is
+        # full or the oldest request has waited `max_wait`.
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            volumes = [item[0] for item in batch]
+            futures = [item[1] for item in batch]
+            try:
+                embeddings = self.embedder.embed_batch(torch.stack(volumes))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                with self._stats_lock:
+                    self._num_errors += len(batch)
+                continue
+            finished = time.perf_counter()
+            for i, future in enumerate(futures):
+                future.set_result(embeddings[i])
+            with self._stats_lock:
+                self._num_batches += 1
+                self._num_items += len(batch)
+                self._batch_sizes.append(len(batch))
+                self._batch_ms.append((finished - started) * 1000.0)
+                self._queue_waits_ms.extend((started - item[2]) * 1000.0 for item in batch)
+
+    def stats(self) -> Dict[str, Any]:
+        """Batch-size and queue-wait stats over the last `_STATS_WINDOW` samples."""
+        with self._stats_lock:
+            sizes = list(self._batch_sizes)
+            waits = list(self._queue_waits_ms)
+            batch_ms = list(self._batch_ms)
+            return {
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "queue_depth": self._queue.qsize(),
+                "num_batches": self._num_batches,
+                "num_items": self._num_items,
+                "num_errors": self._num_errors,
+                "mean_batch_size": float(np.mean(sizes)) if sizes else None,
+                "batch_size_histogram": {str(n): sizes.count(n) for n in sorted(set(sizes))},
+                "queue_wait_ms_p50": _percentile(waits, 50),
+                "queue_wait_ms_p99": _percentile(waits, 99),
+                "batch_ms_p50": _percentile(batch_ms, 50),
+                "batch_ms_p99": _percentile(batch_ms, 99),
+            }
+
+
+_queues: Dict[str, InferenceQueue] = {}
+_queues_lock = threading.Lock()
+
+
+def get_queue(name: str = "default", **kwargs) -> InferenceQueue:
+    """Shared per-process queue for the registry embedder `name`."""
+    q = _queues.get(name)
+    if q is not None:
+        return q
+    with _queues_lock:
+        q = _queues.get(name)
+        if q is None:
+            q = InferenceQueue(get_embedder(name), **kwargs)
+            _queues[name] = q
+    return q
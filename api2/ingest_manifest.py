@@ -0,0 +1,118 @@
+# ingest_manifest.py
+#
+# Persistent record of what the knowledge base already contains. For every
+# patient we keep the hash of its clinical row, a fingerprint of its image,
+# the embedder version and whether feeding succeeded. Reruns only process
+# entries whose inputs changed or that never made it into Vespa, and the
+# manifest is checkpointed while ingestion runs so a crash resumes from there.
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from zip_volumes import ZipMember, open_zip
+
+MANIFEST_VERSION = 1
+
+STATUS_FED = "fed"
+STATUS_FAILED = "failed"
+
+
+def row_hash(clinical_string: str) -> str:
+    return hashlib.blake2b(clinical_string.encode(), digest_size=16).hexdigest()
+
+
+def image_fingerprint(source) -> str:
+    """
+    Cheap identity for an image source. Zip members use the CRC32 and size
+    already stored in the archive directory, so nothing has to be read; the
+    values recorded when the member was listed are used when present, so
+    they always match the archive the member came from.
+    """
+    if isinstance(source, ZipMember):
+        if source.crc is not None:
+            return f"crc32:{source.crc:08x}:{source.file_size}"
+        info = open_zip(source.zip_path).getinfo(source.member)
+        return f"crc32:{info.CRC:08x}:{info.file_size}"
+    h = hashlib.blake2b(digest_size=16)
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return f"blake2b:{h.hexdigest()}"
+
+
+class IngestManifest:
+    def __init__(self, path: str, checkpoint_every: int = 16):
+        self.path = path
+        self.checkpoint_every = max(1, checkpoint_every)
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._dirty = 0
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            payload = json.load(f)
+        if payload.get("version") != MANIFEST_VERSION:
+            print(f"Ignoring manifest {self.path} with unknown version {payload.get('version')}")
+            return
+        self._entries = payload.get("entries", {})
+
+    def checkpoint(self):
+        """Atomically write the manifest to disk."""
+        with self._lock:
+            payload = {"version": MANIFEST_VERSION, "entries": self._entries}
+            directory = os.path.dirname(self.path) or "."
+            os.makedirs(directory, exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(payload, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+            self._dirty = 0
+
+    def status(self, pat_id: str, row: str, image: str, model_version: Optional[str]) -> str:
+        """One of "new", "changed", "failed" or "unchanged"."""
+        entry = self._entries.get(pat_id)
+        if entry is None:
+            return "new"
+        if (entry.get("row_hash"), entry.get("image_hash"), entry.get("model_version")) != (row, image, model_version):
+            return "changed"
+        if entry.get("status") != STATUS_FED:
+            return "failed"
+        return "unchanged"
+
+    def plan(self, candidates: Iterable[Dict[str, Any]]) -> Dict[str, List[str]]:
+        """
+        Classify `candidates` (dicts with pat_id, row_hash, image_hash,
+        model_version). Patients in the manifest but not among the candidates
+        are reported as "removed"; nothing is deleted from Vespa.
+        """
+        plan: Dict[str, List[str]] = {"new": [], "changed": [], "failed": [], "unchanged": []}
+        seen = set()
+        for c in candidates:
+            seen.add(c["pat_id"])
+            plan[self.status(c["pat_id"], c["row_hash"], c["image_hash"], c["model_version"])].append(c["pat_id"])
+        plan["removed"] = sorted(set(self._entries) - seen)
+        return plan
+
+    def mark(self, pat_id: str, row: str, image: str, model_version: Optional[str],
+             error: Optional[str] = None):
+        """Record the outcome for one patient, checkpointing every `checkpoint_every` marks."""
+        with self._lock:
+            self._entries[pat_id] = {
+                "row_hash": row,
+                "image_hash": image,
+                "model_version": model_version,
+                "status": STATUS_FAILED if error else STATUS_FED,
+                "error": error,
+                "updated_at": time.time(),
+            }
+            self._dirty += 1
+            due = self._dirty >= self.checkpoint_every
+        if due:
+            self.checkpoint()
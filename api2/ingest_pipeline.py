@@ -0,0 +1,371 @@
+# ingest_pipeline.py
+#
+# Staged knowledge-base ingestion. Three stages connected by bounded queues so
+# disk I/O, CPU preprocessing, inference and Vespa feeding overlap:
+#
+#   load    - NIfTI decoding + preprocessing in a process pool
+#   embed   - one thread running batched forward passes (cache-aware)
+#   feed    - a BulkFeeder streaming documents to Vespa concurrently
+#
+# Each stage records its own throughput so the slow one is easy to spot.
+
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+import torch
+
+from embedding_cache import volume_key
+from nifti_loader import DEFAULT_BACKEND as PREPROCESS_BACKEND, build_preprocess, read_nifti_float32
+from vespa_feeder import BulkFeeder, FeedResult
+from embedding_store import vespa_tensor
+from zip_volumes import ZipMember, read_member_volume
+
+DEFAULT_LOAD_WORKERS = int(os.getenv("INGEST_LOAD_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+DEFAULT_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "8"))
+DEFAULT_FEED_CONCURRENCY = int(os.getenv("INGEST_FEED_CONCURRENCY", "32"))
+DEFAULT_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "32"))
+
+# Marks the end of a stage's input.
+_DONE = object()
+
+
+@dataclass
+class IngestItem:
+    """One patient to ingest: the Vespa document minus its embedding, plus where its volume lives."""
+    pat_id: str
+    doc_id: str
+    fields: Dict[str, Any]
+    image_source: Any
+
+
+@dataclass
+class PipelineConfig:
+    load_workers: int = DEFAULT_LOAD_WORKERS
+    batch_size: int = DEFAULT_BATCH_SIZE
+    feed_concurrency: int = DEFAULT_FEED_CONCURRENCY
+    queue_size: int = DEFAULT_QUEUE_SIZE
+
+
+class StageStats:
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self.items = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self._first_start: Optional[float] = None
+        self._last_end: Optional[float] = None
+
+    def record(self, started: float, items: int = 1, errors: int = 0):
+        ended = time.perf_counter()
+        with self._lock:
+            self.items += items
+            self.errors += errors
+            self.busy_seconds += ended - started
+            if self._first_start is None or started < self._first_start:
+                self._first_start = started
+            self._last_end = ended
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            wall = (self._last_end - self._first_start) if self._first_start is not None else 0.0
+            return {
+                "items": self.items,
+                "errors": self.errors,
+                "wall_seconds": wall,
+                "busy_seconds": self.busy_seconds,
+                "docs_per_sec": self.items / wall if wall > 0 else None,
+            }
+
+
+# --- load stage (runs in worker processes) ---
+
+_worker_preprocess = None
+
+
+def _init_load_worker():
+    global _worker_preprocess
+    # Several workers share the machine; don't let each one spin up a full thread pool.
+    torch.set_num_threads(1)
+    _worker_preprocess = build_preprocess(PREPROCESS_BACKEND)
+
+
+def read_volume(source) -> np.ndarray:
+    """Decode an image source (a .nii/.nii.gz path or a ZipMember) to a float32 voxel array."""
+    if isinstance(source, ZipMember):
+        return read_member_volume(source)
+    return read_nifti_float32(source)
+
+
+def _load_and_preprocess(source, model_version: Optional[str]):
+    """Worker task: returns (cache key, preprocessed (1, 128, 128, 64) float32 array)."""
+    data = read_volume(source)
+    key = volume_key(data, model_version, PREPROCESS_BACKEND)
+    return key, _worker_preprocess(data[np.newaxis, ...]).numpy()
+
+
+# --- pipeline ---
+
+class IngestPipeline:
+    def __init__(self, embedder, feeder: BulkFeeder,
+                 config: Optional[PipelineConfig] = None,
+                 on_done: Optional[Callable[[IngestItem, Optional[str]], Any]] = None,
+                 index=None):
+        """
+        `feeder` sends finished documents to Vespa; its concurrency is set
+        from `config.feed_concurrency` and its result callback is taken over
+        by the pipeline. `on_done(item, error)` is called once per item with
+        None on success or the error message of the stage that failed; the
+        calls are made one at a time on a thread of their own, so a slow
+        callback (e.g. a manifest write) never stalls the feeder's event loop.
+        Documents Vespa accepted are also upserted into `index` (a
+        vector_index.VectorIndex) when one is given.
+        """
+        self.embedder = embedder
+        self.on_done = on_done
+        self.index = index
+        self.config = config or PipelineConfig()
+        self.feeder = feeder
+        self.feeder.concurrency = max(1, self.config.feed_concurrency)
+        self.feeder.on_result = self._feed_result
+        # Feed sequence number -> (item, embedding) for documents handed to
+        # the feeder but not yet acknowledged. Not keyed by doc_id: the same
+        # patient can appear twice in one run.
+        self._feeding: Dict[int, tuple] = {}
+        self._feed_seq = itertools.count()
+        self._callbacks: Optional[ThreadPoolExecutor] = None
+        self._feed_summary: Dict[str, Any] = {}
+        self._feed_drained = False
+        self.stats = {name: StageStats(name) for name in ("load", "embed", "feed")}
+        self._embed_q: "queue.Queue" = queue.Queue(maxsize=self.config.queue_size)
+        self._feed_q: "queue.Queue" = queue.Queue(maxsize=self.config.queue_size)
+        self._errors: List[Dict[str, str]] = []
+        self._errors_lock = threading.Lock()
+
+    def _error(self, item: IngestItem, stage: str, e):
+        print(f"Error in {stage} stage for patient {item.pat_id}: {e}")
+        with self._errors_lock:
+            self._errors.append({"pat": item.pat_id, "stage": stage, "error": str(e)})
+        self._notify(item, f"{stage}: {e}")
+
+    def _notify(self, item: IngestItem, error: Optional[str]):
+        if self.on_done is None:
+            return
+
+        def _call():
+            try:
+                self.on_done(item, error)
+            except Exception as callback_error:
+                print(f"on_done callback failed for patient {item.pat_id}: {callback_error}")
+
+        self._callbacks.submit(_call)
+
+    def _load_stage(self, items: Iterable[IngestItem]):
+        cfg = self.config
+        # Bounds the number of decoded volumes alive between pool and embed stage.
+        slots = threading.BoundedSemaphore(cfg.queue_size)
+        ctx = multiprocessing.get_context("spawn")
+        futures = []
+        with ProcessPoolExecutor(max_workers=max(1, cfg.load_workers), mp_context=ctx,
+                                 initializer=_init_load_worker) as pool:
+            for item in items:
+                slots.acquire()
+                started = time.perf_counter()
+                future = pool.submit(_load_and_preprocess, item.image_source, self.embedder.version)
+
+                def _done(f, item=item, started=started):
+                    self.stats["load"].record(started, errors=int(f.exception() is not None))
+                    self._embed_q.put((item, f, slots))
+
+                future.add_done_callback(_done)
+                futures.append(future)
+            wait(futures)
+        self._embed_q.put(_DONE)
+
+    def _next_batch(self):
+        first = self._embed_q.get()
+        if first is _DONE:
+            return None, True
+        batch = [first]
+        done = False
+        while len(batch) < self.config.batch_size:
+            try:
+                entry = self._embed_q.get(timeout=0.05)
+            except queue.Empty:
+                break
+            if entry is _DONE:
+                done = True
+                break
+            batch.append(entry)
+        return batch, done
+
+    def _cached(self, key):
+        cache = self.embedder.cache
+        if cache is None:
+            return None
+        try:
+            return cache.get(key)
+        except Exception as e:
+            # A broken cache tier only costs a forward pass.
+            print(f"Embedding cache lookup failed: {e}")
+            return None
+
+    def _store(self, key, embedding):
+        cache = self.embedder.cache
+        if cache is None:
+            return embedding
+        try:
+            return cache.put(key, embedding)
+        except Exception as e:
+            # E.g. the disk tier is full; the embedding itself is still good.
+            print(f"Embedding cache store failed: {e}")
+            return embedding
+
+    def _embed_batch(self, batch):
+        """Embed one batch and queue the results for feeding; returns (queued, embed errors)."""
+        ready, pending = [], []
+        for item, future, _ in batch:
+            try:
+                key, volume = future.result()
+            except Exception as e:
+                self._error(item, "load", e)
+                continue
+            cached = self._cached(key)
+            if cached is not None:
+                ready.append((item, cached))
+            else:
+                pending.append((item, key, volume))
+
+        errors = 0
+        if pending:
+            try:
+                volumes = torch.from_numpy(np.stack([p[2] for p in pending]))
+                embeddings = self.embedder.embed_batch(volumes)
+            except Exception as e:
+                for item, _, _ in pending:
+                    self._error(item, "embed", e)
+                errors = len(pending)
+            else:
+                for (item, key, _), embedding in zip(pending, embeddings):
+                    ready.append((item, self._store(key, embedding)))
+
+        for i, (item, embedding) in enumerate(ready):
+            try:
+                self._feed_q.put((item, embedding))
+            except Exception as e:
+                for failed, _ in ready[i:]:
+                    self._error(failed, "embed", e)
+                return i, errors + len(ready) - i
+        return len(ready), errors
+
+    def _embed_stage(self):
+        done = False
+        try:
+            while not done:
+                batch, done = self._next_batch()
+                if not batch:
+                    done = True
+                    break
+                # Free the load stage's slots first, so nothing below can leave it blocked.
+                for _, _, slots in batch:
+                    slots.release()
+                started = time.perf_counter()
+                try:
+                    queued, errors = self._embed_batch(batch)
+                except Exception as e:
+                    # Unexpected failure: fail the batch but keep the stage alive.
+                    for item, _, _ in batch:
+                        self._error(item, "embed", e)
+                    queued, errors = 0, len(batch)
+                self.stats["embed"].record(started, items=queued, errors=errors)
+        finally:
+            if not done:
+                # The stage is going down anyway; keep releasing the load
+                # stage's slots until it finishes, so run() can return.
+                for item, _, slots in iter(self._embed_q.get, _DONE):
+                    slots.release()
+                    self._error(item, "embed", "embed stage stopped")
+            self._feed_q.put(_DONE)
+
+    def _feed_docs(self):
+        while True:
+            entry = self._feed_q.get()
+            if entry is _DONE:
+                self._feed_drained = True
+                return
+            item, embedding = entry
+            fields = dict(item.fields)
+            # Hex short form: no per-float Python objects or decimal JSON.
+            fields["image_embedding"] = vespa_tensor(embedding)
+            # Which weights produced it, so stale documents can be found later.
+            fields["model_version"] = self.embedder.version
+            seq = next(self._feed_seq)
+            self._feeding[seq] = (item, embedding)
+            yield item.doc_id, fields, seq
+
+    def _feed_result(self, result: FeedResult):
+        item, embedding = self._feeding.pop(result.context)
+        started = time.perf_counter() - result.latency_ms / 1000.0
+        self.stats["feed"].record(started, items=int(result.ok), errors=int(not result.ok))
+        if not result.ok:
+            self._error(item, "feed", result.error)
+            return
+        if self.index is not None:
+            self.index.upsert(item.doc_id, embedding, item.fields)
+        self._notify(item, None)
+
+    def _feed_stage(self):
+        try:
+            self._feed_summary = self.feeder.feed(self._feed_docs())
+        except Exception as e:
+            print(f"Feeder stopped: {e}")
+            for item, _ in list(self._feeding.values()):
+                self._error(item, "feed", e)
+            self._feeding.clear()
+            # Keep draining so the embed stage never blocks on a full queue.
+            if not self._feed_drained:
+                for entry in iter(self._feed_q.get, _DONE):
+                    self._error(entry[0], "feed", e)
+
+    def run(self, items: Iterable[IngestItem]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        # One thread, so on_done calls never race each other.
+        self._callbacks = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest-done")
+        threads = [threading.Thread(target=self._embed_stage, name="ingest-embed", daemon=True)]
+        threads.append(threading.Thread(target=self._feed_stage, name="ingest-feed", daemon=True))
+        for t in threads:
+            t.start()
+        try:
+            self._load_stage(items)
+        except BaseException:
+            # Let the downstream stages drain and exit before re-raising.
+            self._embed_q.put(_DONE)
+            raise
+        finally:
+            for t in threads:
+                t.join()
+            # Every outcome is reported before run() returns.
+            self._callbacks.shutdown(wait=True)
+        elapsed = time.perf_counter() - started
+
+        stages = {name: s.summary() for name, s in self.stats.items()}
+        for name, s in stages.items():
+            rate = f"{s['docs_per_sec']:.1f} docs/s" if s["docs_per_sec"] else "n/a"
+            print(f"[ingest] {name:<5} {s['items']} items, {s['errors']} errors, {rate}")
+        num_docs = stages["feed"]["items"]
+        print(f"[ingest] {num_docs} documents in {elapsed:.1f}s")
+        return {
+            "num_docs": num_docs,
+            "elapsed_seconds": elapsed,
+            "stages": stages,
+            "feeder": self._feed_summary,
+            "errors": list(self._errors),
+        }
@@ -0,0 +1,312 @@
+# job_queue.py
+#
+# Asynchronous analysis jobs. POST /jobs stores the uploaded volume, enqueues
+# a job and returns its id straight away; a fixed pool of workers on the event
+# loop runs the analysis, and clients poll (or long-poll) for the result.
+#
+# Admission control: each priority has its own queue-depth limit, and
+# submissions past it are refused (HTTP 429) instead of piling up. Interactive
+# jobs are always dequeued before bulk ones, and `reserved_workers` workers
+# only take interactive jobs, so a bulk backlog can't starve the UI.
+#
+# Job state lives in SQLite and the inputs as .nii files next to it, so queued
+# jobs survive a restart; jobs that were running when the process died are
+# run again.
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+DEFAULT_DIR = os.getenv("JOBS_DIR", "./data/jobs")
+DEFAULT_WORKERS = int(os.getenv("JOBS_WORKERS", "4"))
+DEFAULT_RESERVED_WORKERS = int(os.getenv("JOBS_RESERVED_WORKERS", "1"))
+DEFAULT_MAX_INTERACTIVE = int(os.getenv("JOBS_MAX_QUEUED", "64"))
+DEFAULT_MAX_BULK = int(os.getenv("JOBS_MAX_BULK_QUEUED", "1024"))
+DEFAULT_RESULT_TTL = float(os.getenv("JOBS_RESULT_TTL_SECONDS", str(24 * 3600)))
+
+PRIORITIES = ("interactive", "bulk")
+FINISHED = ("done", "failed", "cancelled")
+
+# Runs one job: given the path of its .nii input, returns the JSON result.
+Runner = Callable[[str], Awaitable[Dict[str, Any]]]
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    id: str
+    priority: str
+    status: str = "queued"
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "priority": self.priority,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    def __init__(self, runner: Runner, path: str = DEFAULT_DIR, workers: int = DEFAULT_WORKERS,
+                 reserved_workers: int = DEFAULT_RESERVED_WORKERS,
+                 max_interactive: int = DEFAULT_MAX_INTERACTIVE, max_bulk: int = DEFAULT_MAX_BULK,
+                 result_ttl: float = DEFAULT_RESULT_TTL):
+        """
+        `workers` jobs run at once; `reserved_workers` of them only run
+        interactive jobs. `max_interactive` / `max_bulk` bound how many jobs
+        of each priority may be queued. Finished jobs are forgotten after
+        `result_ttl` seconds.
+        """
+        self.runner = runner
+        self.path = path
+        self.workers = max(1, workers)
+        self.reserved_workers = min(max(0, reserved_workers), self.workers - 1)
+        self.limits = {"interactive": max(1, max_interactive), "bulk": max(1, max_bulk)}
+        self.result_ttl = result_ttl
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = {}
+        self._pending = {p: deque() for p in PRIORITIES}
+        self._admitting = {p: 0 for p in PRIORITIES}
+        self._events: Dict[str, asyncio.Event] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._workers = []
+        self._cond: Optional[asyncio.Condition] = None
+        self._counters = {"submitted": 0, "rejected": 0, "done": 0, "failed": 0,
+                          "cancelled": 0, "recovered": 0}
+
+        os.makedirs(os.path.join(path, "inputs"), exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(path, "jobs.sqlite"), check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, priority TEXT, "
+                         "status TEXT, created REAL, started REAL, finished REAL, result TEXT, error TEXT)")
+        self._db.commit()
+
+    def input_path(self, job_id: str) -> str:
+        return os.path.join(self.path, "inputs", f"{job_id}.nii")
+
+    async def _save(self, job: Job):
+        # Snapshot the row on the loop; the SQLite write and commit run in a thread.
+        row = (job.id, job.priority, job.status, job.created, job.started, job.finished,
+               json.dumps(job.result) if job.result is not None else None, job.error)
+        await asyncio.get_running_loop().run_in_executor(None, self._write_row, row)
+
+    def _write_row(self, row: tuple):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
+            self._db.commit()
+
+    # --- lifecycle ---
+
+    async def start(self):
+        """Reload persisted jobs and start the workers. Call from the app's event loop."""
+        self._cond = asyncio.Condition()
+        await self._prune()
+        rows = self._db.execute("SELECT id, priority, status, created, started, finished, result, error "
+                                "FROM jobs ORDER BY created").fetchall()
+        for row in rows:
+            job = Job(row[0], row[1], row[2], row[3], row[4], row[5],
+                      json.loads(row[6]) if row[6] is not None else None, row[7])
+            self._jobs[job.id] = job
+            self._events[job.id] = asyncio.Event()
+            if job.status in FINISHED:
+                self._events[job.id].set()
+                continue
+            # Queued, or interrupted mid-run: run it (again) if the input survived.
+            if os.path.exists(self.input_path(job.id)):
+                job.status, job.started = "queued", None
+                self._pending[job.priority].append(job.id)
+                self._counters["recovered"] += 1
+            else:
+                self._finish(job, "failed", error="Job input was lost")
+            await self._save(job)
+        for i in range(self.workers):
+            self._workers.append(asyncio.ensure_future(self._work(interactive_only=i < self.reserved_workers)))
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # Jobs interrupted here stay "running" on disk and are rerun by start().
+        with self._lock:
+            self._db.close()
+
+    async def _prune(self):
+        expired = await asyncio.get_running_loop().run_in_executor(
+            None, self._delete_expired, time.time() - self.result_ttl)
+        for job_id in expired:
+            self._jobs.pop(job_id, None)
+            self._events.pop(job_id, None)
+
+    def _delete_expired(self, cutoff: float) -> List[str]:
+        with self._lock:
+            expired = [row[0] for row in self._db.execute(
+                "SELECT id FROM jobs WHERE finished IS NOT NULL AND finished < ?", (cutoff,))]
+            self._db.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (cutoff,))
+            self._db.commit()
+        return expired
+
+    # --- API ---
+
+    async def submit(self, nifti: bytes, priority: str = "interactive") -> Dict[str, Any]:
+        """
+        Store `nifti` (an uncompressed .nii) and enqueue it. Raises
+        JobQueueFull when the priority's queue is at its limit.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"priority must be one of {PRIORITIES}")
+        # Count submissions still writing their input against the limit too.
+        if len(self._pending[priority]) + self._admitting[priority] >= self.limits[priority]:
+            self._counters["rejected"] += 1
+            raise JobQueueFull(f"Too many queued {priority} jobs ({self.limits[priority]})")
+        job = Job(uuid.uuid4().hex, priority)
+        self._admitting[priority] += 1
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, _write_file, self.input_path(job.id), nifti)
+        finally:
+            self._admitting[priority] -= 1
+        # Persist before the job becomes visible, so it can't be cancelled mid-save.
+        await self._save(job)
+        self._jobs[job.id] = job
+        self._events[job.id] = asyncio.Event()
+        async with self._cond:
+            self._pending[priority].append(job.id)
+            # Wake every idle worker: notify() could pick a reserved worker
+            # that can't take a bulk job, leaving it queued while others sleep.
+            self._cond.notify_all()
+        self._counters["submitted"] += 1
+        return self.status(job.id)
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        status = job.to_dict()
+        if job.status == "queued":
+            status["position"] = self._position(job)
+        return status
+
+    def _position(self, job: Job) -> int:
+        """Number of queued jobs that will be dequeued before `job`."""
+        ahead = self._pending[job.priority].index(job.id)
+        if job.priority == "bulk":
+            ahead += len(self._pending["interactive"])
+        return ahead
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Long-poll: the job's status once it finishes, or after `timeout` seconds."""
+        event = self._events.get(job_id)
+        if event is None:
+            return None
+        if timeout > 0 and not event.is_set():
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.status(job_id)
+
+    async def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if job.status == "queued":
+            async with self._cond:
+                self._pending[job.priority].remove(job.id)
+            self._finish(job, "cancelled")
+            await self._save(job)
+        elif job.status == "running" and job.id in self._tasks:
+            self._tasks[job.id].cancel()
+            # The worker records the cancellation once the task has unwound.
+            await self._events[job.id].wait()
+        return self.status(job_id)
+
+    # --- workers ---
+
+    async def _next(self, interactive_only: bool) -> Job:
+        async with self._cond:
+            while True:
+                if self._pending["interactive"]:
+                    job_id = self._pending["interactive"].popleft()
+                    break
+                if not interactive_only and self._pending["bulk"]:
+                    job_id = self._pending["bulk"].popleft()
+                    break
+                await self._cond.wait()
+            if self._pending["interactive"] or self._pending["bulk"]:
+                # Someone else may be able to take the next one (again not
+                # necessarily the next waiter, who may be interactive-only).
+                self._cond.notify_all()
+        return self._jobs[job_id]
+
+    def _finish(self, job: Job, status: str, result: Optional[Dict[str, Any]] = None,
+                error: Optional[str] = None):
+        job.status, job.result, job.error = status, result, error
+        job.finished = time.time()
+        self._counters[status] += 1
+        try:
+            os.remove(self.input_path(job.id))
+        except FileNotFoundError:
+            pass
+        self._events[job.id].set()
+
+    async def _work(self, interactive_only: bool):
+        while True:
+            job = await self._next(interactive_only)
+            job.status, job.started = "running", time.time()
+            task = asyncio.ensure_future(self.runner(self.input_path(job.id)))
+            self._tasks[job.id] = task
+            try:
+                await self._save(job)
+                result = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    # The worker itself is being stopped; leave the job to be rerun.
+                    task.cancel()
+                    raise
+                self._finish(job, "cancelled")
+            except Exception as e:
+                self._finish(job, "failed", error=getattr(e, "detail", None) or str(e))
+            else:
+                self._finish(job, "done", result=result)
+            finally:
+                self._tasks.pop(job.id, None)
+            await self._save(job)
+            await self._prune()
+
+    def stats(self) -> Dict[str, Any]:
+        running = [j for j in self._jobs.values() if j.status == "running"]
+        return {
+            **self._counters,
+            "queued": {p: len(q) for p, q in self._pending.items()},
+            "queue_limits": dict(self.limits),
+            "running": {p: sum(1 for j in running if j.priority == p) for p in PRIORITIES},
+            "workers": self.workers,
+            "reserved_workers": self.reserved_workers,
+        }
+
+
+def _write_file(path: str, data: bytes):
+    # Write then rename, so a crash never leaves a truncated input behind.
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
@@ -1,26 +1,47 @@
 # main.py
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from fastapi.responses import FileResponse, Response, StreamingResponse
 import pandas as pd
 import os
 from sentence_transformers import SentenceTransformer
 from vespa.application import Vespa
 import requests
 from dotenv import load_dotenv
-from embeddings import NIfTIToEmbedding
-from smart_diagnosis import sMaRTDiagnosis
+from model_registry import get_embedder, readiness, is_ready, warmup_in_background
+from inference_queue import get_queue
+from embedding_cache import get_cache
+from vector_index import get_index, load_in_background
+from vespa_query import VespaQueryClient, VespaQueryError
+from nifti_stream import DEFAULT_MAX_BODY_BYTES, NiftiBuffer, PayloadTooLarge
+from smart_diagnosis import close_client as close_diagnosis_client, diagnose, first_flag, flag_bits, stream_diagnosis
+from diagnosis_cache import get_diagnosis_cache
+from job_queue import JobQueue, JobQueueFull
+from mesh_store import get_mesh_store
 from create_knowledge_base import ingest_data_from_zip
+from embedding_migration import current_job as current_reembed, start_reembed
 from fastapi.middleware.cors import CORSMiddleware
 
 from pydantic import BaseModel
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import base64
+import json
 app = FastAPI(title="Vespa Embeddings/RAG FastAPI Demo")
 
 # Initialize Vespa client – assumes Vespa is running at localhost:8080
 vespa_app = Vespa(url="http://localhost", port=8080)
 # vespa_app = Vespa(url="https://e7032d12.d1f1f075.z.vespa-app.cloud/", port=8080)
 
+# Queries from the endpoints go through one pooled, non-blocking client
+# (vespa_app is still used for feeding and visiting).
+vespa_query = VespaQueryClient(
+    os.getenv("VESPA_URL", "http://localhost:8080"),
+    endpoint_concurrency={"search": int(os.getenv("SEARCH_QUERY_CONCURRENCY", "32")),
+                          "upload": int(os.getenv("UPLOAD_QUERY_CONCURRENCY", "16"))},
+)
+
 # ---------------------------
 #  CORS Middleware
 # ---------------------------
@@ -32,6 +53,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ---------------------------
+#  Model warmup
+# ---------------------------
+@app.on_event("startup")
+def warm_models():
+    # Build the shared embedder and run a dummy forward pass in the background,
+    # so the first /upload doesn't pay for model construction.
+    warmup_in_background("default")
+    # Mirror clinical_data into the in-process vector index (VECTOR_INDEX_MODE).
+    load_in_background(vespa_app)
+
+@app.on_event("shutdown")
+async def close_clients():
+    await jobs.stop()
+    await vespa_query.aclose()
+    await close_diagnosis_client()
+
 # ---------------------------
 #  Pydantic Models
 # ---------------------------
@@ -45,68 +83,104 @@ class UploadRequest(BaseModel):
 #  Existing Endpoints
 # ---------------------------
 @app.post("/search")
-def search_documents(req: QueryRequest):
+async def search_documents(req: QueryRequest):
     """
     Given a query text, generate an embedding, and search for nearest docs in Vespa.
     (This was from the original snippet, for textual queries.)
     """
-    from app.embeddings import generate_embedding
-    query_vec = generate_embedding(req.query_text)
-
-    hits = vespa_app.query(
-        body={
-            "yql": "select * from sources * where ([{\"targetNumHits\":10}]nearestNeighbor(embedding, query_embedding));",
-            "hits": 10,
-            "input.query_embedding": query_vec,
-            "ranking.features.query(query_embedding)": query_vec,
-            "ranking.profile": "default"
-        },
-        schema="hvsmr"
-    )
-    return hits.json
+    from app.embeddings import embed_query
+    query_vec = await run_in_threadpool(embed_query, req.query_text)
+
+    try:
+        return await vespa_query.query(
+            body={
+                "yql": "select * from sources * where ([{\"targetNumHits\":10}]nearestNeighbor(embedding, query_embedding));",
+                "hits": 10,
+                "input.query_embedding": query_vec,
+                "ranking.features.query(query_embedding)": query_vec,
+                "ranking.profile": "default"
+            },
+            endpoint="search",
+            schema="hvsmr"
+        )
+    except VespaQueryError as e:
+        raise HTTPException(status_code=502, detail=f"Vespa query error: {str(e)}")
 
 @app.get("/healthcheck")
 def healthcheck():
     return {"status": "ok"}
 
+@app.get("/ready")
+def ready():
+    """Readiness probe: 503 until the shared embedder has been built and warmed up."""
+    models = readiness()
+    if not is_ready("default"):
+        raise HTTPException(status_code=503, detail={"status": "warming", "models": models})
+    return {"status": "ready", "models": models}
+
+@app.get("/stats/inference")
+def inference_stats():
+    """Micro-batching stats (batch sizes, queue wait percentiles) for tuning."""
+    return get_queue("default").stats()
+
+@app.get("/stats/cache")
+def cache_stats():
+    """Embedding cache hit/miss/eviction counters."""
+    return get_cache().stats()
+
+@app.get("/stats/diagnosis-cache")
+def diagnosis_cache_stats():
+    """Diagnosis cache hit/miss counters."""
+    return get_diagnosis_cache().stats()
+
+@app.get("/stats/vespa-query")
+def vespa_query_stats():
+    """Query client latency, hedging and retry counters."""
+    return vespa_query.stats()
+
 # ---------------------------
 #  New "/upload" Endpoint
 # ---------------------------
-@app.post("/upload")
-def upload_file(req: UploadRequest) -> Dict[str, Any]:
+def _embed_volume(data):
+    # Repeat volumes are served from the embedding cache; misses are batched
+    # with concurrent uploads by the inference queue.
+    return get_embedder("default").embed_volume(data, get_queue("default").embed).tolist()
+
+async def _find_neighbours(data):
     """
-    Receive a base64-encoded NIfTI file, convert it to an embedding,
-    perform a Vespa ANN search, gather relevant doc data, then call
-    the sMaRTDiagnosis function to get an AI-based diagnosis + links.
-    Return them to the client as JSON.
+    Embed a decoded volume and find its nearest docs. Returns the hits, their
+    'data' fields combined into one string for sMaRTDiagnosis, and the
+    confidence. Blocking steps run in the threadpool; the Vespa query runs on
+    the loop.
     """
-    base64_str = req.nii_path
-    if not base64_str:
-        raise HTTPException(status_code=400, detail="No NIfTI data received")
-
-    # 1. Generate embedding from base64
-    embedder = NIfTIToEmbedding()
+    # 1. Generate embedding.
     try:
-        embedding = embedder.embedding_from_base64(base64_str).flatten().tolist()
+        embedding = await run_in_threadpool(_embed_volume, data)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating embedding: {str(e)}")
 
-    # 2. Query Vespa for nearest docs
-    try:
-        response = vespa_app.query(
-            body={
-                "yql": "select * from sources * where ([{\"targetNumHits\":3}]nearestNeighbor(image_embedding, query_vec));",
-                "hits": 3,
-                "input.query_vec": embedding,
-                "ranking.features.query(query_vec)": embedding,
-                "ranking.profile": "default"
-            },
-            schema="clinical_data"
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Vespa query error: {str(e)}")
+    # 2. Find the nearest docs: in-process when the vector index is loaded,
+    #    otherwise (and as the source of truth) from Vespa.
+    index = get_index()
+    if index is not None and index.ready:
+        hits = index.search(embedding, 3)
+    else:
+        try:
+            response = await vespa_query.query(
+                body={
+                    "yql": "select * from sources * where ([{\"targetNumHits\":3}]nearestNeighbor(image_embedding, query_vec));",
+                    "hits": 3,
+                    "input.query_vec": embedding,
+                    "ranking.features.query(query_vec)": embedding,
+                    "ranking.profile": "default"
+                },
+                endpoint="upload",
+                schema="clinical_data"
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Vespa query error: {str(e)}")
 
-    hits = response.json["root"].get("children", [])
+        hits = response["root"].get("children", [])
     if not hits:
         # If we get no results, we still pass something to sMaRTDiagnosis
         # but let's at least let the user know.
@@ -116,15 +190,26 @@ def upload_file(req: UploadRequest) -> Dict[str, Any]:
     #    For example, we might join 'data' fields from the top 3 hits.
     #    Or you can do something more advanced if you want.
     doc_strings = []
+    doc_confidence = ""
     for h in hits:
         fields = h.get("fields", {})
         doc_data = fields.get("data", "")
         doc_confidence = h.get("relevance", "")
         doc_strings.append(doc_data)
     combined_data = "\n".join(doc_strings) if doc_strings else "No data from Vespa"
+    return hits, combined_data, doc_confidence
+
+async def _analyze_volume(data) -> Dict[str, Any]:
+    """
+    Shared tail of the upload endpoints: embed a decoded volume,
+    perform a Vespa ANN search, gather relevant doc data, then call
+    the sMaRTDiagnosis function to get an AI-based diagnosis + links.
+    """
+    hits, combined_data, doc_confidence = await _find_neighbours(data)
 
     # 4. Pass to sMaRTDiagnosis to get textual diagnosis + relevant links
-    diagnosis_text, diagnosis_links, first_diagnosis = sMaRTDiagnosis(combined_data)
+    #    (cached by clinical flag vector, so repeats skip the LLM call)
+    diagnosis_text, diagnosis_links, first_diagnosis = await diagnose(combined_data)
 
     # 5. Return the final JSON to the client
     print(doc_confidence)
@@ -135,3 +220,299 @@ def upload_file(req: UploadRequest) -> Dict[str, Any]:
         "num_hits": len(hits),
         # "first_diagnosis": first_diagnosis
     }
+
+@app.post("/upload")
+async def upload_file(req: UploadRequest) -> Dict[str, Any]:
+    """
+    Receive a base64-encoded NIfTI file and run it through the analysis
+    pipeline (embedding -> Vespa ANN search -> sMaRTDiagnosis).
+    Kept for compatibility; prefer /upload/raw for large volumes.
+    """
+    return await _analyze_volume(await _decode_base64_upload(req))
+
+async def _decode_base64_upload(req: UploadRequest):
+    base64_str = req.nii_path
+    if not base64_str:
+        raise HTTPException(status_code=400, detail="No NIfTI data received")
+
+    embedder = await run_in_threadpool(get_embedder, "default")
+    try:
+        return await run_in_threadpool(embedder.decode_base64, base64_str)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating embedding: {str(e)}")
+
+# ---------------------------
+#  Raw binary / multipart upload
+# ---------------------------
+RAW_UPLOAD_CONTENT_TYPES = ("application/octet-stream", "application/gzip", "application/x-gzip")
+
+async def _read_nifti_body(request: Request) -> memoryview:
+    """
+    Stream the request body into a single NiftiBuffer. Accepts either a raw
+    .nii/.nii.gz body or a multipart form with one file field.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    length = request.headers.get("content-length")
+    length = int(length) if length and length.isdigit() else None
+    if length is not None and length > DEFAULT_MAX_BODY_BYTES:
+        raise HTTPException(status_code=413, detail=f"Body exceeds the {DEFAULT_MAX_BODY_BYTES} byte limit")
+    try:
+        if content_type.startswith("multipart/form-data"):
+            form = await request.form()
+            upload = next((v for v in form.values() if isinstance(v, StarletteUploadFile)), None)
+            if upload is None:
+                raise HTTPException(status_code=400, detail="Multipart body has no file field")
+            name = (upload.filename or "").lower()
+            if name and not (name.endswith(".nii") or name.endswith(".nii.gz")):
+                raise HTTPException(status_code=415, detail="Expected a .nii or .nii.gz file")
+            try:
+                buffer = NiftiBuffer(getattr(upload, "size", None))
+                # The spooled upload file is read synchronously off the event loop.
+                await run_in_threadpool(buffer.readfrom, upload.file)
+            finally:
+                await upload.close()
+        elif content_type in RAW_UPLOAD_CONTENT_TYPES or not content_type:
+            buffer = NiftiBuffer(length)
+            async for chunk in request.stream():
+                # Inflating gzip bodies is CPU work; keep it off the event loop.
+                await run_in_threadpool(buffer.feed, chunk)
+        else:
+            raise HTTPException(status_code=415, detail=f"Unsupported content type: {content_type}")
+        return await run_in_threadpool(buffer.finish)
+    except PayloadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/upload/raw")
+async def upload_raw(request: Request) -> Dict[str, Any]:
+    """
+    Same analysis as /upload, but the NIfTI volume is sent as the raw request
+    body (application/octet-stream) or as a multipart .nii/.nii.gz file
+    instead of base64 inside JSON.
+    """
+    return await _analyze_volume(await _decode_raw_upload(request))
+
+async def _decode_raw_upload(request: Request):
+    body = await _read_nifti_body(request)
+    if not len(body):
+        raise HTTPException(status_code=400, detail="No NIfTI data received")
+
+    embedder = await run_in_threadpool(get_embedder, "default")
+    try:
+        return await run_in_threadpool(embedder.decode_buffer, body)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error loading NIfTI: {str(e)}")
+
+# ---------------------------
+#  Streaming upload
+# ---------------------------
+def _wants_sse(request: Request) -> bool:
+    return "text/event-stream" in request.headers.get("accept", "")
+
+async def _stream_analysis(data, sse: bool):
+    """
+    Events, one JSON object each (NDJSON lines, or SSE "data:" frames):
+      {"event": "neighbours", "hits": [...], "confidence": ..., "num_hits": n}
+      {"event": "token", "text": "..."}            (repeated)
+      {"event": "citations", "links": [...], "first_diagnosis": "..."}
+      {"event": "done", "diagnosis_text": "..."}
+      {"event": "error", "detail": "..."}          (instead of the rest)
+    """
+    def frame(payload: Dict[str, Any]) -> str:
+        line = json.dumps(payload)
+        return f"data: {line}\n\n" if sse else line + "\n"
+
+    try:
+        hits, combined_data, doc_confidence = await _find_neighbours(data)
+    except HTTPException as e:
+        yield frame({"event": "error", "detail": e.detail})
+        return
+    yield frame({
+        "event": "neighbours",
+        "hits": [{"id": h.get("id"), "relevance": h.get("relevance"),
+                  "pat": h.get("fields", {}).get("pat")} for h in hits],
+        "confidence": doc_confidence,
+        "num_hits": len(hits),
+    })
+
+    parts = []
+    async for kind, value in stream_diagnosis(combined_data):
+        if kind == "token":
+            parts.append(value)
+            yield frame({"event": "token", "text": value})
+        elif kind == "citations":
+            yield frame({"event": "citations", "links": value,
+                         "first_diagnosis": first_flag(flag_bits(combined_data))})
+        else:
+            yield frame({"event": "error", "detail": value})
+            return
+    yield frame({"event": "done", "diagnosis_text": "".join(parts)})
+
+def _streaming_response(request: Request, data) -> StreamingResponse:
+    sse = _wants_sse(request)
+    return StreamingResponse(
+        _stream_analysis(data, sse),
+        media_type="text/event-stream" if sse else "application/x-ndjson",
+        # Stop proxies from buffering the stream.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/upload/stream")
+async def upload_stream(req: UploadRequest, request: Request):
+    """
+    Streaming /upload: the nearest neighbours and confidence are sent as soon
+    as the search finishes, then the diagnosis streams in token by token.
+    NDJSON by default, Server-Sent Events with "Accept: text/event-stream".
+    """
+    return _streaming_response(request, await _decode_base64_upload(req))
+
+@app.post("/upload/raw/stream")
+async def upload_raw_stream(request: Request):
+    """Streaming variant of /upload/raw (same events as /upload/stream)."""
+    return _streaming_response(request, await _decode_raw_upload(request))
+
+# ---------------------------
+#  Analysis jobs
+# ---------------------------
+async def _run_job(input_path: str) -> Dict[str, Any]:
+    embedder = await run_in_threadpool(get_embedder, "default")
+    try:
+        data = await run_in_threadpool(embedder.read_nifti, input_path)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error loading NIfTI: {str(e)}")
+    return await _analyze_volume(data)
+
+# Queued and finished jobs are kept under JOBS_DIR across restarts.
+jobs = JobQueue(_run_job)
+
+@app.on_event("startup")
+async def start_jobs():
+    await jobs.start()
+
+def _nifti_from_base64(base64_str: str) -> memoryview:
+    buffer = NiftiBuffer()
+    buffer.feed(base64.b64decode(base64_str))
+    return buffer.finish()
+
+async def _submit_job(nifti, priority: str) -> Dict[str, Any]:
+    try:
+        return await jobs.submit(nifti, priority)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/jobs", status_code=202)
+async def submit_job(req: UploadRequest, priority: str = Query("interactive")) -> Dict[str, Any]:
+    """
+    Queue a base64-encoded NIfTI volume for analysis and return its job id
+    at once. `priority` is "interactive" (default) or "bulk"; bulk jobs only
+    run when no interactive job is waiting. 429 when the queue is full.
+    """
+    if not req.nii_path:
+        raise HTTPException(status_code=400, detail="No NIfTI data received")
+    try:
+        nifti = await run_in_threadpool(_nifti_from_base64, req.nii_path)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error decoding NIfTI: {str(e)}")
+    return await _submit_job(nifti, priority)
+
+@app.post("/jobs/raw", status_code=202)
+async def submit_raw_job(request: Request, priority: str = Query("interactive")) -> Dict[str, Any]:
+    """Queue a raw or multipart .nii/.nii.gz upload (as /upload/raw) for analysis."""
+    body = await _read_nifti_body(request)
+    if not len(body):
+        raise HTTPException(status_code=400, detail="No NIfTI data received")
+    return await _submit_job(body, priority)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = Query(0, ge=0, le=60)) -> Dict[str, Any]:
+    """
+    Job status; "result" holds the /upload response once status is "done".
+    With `wait`, hold the request up to that many seconds for the job to finish.
+    """
+    status = await jobs.wait(job_id, wait)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return status
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str) -> Dict[str, Any]:
+    """Cancel a queued or running job. Finished jobs are returned unchanged."""
+    status = await jobs.cancel(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return status
+
+@app.get("/stats/jobs")
+def job_stats():
+    """Queue depth per priority, running jobs and outcome counters."""
+    return jobs.stats()
+
+# ---------------------------
+#  Re-embedding after a model upgrade
+# ---------------------------
+@app.post("/admin/reembed", status_code=202)
+def reembed(dry_run: bool = Query(False)) -> Dict[str, Any]:
+    """
+    Re-embed and re-feed, in the background, the documents whose
+    model_version isn't the current embedder's. Returns the running job's
+    status if one is already in progress; `dry_run` only counts them.
+    """
+    return start_reembed(vespa_app, dry_run=dry_run).status()
+
+@app.get("/stats/reembed")
+def reembed_stats():
+    """Status of the last re-embed job."""
+    job = current_reembed()
+    if job is None:
+        return {"state": "idle"}
+    return job.status()
+
+# ---------------------------
+#  Heart meshes
+# ---------------------------
+# Meshes only change when a patient is re-ingested, and the ETag changes with
+# them, so clients may reuse a copy for a while and revalidate after that.
+MESH_CACHE_CONTROL = "public, max-age=3600, must-revalidate"
+
+def _mesh_index(patient_id: str) -> Dict[str, Any]:
+    try:
+        index = get_mesh_store().index(patient_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if index is None:
+        raise HTTPException(status_code=404, detail=f"No meshes for patient {patient_id}")
+    return index
+
+@app.get("/meshes/{patient_id}")
+def mesh_regions(patient_id: str) -> Dict[str, Any]:
+    """
+    Regions available for a patient, with their .glb URLs, sizes and ETags.
+    Each region's "lods" lists decimated levels, coarsest first, so a viewer
+    can show those and refine up to the full-resolution "url".
+    """
+    index = _mesh_index(patient_id)
+    regions = []
+    for r in index["regions"]:
+        url = f"/meshes/{patient_id}/{r['label']}.glb"
+        regions.append({**r, "url": url,
+                        "lods": [{**l, "url": f"{url}?lod={l['level']}"} for l in r.get("lods", [])]})
+    return {"patient": patient_id, "regions": regions}
+
+@app.get("/meshes/{patient_id}/{label}.glb")
+def mesh_region(patient_id: str, label: int, request: Request, lod: Optional[int] = Query(None, ge=0)):
+    """
+    One region as binary glTF (KHR_mesh_quantization), at full resolution or
+    decimated level `lod`. Honours If-None-Match.
+    """
+    _mesh_index(patient_id)
+    region = get_mesh_store().region(patient_id, label, lod)
+    if region is None:
+        raise HTTPException(status_code=404, detail=f"No region {label} (lod {lod}) for patient {patient_id}")
+    path, etag = region
+    headers = {"ETag": etag, "Cache-Control": MESH_CACHE_CONTROL}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="model/gltf-binary", headers=headers)
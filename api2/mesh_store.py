@@ -0,0 +1,249 @@
+# mesh_store.py
+#
+# Precomputed heart meshes for the web viewer, one binary glTF (.glb) file per
+# patient and segmentation label:
+#
+#   <store>/<patient>/index.json   regions, their ETags and the source fingerprint
+#   <store>/<patient>/<label>.glb
+#   <store>/<patient>/<label>.lod<n>.glb   decimated levels (mesh_lod), coarsest first
+#
+# Positions are quantized to uint16 (KHR_mesh_quantization; the node's
+# translation/scale maps them back to voxel coordinates), normals to int8 and
+# indices are uint16 whenever the region has fewer than 65536 vertices. That
+# is 12 bytes per vertex plus 6 (or 12) per triangle, against the float64
+# JSON text that plot_smooth_heart writes into its HTML.
+
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from heart_mesh import DEFAULT_SIGMA, DEFAULT_WORKERS, mesh_labels
+from mesh_lod import DEFAULT_BUDGETS, build_lods
+from ingest_manifest import image_fingerprint
+
+DEFAULT_DIR = os.getenv("MESH_DIR", "./data/meshes")
+
+# Viewer colours per label (RGB, 0-1), in the spirit of the RdYlBu plots.
+REGION_COLORS = {
+    1: (0.84, 0.19, 0.15), 2: (0.96, 0.43, 0.26), 3: (0.99, 0.68, 0.38), 4: (1.00, 0.88, 0.56),
+    5: (0.88, 0.95, 0.97), 6: (0.67, 0.85, 0.91), 7: (0.45, 0.68, 0.82), 8: (0.27, 0.46, 0.71),
+}
+
+_PATIENT_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+
+# glTF constants
+_BYTE, _UNSIGNED_SHORT, _UNSIGNED_INT = 5120, 5123, 5125
+_ARRAY_BUFFER, _ELEMENT_ARRAY_BUFFER = 34962, 34963
+
+
+def vertex_normals(verts: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    """Area-weighted unit vertex normals."""
+    tri = verts[faces.astype(np.int64)]
+    face_normals = np.cross(tri[:, 1] - tri[:, 0], tri[:, 2] - tri[:, 0])
+    normals = np.empty_like(verts, dtype=np.float32)
+    flat = faces.reshape(-1)
+    for axis in range(3):
+        normals[:, axis] = np.bincount(flat, weights=np.repeat(face_normals[:, axis], 3),
+                                       minlength=len(verts))
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    return normals
+
+
+def _pad4(data: bytes, fill: bytes = b"\x00") -> bytes:
+    return data + fill * (-len(data) % 4)
+
+
+def encode_glb(verts: np.ndarray, faces: np.ndarray, color=None, name: str = "region") -> bytes:
+    """One quantized, indexed triangle mesh as a self-contained .glb."""
+    verts = np.asarray(verts, dtype=np.float32)
+    lo, hi = verts.min(axis=0), verts.max(axis=0)
+    scale = np.maximum(hi - lo, 1e-6) / 65535.0
+    # Positions and normals are padded to 8 and 4 bytes per vertex: glTF
+    # vertex strides must be multiples of 4.
+    positions = np.zeros((len(verts), 4), dtype=np.uint16)
+    positions[:, :3] = np.rint((verts - lo) / scale)
+    normals = np.zeros((len(verts), 4), dtype=np.int8)
+    normals[:, :3] = np.rint(vertex_normals(verts, faces) * 127.0)
+    index_type = _UNSIGNED_SHORT if len(verts) < 65536 else _UNSIGNED_INT
+    indices = np.ascontiguousarray(faces, dtype=np.uint16 if index_type == _UNSIGNED_SHORT else np.uint32)
+
+    views, offset, blobs = [], 0, []
+    for blob, target, stride in ((positions.tobytes(), _ARRAY_BUFFER, 8),
+                                 (normals.tobytes(), _ARRAY_BUFFER, 4),
+                                 (indices.tobytes(), _ELEMENT_ARRAY_BUFFER, None)):
+        view = {"buffer": 0, "byteOffset": offset, "byteLength": len(blob), "target": target}
+        if stride:
+            view["byteStride"] = stride
+        views.append(view)
+        blob = _pad4(blob)
+        blobs.append(blob)
+        offset += len(blob)
+    binary = b"".join(blobs)
+
+    gltf = {
+        "asset": {"version": "2.0", "generator": "heartai mesh_store"},
+        "extensionsUsed": ["KHR_mesh_quantization"],
+        "extensionsRequired": ["KHR_mesh_quantization"],
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0, "name": name,
+                   "translation": [float(v) for v in lo], "scale": [float(v) for v in scale]}],
+        "meshes": [{"name": name, "primitives": [{
+            "attributes": {"POSITION": 0, "NORMAL": 1}, "indices": 2, "material": 0}]}],
+        "materials": [{"pbrMetallicRoughness": {
+            "baseColorFactor": [*(color or (0.8, 0.8, 0.8)), 1.0],
+            "metallicFactor": 0.0, "roughnessFactor": 0.8}}],
+        "buffers": [{"byteLength": len(binary)}],
+        "bufferViews": views,
+        "accessors": [
+            {"bufferView": 0, "componentType": _UNSIGNED_SHORT, "count": len(verts), "type": "VEC3",
+             "min": [int(v) for v in positions[:, :3].min(axis=0)],
+             "max": [int(v) for v in positions[:, :3].max(axis=0)]},
+            {"bufferView": 1, "componentType": _BYTE, "normalized": True, "count": len(verts), "type": "VEC3"},
+            {"bufferView": 2, "componentType": index_type, "count": int(indices.size), "type": "SCALAR"},
+        ],
+    }
+    json_chunk = _pad4(json.dumps(gltf, separators=(",", ":")).encode(), b" ")
+    length = 12 + 8 + len(json_chunk) + 8 + len(binary)
+    return b"".join([
+        struct.pack("<4sII", b"glTF", 2, length),
+        struct.pack("<I4s", len(json_chunk), b"JSON"), json_chunk,
+        struct.pack("<I4s", len(binary), b"BIN\x00"), binary,
+    ])
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class MeshStore:
+    def __init__(self, path: str = DEFAULT_DIR):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _dir(self, patient_id: str) -> str:
+        if not _PATIENT_ID.match(patient_id):
+            raise ValueError(f"Invalid patient id: {patient_id!r}")
+        return os.path.join(self.path, patient_id)
+
+    def index(self, patient_id: str) -> Optional[Dict[str, Any]]:
+        """The patient's index.json, or None if no meshes were stored."""
+        try:
+            with open(os.path.join(self._dir(patient_id), "index.json")) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def region(self, patient_id: str, label: int, lod: Optional[int] = None) -> Optional[Tuple[str, str]]:
+        """(.glb path, ETag) of one region at level `lod` (None: full resolution), or None."""
+        index = self.index(patient_id)
+        region = next((r for r in (index or {}).get("regions", []) if r["label"] == label), None)
+        if region is None:
+            return None
+        if lod is None:
+            return os.path.join(self._dir(patient_id), f"{label}.glb"), region["etag"]
+        level = next((l for l in region.get("lods", []) if l["level"] == lod), None)
+        if level is None:
+            return None
+        return os.path.join(self._dir(patient_id), f"{label}.lod{lod}.glb"), level["etag"]
+
+    def _write_glb(self, directory: str, name: str, label: int, verts, faces) -> Dict[str, Any]:
+        glb = encode_glb(verts, faces, REGION_COLORS.get(label), name=f"region-{label}")
+        _write_atomic(os.path.join(directory, name), glb)
+        return {"etag": f'"{hashlib.blake2b(glb, digest_size=12).hexdigest()}"',
+                "bytes": len(glb), "vertices": len(verts), "triangles": len(faces)}
+
+    def put(self, patient_id: str, seg, source: Optional[str] = None, sigma: float = DEFAULT_SIGMA,
+            workers: int = DEFAULT_WORKERS, lod_budgets=DEFAULT_BUDGETS) -> Dict[str, Any]:
+        """
+        Mesh every label of `seg` and store the regions, each with decimated
+        levels for the triangle budgets below its own size. `source` is any
+        fingerprint of the segmentation, so callers can skip unchanged ones.
+        """
+        directory = self._dir(patient_id)
+        os.makedirs(directory, exist_ok=True)
+        meshes = mesh_labels(seg, sigma=sigma, workers=workers)
+        regions, written = [], set()
+        for label, (verts, faces) in sorted(meshes.items()):
+            region = {"label": label, **self._write_glb(directory, f"{label}.glb", label, verts, faces), "lods": []}
+            written.add(f"{label}.glb")
+            for level, (lod_verts, lod_faces) in enumerate(build_lods(verts, faces, lod_budgets)):
+                name = f"{label}.lod{level}.glb"
+                region["lods"].append({"level": level,
+                                       **self._write_glb(directory, name, label, lod_verts, lod_faces)})
+                written.add(name)
+            regions.append(region)
+        for name in os.listdir(directory):
+            # Labels (or levels) that no longer exist.
+            if name.endswith(".glb") and name not in written:
+                os.remove(os.path.join(directory, name))
+        index = {"patient": patient_id, "source": source, "sigma": sigma,
+                 "lod_budgets": sorted(set(lod_budgets)), "regions": regions}
+        # Written last, so every region it lists has its file.
+        _write_atomic(os.path.join(directory, "index.json"), json.dumps(index).encode())
+        return index
+
+
+def precompute(volumes, store: MeshStore, pat_ids: Iterable[str], force: bool = False) -> Dict[str, int]:
+    """
+    Mesh the "cropped_seg" volume of each patient in a ZipVolumeSource,
+    skipping patients whose stored meshes came from the same zip member
+    (and LOD budgets).
+    """
+    counts = {"meshed": 0, "unchanged": 0, "missing": 0, "errors": 0}
+    for pat_id in pat_ids:
+        ref = volumes.member("cropped_seg", f"pat{pat_id}_cropped_seg.nii")
+        if ref is None:
+            counts["missing"] += 1
+            continue
+        fingerprint = image_fingerprint(ref)
+        existing = store.index(pat_id)
+        if (not force and existing is not None and existing.get("source") == fingerprint
+                and existing.get("lod_budgets") == sorted(set(DEFAULT_BUDGETS))):
+            counts["unchanged"] += 1
+            continue
+        try:
+            store.put(pat_id, volumes.read("cropped_seg", f"pat{pat_id}_cropped_seg.nii"), source=fingerprint)
+            counts["meshed"] += 1
+        except Exception as e:
+            print(f"Error meshing segmentation for patient {pat_id}: {e}")
+            counts["errors"] += 1
+    return counts
+
+
+_store: Optional[MeshStore] = None
+_store_lock = threading.Lock()
+
+
+def get_mesh_store() -> MeshStore:
+    """Shared per-process store (MESH_DIR)."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = MeshStore()
+    return _store
+
+
+if __name__ == "__main__":
+    import argparse
+    import nibabel as nib
+    parser = argparse.ArgumentParser(description="Mesh one segmentation into the mesh store.")
+    parser.add_argument("patient")
+    parser.add_argument("seg", help=".nii/.nii.gz segmentation")
+    parser.add_argument("--store", default=DEFAULT_DIR)
+    parser.add_argument("--sigma", type=float, default=DEFAULT_SIGMA)
+    args = parser.parse_args()
+
+    index = MeshStore(args.store).put(args.patient, nib.load(args.seg).get_fdata(), sigma=args.sigma)
+    total = sum(r["bytes"] for r in index["regions"])
+    print(f"{len(index['regions'])} regions, {total / 1024:.1f} KiB of .glb in {args.store}/{args.patient}")
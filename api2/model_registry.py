@@ -0,0 +1,182 @@
+# model_registry.py
+#
+# Process-wide registry of image embedders. Building NIfTIToEmbedding
+# allocates the full Conv3d + TransformerEncoder stack, so we do it once per
+# process and hand the same (eval-mode, grad-free) instance to every caller.
+#
+# Weights come from EMBEDDER_CHECKPOINT (a state_dict file, or a directory of
+# them, newest first). Without one the network is initialised from
+# EMBEDDER_SEED, so the API and the ingestion still build the same model. The
+# fingerprint of the weights is the model version stored with every document.
+
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import torch
+
+from embedding_cache import get_cache
+from embeddings import NIfTIToEmbedding
+
+# Spatial size the preprocessing pipeline resizes every volume to.
+WARMUP_SHAPE = (128, 128, 64)
+# "eager", or an exported backend from embedder_export.py (torchscript,
+# torchscript-int8, onnx, onnx-int8), loaded from EMBEDDER_EXPORT_DIR.
+DEFAULT_BACKEND = os.getenv("EMBEDDER_BACKEND", "eager")
+DEFAULT_CHECKPOINT = os.getenv("EMBEDDER_CHECKPOINT") or None
+DEFAULT_SEED = int(os.getenv("EMBEDDER_SEED", "0"))
+
+_lock = threading.Lock()
+_embedders: Dict[str, NIfTIToEmbedding] = {}
+_status: Dict[str, Dict[str, Any]] = {}
+
+
+def _set_status(name: str, state: str, **extra):
+    entry = _status.setdefault(name, {})
+    entry["state"] = state
+    entry.update(extra)
+
+
+def model_fingerprint(model: torch.nn.Module) -> str:
+    """
+    Digest of a model's weights. Used as the model version (embedding-cache
+    salt, and the `model_version` of fed documents): a checkpoint path alone
+    would not identify what produced an embedding.
+    """
+    h = hashlib.blake2b(digest_size=12)
+    for key, tensor in model.state_dict().items():
+        h.update(key.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def resolve_checkpoint(path: Optional[str]) -> Optional[str]:
+    """`path` itself, or the newest .pt file when it is a directory of versioned checkpoints."""
+    if not path or not os.path.isdir(path):
+        return path
+    files = [os.path.join(path, f) for f in os.listdir(path) if f.endswith(".pt")]
+    if not files:
+        raise FileNotFoundError(f"No .pt checkpoints in {path}")
+    return max(files, key=os.path.getmtime)
+
+
+def save_checkpoint(model: torch.nn.Module, directory: str) -> str:
+    """Write `model`'s weights as <directory>/embedder-<version>.pt and return the path."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"embedder-{model_fingerprint(model)}.pt")
+    torch.save(model.state_dict(), path)
+    return path
+
+
+def build_eager(device: Optional[str] = None, checkpoint: Optional[str] = None,
+                seed: int = DEFAULT_SEED) -> NIfTIToEmbedding:
+    """An eval-mode NIfTIToEmbedding with `checkpoint`'s weights, or seeded ones, and its version set."""
+    # Seed a forked RNG so building the model doesn't reset everyone else's.
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(seed)
+        embedder = NIfTIToEmbedding(device=device) if device else NIfTIToEmbedding()
+    checkpoint = resolve_checkpoint(checkpoint)
+    if checkpoint:
+        state_dict = torch.load(checkpoint, map_location=embedder.device)
+        embedder.model.load_state_dict(state_dict)
+    # Shared instances are read-only: no dropout, no autograd bookkeeping.
+    embedder.model.eval()
+    embedder.model.requires_grad_(False)
+    embedder.version = model_fingerprint(embedder.model)
+    return embedder
+
+
+def _build(name: str, device: Optional[str], checkpoint: Optional[str],
+           backend: str) -> NIfTIToEmbedding:
+    _set_status(name, "loading")
+    start = time.perf_counter()
+    if backend == "eager":
+        checkpoint = resolve_checkpoint(checkpoint)
+        embedder = build_eager(device, checkpoint)
+    else:
+        from embedder_export import load_backend
+        # Exported models run on the CPU and carry the fingerprint of the
+        # weights they were exported from. int8 embeddings are close to but
+        # not the same as fp32 ones, so they get their own version.
+        model, manifest = load_backend(backend)
+        embedder = NIfTIToEmbedding(device="cpu", model=model)
+        embedder.version = manifest["version"] + ("+int8" if backend.endswith("int8") else "")
+        checkpoint = manifest.get("checkpoint")
+    embedder.cache = get_cache()
+    _set_status(name, "loaded", load_seconds=time.perf_counter() - start,
+                device=str(embedder.device), checkpoint=checkpoint,
+                backend=backend, version=embedder.version)
+    return embedder
+
+
+def get_embedder(name: str = "default", device: Optional[str] = None,
+                 checkpoint: Optional[str] = None,
+                 backend: Optional[str] = None) -> NIfTIToEmbedding:
+    """
+    Return the shared embedder registered under `name`, building it on first use.
+    `device`, `checkpoint` (default EMBEDDER_CHECKPOINT) and `backend`
+    (default EMBEDDER_BACKEND) only apply to that first build.
+    """
+    embedder = _embedders.get(name)
+    if embedder is not None:
+        return embedder
+    with _lock:
+        embedder = _embedders.get(name)
+        if embedder is None:
+            try:
+                embedder = _build(name, device, checkpoint or DEFAULT_CHECKPOINT,
+                                  backend or DEFAULT_BACKEND)
+            except Exception as e:
+                _set_status(name, "failed", error=str(e))
+                raise
+            _embedders[name] = embedder
+    return embedder
+
+
+@torch.no_grad()
+def warmup(name: str = "default", **kwargs) -> NIfTIToEmbedding:
+    """
+    Build the embedder if needed and run one forward pass on a dummy volume,
+    so the first real request doesn't pay for lazy allocations.
+    """
+    embedder = get_embedder(name, **kwargs)
+    if _status.get(name, {}).get("state") == "ready":
+        return embedder
+    _set_status(name, "warming")
+    start = time.perf_counter()
+    try:
+        dummy = torch.zeros((1, 1) + WARMUP_SHAPE, dtype=torch.float32, device=embedder.device)
+        embedder.model(dummy)
+    except Exception as e:
+        _set_status(name, "failed", error=str(e))
+        raise
+    _set_status(name, "ready", warmup_seconds=time.perf_counter() - start)
+    print(f"Embedder '{name}' ready ({_status[name]['warmup_seconds']:.2f}s warmup)")
+    return embedder
+
+
+def warmup_in_background(name: str = "default", **kwargs) -> threading.Thread:
+    """Run `warmup` on a daemon thread so server startup isn't blocked."""
+    if name not in _status:
+        _set_status(name, "pending")
+
+    def _run():
+        try:
+            warmup(name, **kwargs)
+        except Exception as e:
+            print(f"Warmup of embedder '{name}' failed: {e}")
+
+    thread = threading.Thread(target=_run, name=f"warmup-{name}", daemon=True)
+    thread.start()
+    return thread
+
+
+def is_ready(name: str = "default") -> bool:
+    return _status.get(name, {}).get("state") == "ready"
+
+
+def readiness() -> Dict[str, Dict[str, Any]]:
+    """Snapshot of every registered embedder's state (pending/loading/warming/ready/failed)."""
+    return {name: dict(entry) for name, entry in _status.items()}
@@ -0,0 +1,159 @@
+# nifti_stream.py
+#
+# Helpers for the raw-binary upload path. The request body is streamed into a
+# single buffer (preallocated from Content-Length when we have it), gzip is
+# detected from the magic bytes and inflated incrementally as chunks arrive,
+# and the voxel array is a NumPy view straight over that buffer. Both the body
+# and the decoded volume are capped (UPLOAD_MAX_BODY_BYTES,
+# UPLOAD_MAX_NIFTI_BYTES), so a bogus Content-Length or a gzip bomb is
+# rejected instead of exhausting memory.
+
+import io
+import os
+import sys
+import zlib
+from typing import Optional
+
+import nibabel as nib
+import numpy as np
+
+GZIP_MAGIC = b"\x1f\x8b"
+# Size of a NIfTI-1 header plus the 4-byte extension flag.
+NIFTI1_HEADER_SIZE = 352
+
+DEFAULT_MAX_BODY_BYTES = int(os.getenv("UPLOAD_MAX_BODY_BYTES", str(256 << 20)))
+DEFAULT_MAX_NIFTI_BYTES = int(os.getenv("UPLOAD_MAX_NIFTI_BYTES", str(1 << 30)))
+
+
+# Stands in for "no limit"; still a valid zlib max_length after the +1.
+_UNLIMITED = sys.maxsize - 1
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+
+class NiftiBuffer:
+    """
+    Accumulates a (possibly gzipped) .nii body chunk by chunk.
+
+    Raw bodies are written into one preallocated bytearray; gzipped bodies are
+    decompressed on the fly into a bytearray presized from the compressed
+    length, so we never hold the compressed and decompressed payloads as
+    separate full copies.
+    """
+
+    def __init__(self, expected_size: Optional[int] = None,
+                 max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES,
+                 max_nifti_bytes: Optional[int] = DEFAULT_MAX_NIFTI_BYTES):
+        """
+        `max_body_bytes` caps the bytes fed (compressed, for gzip bodies) and
+        `max_nifti_bytes` the decoded .nii; exceeding either raises
+        PayloadTooLarge. None disables a limit (trusted local files only).
+        """
+        max_body_bytes = max_body_bytes if max_body_bytes is not None else _UNLIMITED
+        max_nifti_bytes = max_nifti_bytes if max_nifti_bytes is not None else _UNLIMITED
+        self.max_body_bytes = max_body_bytes
+        self.max_nifti_bytes = max_nifti_bytes
+        if expected_size is not None and expected_size > max_body_bytes:
+            raise PayloadTooLarge(f"Body of {expected_size} bytes exceeds the {max_body_bytes} byte limit")
+        self.expected_size = expected_size
+        self._buf = bytearray(expected_size or 0)
+        self._len = 0
+        self._received = 0
+        self._inflater = None
+        self._sniffed = False
+        self._pending = b""
+
+    @property
+    def is_gzip(self) -> bool:
+        return self._inflater is not None
+
+    def _write(self, data):
+        end = self._len + len(data)
+        if end > self.max_nifti_bytes:
+            raise PayloadTooLarge(f"NIfTI data exceeds the {self.max_nifti_bytes} byte limit")
+        if end > len(self._buf):
+            # Grow geometrically so unknown-length bodies stay amortized O(n).
+            grow = max(end - len(self._buf), min(len(self._buf), self.max_nifti_bytes - len(self._buf)))
+            self._buf.extend(bytes(grow))
+        memoryview(self._buf)[self._len:end] = data
+        self._len = end
+
+    def _inflate(self, data: bytes):
+        # Never let one chunk inflate past the cap before we can check it.
+        limit = self.max_nifti_bytes - self._len
+        out = self._inflater.decompress(data, limit + 1)
+        if len(out) > limit:
+            raise PayloadTooLarge(f"NIfTI data exceeds the {self.max_nifti_bytes} byte limit")
+        self._write(out)
+
+    def feed(self, chunk: bytes):
+        if not chunk:
+            return
+        self._received += len(chunk)
+        if self._received > self.max_body_bytes:
+            raise PayloadTooLarge(f"Body exceeds the {self.max_body_bytes} byte limit")
+        if not self._sniffed:
+            # Wait until we have enough bytes to check the gzip magic.
+            self._pending += chunk
+            if len(self._pending) < len(GZIP_MAGIC):
+                return
+            chunk, self._pending = self._pending, b""
+            self._sniffed = True
+            if chunk.startswith(GZIP_MAGIC):
+                self._inflater = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+                # Volumes typically compress ~3-4x; start there and let _write grow.
+                self._buf = bytearray(min((self.expected_size or 0) * 4, self.max_nifti_bytes))
+        if self._inflater is not None:
+            self._inflate(chunk)
+        else:
+            self._write(chunk)
+
+    def readfrom(self, fileobj, chunk_size: int = 1 << 20):
+        """Feed everything from a binary file object."""
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            self.feed(chunk)
+
+    def finish(self) -> memoryview:
+        """Flush and return a memoryview over the decoded .nii bytes."""
+        if self._pending:
+            self._sniffed = True
+            self._write(self._pending)
+            self._pending = b""
+        if self._inflater is not None:
+            self._write(self._inflater.flush())
+            if not self._inflater.eof:
+                raise ValueError("Truncated gzip stream")
+        return memoryview(self._buf)[:self._len]
+
+
+def volume_from_buffer(buf: memoryview) -> np.ndarray:
+    """
+    Parse a single-file NIfTI-1 image held in `buf` and return its voxel data.
+
+    The returned array is a view over `buf` (no copy) when the image has no
+    scaling; otherwise scl_slope/scl_inter are applied in float32.
+    """
+    if len(buf) < NIFTI1_HEADER_SIZE:
+        raise ValueError("Body too small to be a NIfTI file")
+    header = nib.Nifti1Header.from_fileobj(io.BytesIO(buf[:NIFTI1_HEADER_SIZE]), check=True)
+    shape = header.get_data_shape()
+    dtype = header.get_data_dtype()
+    offset = int(header.get_data_offset())
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    if offset + nbytes > len(buf):
+        raise ValueError("NIfTI body is shorter than its header declares")
+    data = np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset, order="F")
+
+    slope, inter = header.get_slope_inter()
+    if slope is None or (slope == 1.0 and not inter):
+        return data
+    scaled = data.astype(np.float32)
+    scaled *= np.float32(slope)
+    if inter:
+        scaled += np.float32(inter)
+    return scaled
@@ -0,0 +1,321 @@
+# segmentation.py
+#
+# CPU inference for the UNet3D heart segmentation model trained in
+# ml/embeder.ipynb. The volume is prepared like the training data (padded to
+# a cube and resized to 128^3, computed per axis without building the cube),
+# then segmented in overlapping tiles whose logits are blended with a
+# Gaussian weight, so peak memory depends on the tile size rather than the
+# volume. Tiles are batched, run channels-last-3d and, on
+# CPUs that support it, under bfloat16 autocast.
+#
+# The result is a uint8 mask in the input's voxel grid with labels 1-8 (0 for
+# background), i.e. what heart_mesh.mesh_labels expects.
+
+import os
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+DEFAULT_CHECKPOINT = os.getenv("SEGMENTATION_CHECKPOINT")
+DEFAULT_TILE = int(os.getenv("SEGMENTATION_TILE", "64"))
+DEFAULT_OVERLAP = float(os.getenv("SEGMENTATION_OVERLAP", "0.5"))
+DEFAULT_BATCH_SIZE = int(os.getenv("SEGMENTATION_BATCH_SIZE", "4"))
+DEFAULT_BF16 = os.getenv("SEGMENTATION_BF16", "1") == "1"
+# Training resized every volume to this cube.
+MODEL_GRID = (128, 128, 128)
+NUM_LABELS = 8
+
+
+# ----- model (same module names as the notebook, so its checkpoints load) -----
+
+class DoubleConv3D(nn.Module):
+    def __init__(self, in_channels, out_channels):
+        super().__init__()
+        self.conv = nn.Sequential(
+            nn.Conv3d(in_channels, out_channels, kernel_size=3, padding=1, bias=False),
+            nn.BatchNorm3d(out_channels),
+            nn.ReLU(inplace=True),
+            nn.Conv3d(out_channels, out_channels, kernel_size=3, padding=1, bias=False),
+            nn.BatchNorm3d(out_channels),
+            nn.ReLU(inplace=True)
+        )
+
+    def forward(self, x):
+        return self.conv(x)
+
+
+class UNet3D(nn.Module):
+    def __init__(self, in_channels, num_classes, dropout=0.3):
+        super().__init__()
+        self.encoder = nn.ModuleList([
+            DoubleConv3D(in_channels, 64),
+            DoubleConv3D(64, 128),
+            DoubleConv3D(128, 256),
+            DoubleConv3D(256, 512)
+        ])
+        self.pool = nn.MaxPool3d(kernel_size=2, stride=2)
+        self.bottleneck = nn.Sequential(
+            DoubleConv3D(512, 1024),
+            nn.Dropout3d(p=dropout)
+        )
+        self.upconvs = nn.ModuleList([
+            nn.ConvTranspose3d(1024, 512, kernel_size=2, stride=2),
+            nn.ConvTranspose3d(512, 256, kernel_size=2, stride=2),
+            nn.ConvTranspose3d(256, 128, kernel_size=2, stride=2),
+            nn.ConvTranspose3d(128, 64, kernel_size=2, stride=2)
+        ])
+        self.decoder = nn.ModuleList([
+            DoubleConv3D(1024, 512),
+            DoubleConv3D(512, 256),
+            DoubleConv3D(256, 128),
+            DoubleConv3D(128, 64)
+        ])
+        self.final_conv = nn.Conv3d(64, num_classes, kernel_size=1)
+
+    def forward(self, x):
+        skip_connections = []
+        for down in self.encoder:
+            x = down(x)
+            skip_connections.append(x)
+            x = self.pool(x)
+
+        x = self.bottleneck(x)
+
+        skip_connections = skip_connections[::-1]
+        for idx in range(len(self.upconvs)):
+            x = self.upconvs[idx](x)
+            skip_connection = skip_connections[idx]
+            # Odd sizes lose a voxel when pooling; pad back before concatenating.
+            if x.shape != skip_connection.shape:
+                diff_d = skip_connection.shape[2] - x.shape[2]
+                diff_h = skip_connection.shape[3] - x.shape[3]
+                diff_w = skip_connection.shape[4] - x.shape[4]
+                x = F.pad(x, [diff_w // 2, diff_w - diff_w // 2,
+                              diff_h // 2, diff_h - diff_h // 2,
+                              diff_d // 2, diff_d - diff_d // 2])
+            x = torch.cat((skip_connection, x), dim=1)
+            x = self.decoder[idx](x)
+
+        return self.final_conv(x)
+
+
+def load_unet(checkpoint: str, device: str = "cpu") -> UNet3D:
+    """
+    Build a UNet3D from a checkpoint: a bare state_dict, or a dict holding one
+    under "state_dict"/"model_state_dict", optionally saved from DataParallel.
+    The class count is taken from the checkpoint.
+    """
+    state = torch.load(checkpoint, map_location=device)
+    for key in ("state_dict", "model_state_dict"):
+        if isinstance(state, dict) and key in state:
+            state = state[key]
+    state = {k[len("module."):] if k.startswith("module.") else k: v for k, v in state.items()}
+    model = UNet3D(in_channels=1, num_classes=state["final_conv.weight"].shape[0])
+    model.load_state_dict(state)
+    model.eval()
+    model.requires_grad_(False)
+    return model.to(device).to(memory_format=torch.channels_last_3d)
+
+
+# ----- resampling -----
+#
+# Training centre-padded each volume to a cube and resized it to MODEL_GRID.
+# Materializing that cube (and upsampling the labels back to it) costs memory
+# cubic in the volume's longest side, so both directions are done with
+# per-axis index arithmetic on the unpadded (D, H, W) grid instead.
+
+def _linear_taps(out_size: int, side: int, pad: int, size: int) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    The two (index, weight) taps along one axis of F.interpolate(mode="trilinear",
+    align_corners=False) from a zero-padded cube of `side` voxels, holding the
+    input's `size` voxels from `pad` on, to `out_size`. Indices are into the
+    input; taps that land in the padding get weight 0.
+    """
+    src = np.maximum((np.arange(out_size) + 0.5) * (side / out_size) - 0.5, 0.0)
+    i0 = np.floor(src).astype(np.int64)
+    i1 = np.minimum(i0 + 1, side - 1)
+    w1 = src - i0
+    taps = []
+    for i, w in ((i0, 1.0 - w1), (i1, w1)):
+        j = i - pad
+        inside = (j >= 0) & (j < size)
+        taps.append((torch.from_numpy(np.clip(j, 0, size - 1)),
+                     torch.from_numpy(np.where(inside, w, 0.0).astype(np.float32))))
+    return taps
+
+
+def resize_padded(volume: torch.Tensor, pads: List[int], side: int,
+                  size: Tuple[int, int, int] = MODEL_GRID) -> torch.Tensor:
+    """Trilinear resize of `volume` centre-padded to a `side` cube (pads[i] voxels before axis i), one axis at a time."""
+    x = volume
+    for axis in range(3):
+        (j0, w0), (j1, w1) = _linear_taps(size[axis], side, pads[axis], volume.shape[axis])
+        shape = [1, 1, 1]
+        shape[axis] = -1
+        x = x.index_select(axis, j0) * w0.view(shape) + x.index_select(axis, j1) * w1.view(shape)
+    return x
+
+
+def _nearest_index(size: int, side: int, pad: int, grid: int) -> torch.Tensor:
+    """Source indices of F.interpolate(mode="nearest") from `grid` to `side`, at cube positions pad..pad+size."""
+    # float32 like PyTorch's kernel, so boundaries round the same way.
+    dst = np.arange(pad, pad + size, dtype=np.float32)
+    src = np.floor(dst * (np.float32(grid) / np.float32(side))).astype(np.int64)
+    return torch.from_numpy(np.minimum(src, grid - 1))
+
+
+def unpad_labels(labels: torch.Tensor, pads: List[int], side: int, shape: Tuple[int, ...]) -> torch.Tensor:
+    """Labels on MODEL_GRID mapped back to the unpadded `shape`, nearest neighbour."""
+    for axis in range(3):
+        labels = labels.index_select(axis, _nearest_index(shape[axis], side, pads[axis], labels.shape[axis]))
+    return labels
+
+
+# ----- tiling -----
+
+def _starts(size: int, tile: int, step: int) -> List[int]:
+    """Tile origins along one axis; the last tile is flush with the end."""
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile, step))
+    return starts + [size - tile]
+
+
+def tile_origins(shape: Tuple[int, ...], tile: int, overlap: float) -> Iterator[Tuple[int, int, int]]:
+    step = max(1, int(tile * (1.0 - overlap)))
+    for d in _starts(shape[0], tile, step):
+        for h in _starts(shape[1], tile, step):
+            for w in _starts(shape[2], tile, step):
+                yield d, h, w
+
+
+def gaussian_weight(tile: int, sigma_scale: float = 0.125) -> torch.Tensor:
+    """Blending weight peaking at the tile centre, so tile borders count least."""
+    coords = torch.arange(tile, dtype=torch.float32) - (tile - 1) / 2.0
+    g = torch.exp(-(coords ** 2) / (2 * (sigma_scale * tile) ** 2))
+    weight = g[:, None, None] * g[None, :, None] * g[None, None, :]
+    return (weight / weight.max()).clamp_min(1e-3)
+
+
+def bf16_supported() -> bool:
+    """Whether CPU bfloat16 autocast will be fast (AVX512-BF16/AMX), not emulated."""
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class Segmenter:
+    def __init__(self, model: UNet3D, device: str = "cpu", tile: int = DEFAULT_TILE,
+                 overlap: float = DEFAULT_OVERLAP, batch_size: int = DEFAULT_BATCH_SIZE,
+                 bf16: bool = DEFAULT_BF16, threshold: float = 0.5):
+        """
+        `tile` must be a multiple of 16 (four 2x poolings). Checkpoints with 9
+        classes treat channel 0 as background; the notebook's 8-class models
+        have none, so voxels whose best class probability is below `threshold`
+        are background.
+        """
+        if tile % 16:
+            raise ValueError("tile must be a multiple of 16")
+        self.model = model
+        self.device = device
+        self.tile = tile
+        self.overlap = overlap
+        self.batch_size = max(1, batch_size)
+        self.bf16 = bf16 and device == "cpu" and bf16_supported()
+        self.threshold = threshold
+        self.num_classes = model.final_conv.out_channels
+        self._weight = gaussian_weight(tile)
+
+    @torch.inference_mode()
+    def logits(self, volume: torch.Tensor) -> torch.Tensor:
+        """Blended (C, D, H, W) float32 logits for a (D, H, W) volume, tile by tile."""
+        shape = tuple(volume.shape)
+        # Volumes smaller than a tile are zero-padded up to one.
+        padded = [max(s, self.tile) for s in shape]
+        x = F.pad(volume, [0, padded[2] - shape[2], 0, padded[1] - shape[1], 0, padded[0] - shape[0]])
+        out = torch.zeros((self.num_classes, *padded), dtype=torch.float32)
+        norm = torch.zeros(padded, dtype=torch.float32)
+        t = self.tile
+        origins = list(tile_origins(padded, t, self.overlap))
+        for i in range(0, len(origins), self.batch_size):
+            batch_origins = origins[i:i + self.batch_size]
+            batch = torch.stack([x[d:d + t, h:h + t, w:w + t] for d, h, w in batch_origins])[:, None]
+            batch = batch.to(self.device).contiguous(memory_format=torch.channels_last_3d)
+            with torch.autocast("cpu", dtype=torch.bfloat16, enabled=self.bf16):
+                pred = self.model(batch)
+            pred = pred.float().cpu()
+            for (d, h, w), p in zip(batch_origins, pred):
+                out[:, d:d + t, h:h + t, w:w + t] += p * self._weight
+                norm[d:d + t, h:h + t, w:w + t] += self._weight
+        out /= norm
+        return out[:, :shape[0], :shape[1], :shape[2]]
+
+    def labels_from_logits(self, logits: torch.Tensor) -> torch.Tensor:
+        probs = torch.softmax(logits, dim=0)
+        best, index = probs.max(dim=0)
+        if self.num_classes == NUM_LABELS + 1:
+            return index.to(torch.uint8)
+        labels = (index + 1).to(torch.uint8)
+        labels[best < self.threshold] = 0
+        return labels
+
+    def segment(self, volume: np.ndarray) -> np.ndarray:
+        """uint8 label mask (0-8) with the same shape as the (D, H, W) input volume."""
+        volume = torch.as_tensor(np.asarray(volume, dtype=np.float32))
+        shape = tuple(volume.shape)
+        # Same geometry as training (centre-pad to a cube, resize to
+        # MODEL_GRID), without building the cube.
+        side = max(shape)
+        pads = [(side - s) // 2 for s in shape]
+        grid = resize_padded(volume, pads, side)
+
+        labels = self.labels_from_logits(self.logits(grid))
+
+        # Nearest (labels aren't interpolable) straight onto the input's voxels.
+        return unpad_labels(labels, pads, side, shape).numpy()
+
+
+_segmenter: Optional[Segmenter] = None
+_segmenter_lock = threading.Lock()
+
+
+def get_segmenter() -> Segmenter:
+    """Shared per-process segmenter, loaded from SEGMENTATION_CHECKPOINT on first use."""
+    global _segmenter
+    if _segmenter is None:
+        with _segmenter_lock:
+            if _segmenter is None:
+                if not DEFAULT_CHECKPOINT:
+                    raise RuntimeError("SEGMENTATION_CHECKPOINT is not set")
+                _segmenter = Segmenter(load_unet(DEFAULT_CHECKPOINT))
+    return _segmenter
+
+
+if __name__ == "__main__":
+    import argparse
+    import nibabel as nib
+    parser = argparse.ArgumentParser(description="Segment a cropped MRI volume on the CPU.")
+    parser.add_argument("checkpoint")
+    parser.add_argument("volume", help=".nii/.nii.gz, e.g. pat0_cropped.nii.gz")
+    parser.add_argument("out", help="output .nii.gz label mask")
+    parser.add_argument("--tile", type=int, default=DEFAULT_TILE)
+    parser.add_argument("--overlap", type=float, default=DEFAULT_OVERLAP)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--no-bf16", action="store_true")
+    args = parser.parse_args()
+
+    img = nib.load(args.volume)
+    segmenter = Segmenter(load_unet(args.checkpoint), tile=args.tile, overlap=args.overlap,
+                          batch_size=args.batch_size, bf16=not args.no_bf16)
+    started = time.perf_counter()
+    mask = segmenter.segment(img.get_fdata(dtype=np.float32))
+    elapsed = time.perf_counter() - started
+    nib.save(nib.Nifti1Image(mask, img.affine), args.out)
+    counts: Dict[int, int] = {int(k): int(v) for k, v in zip(*np.unique(mask, return_counts=True)) if k}
+    print(f"Segmented {img.shape} in {elapsed:.2f}s (bf16={segmenter.bf16}); voxels per label: {counts}")
@@ -1,45 +1,69 @@
 # app/smart_diagnosis.py
 
+import asyncio
+import hashlib
+import json
 import os
 import requests
+import httpx
 from dotenv import load_dotenv
+from typing import Any, AsyncIterator, List, Optional, Tuple
 
-def sMaRTDiagnosis(vespa_output: str):
-    """
-    Takes in a string containing relevant doc data from Vespa.
-    Calls Perplexity "sonar-pro" API with that data to generate a diagnosis.
-    Returns:
-      1) response_text: A string containing diagnosis & explanation 
-         with bracket references [1], [2], ...
-      2) response_links_unprocessed: A list of citations for the bracket references
-    """
-    # If you have not done so, load your .env containing PERPLEXITY_API_KEY
-    load_dotenv()
-    url = "https://api.perplexity.ai/chat/completions"
-    auth_token = os.getenv("PERPLEXITY_API_KEY")
-    keys_str = "Pat,Age,Category,Normal,MildModerateDilation,VSD,ASD,DORV,DLoopTGA,ArterialSwitch,BilateralSVC,SevereDilation,TortuousVessels,Dextrocardia,Mesocardia,InvertedVentricles,InvertedAtria,LeftCentralIVC,LeftCentralSVC,LLoopTGA,AtrialSwitch,Rastelli,SingleVentricle,DILV,DIDORV,CommonAtrium,Glenn,Fontan,Heterotaxy,SuperoinferiorVentricles,PAAtresiaOrMPAStump,PABanding,AOPAAnastamosis,Marfan,CMRArtifactAO,CMRArtifactPA"
-    keys = keys_str.split(",")
+from diagnosis_cache import get_diagnosis_cache
+
+# If you have not done so, load your .env containing PERPLEXITY_API_KEY
+load_dotenv()
+# Override PERPLEXITY_URL to point at a local stub server in tests.
+PERPLEXITY_URL = os.getenv("PERPLEXITY_URL", "https://api.perplexity.ai/chat/completions")
+MODEL = "sonar-pro"
+TIMEOUT = httpx.Timeout(float(os.getenv("DIAGNOSIS_TIMEOUT", "60")),
+                        connect=float(os.getenv("DIAGNOSIS_CONNECT_TIMEOUT", "5")))
+
+keys_str = "Pat,Age,Category,Normal,MildModerateDilation,VSD,ASD,DORV,DLoopTGA,ArterialSwitch,BilateralSVC,SevereDilation,TortuousVessels,Dextrocardia,Mesocardia,InvertedVentricles,InvertedAtria,LeftCentralIVC,LeftCentralSVC,LLoopTGA,AtrialSwitch,Rastelli,SingleVentricle,DILV,DIDORV,CommonAtrium,Glenn,Fontan,Heterotaxy,SuperoinferiorVentricles,PAAtresiaOrMPAStump,PABanding,AOPAAnastamosis,Marfan,CMRArtifactAO,CMRArtifactPA"
+KEYS = keys_str.split(",")
+
+SYSTEM_PROMPT = (
+    "You are a doctor's assistant specializing in cardiovascular diseases. "
+    "Your job is to explain the diagnosis, summarize, give a short explanation given the following diseases the patient might have "
+    "and suggest possible next steps, referencing the input data. "
+    "You are going to be presented with some diseases we found the patient has more likelihood of having, which is marked with YES or NO in the input data. "
+    "Be concise and clarify medical jargon in simple terms."
+    "Don't use markup (only the brackets for links), and don't mention the YES format I gave you, just use it to suggest your recommendation, but never mention it."
+)
+
+# Cached diagnoses are only valid for the prompt and model that produced them.
+PROMPT_VERSION = hashlib.blake2b(f"{MODEL}\n{SYSTEM_PROMPT}".encode(), digest_size=8).hexdigest()
+
+
+def flag_bits(vespa_output: str) -> int:
+    """Bitmask of the KEYS flagged "X" in the first CSV row of `vespa_output` (bit i = KEYS[i])."""
     vals = vespa_output.split(",")
-    csv_line = ""
-    first_diagnosis = ""
-    for i in range(len(keys)):
-        if vals[i] == "X" and first_diagnosis == "":
-            first_diagnosis = keys[i]
-        csv_line += str(keys[i]) + ": " + ("YES" if vals[i] == "X" else "NO") + ","
-    print(csv_line)
-    payload = {
-        "model": "sonar-pro",
+    bits = 0
+    for i in range(min(len(KEYS), len(vals))):
+        if vals[i] == "X":
+            bits |= 1 << i
+    return bits
+
+
+def first_flag(bits: int) -> str:
+    return next((KEYS[i] for i in range(len(KEYS)) if bits >> i & 1), "")
+
+
+def build_csv_line(bits: int) -> str:
+    return "".join(f"{key}: {'YES' if bits >> i & 1 else 'NO'}," for i, key in enumerate(KEYS))
+
+
+def diagnosis_key(bits: int) -> str:
+    return f"{PROMPT_VERSION}:{bits:0{len(KEYS)}b}"
+
+
+def build_payload(csv_line: str, stream: bool = False) -> dict:
+    return {
+        "model": MODEL,
         "messages": [
             {
                 "role": "system",
-                "content": (
-                    "You are a doctor's assistant specializing in cardiovascular diseases. "
-                    "Your job is to explain the diagnosis, summarize, give a short explanation given the following diseases the patient might have "
-                    "and suggest possible next steps, referencing the input data. "
-                    "You are going to be presented with some diseases we found the patient has more likelihood of having, which is marked with YES or NO in the input data. "
-                    "Be concise and clarify medical jargon in simple terms."
-                    "Don't use markup (only the brackets for links), and don't mention the YES format I gave you, just use it to suggest your recommendation, but never mention it."
-                )
+                "content": SYSTEM_PROMPT
             },
             {
                 "role": "user",
@@ -54,26 +78,162 @@ def sMaRTDiagnosis(vespa_output: str):
         "return_related_questions": False,
         "search_recency_filter": None,
         "top_k": 0,
-        "stream": False,
+        "stream": stream,
         "presence_penalty": 0,
         "frequency_penalty": 1,
         "response_format": None
     }
-    headers = {
-        "Authorization": f"Bearer {auth_token}",
+
+
+def _headers() -> dict:
+    return {
+        "Authorization": f"Bearer {os.getenv('PERPLEXITY_API_KEY')}",
         "Content-Type": "application/json"
     }
 
-    response = requests.post(url, json=payload, headers=headers)
+
+class DiagnosisError(Exception):
+    pass
+
+
+# Pooled client, rebuilt if used from a different event loop.
+_client: Optional[httpx.AsyncClient] = None
+_client_loop = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        _client = httpx.AsyncClient(timeout=TIMEOUT,
+                                    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32))
+        _client_loop = loop
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _fetch_diagnosis(csv_line: str) -> Tuple[str, List[str]]:
+    try:
+        response = await _get_client().post(PERPLEXITY_URL, json=build_payload(csv_line), headers=_headers())
+    except httpx.HTTPError as e:
+        raise DiagnosisError(f"Could not fetch a diagnosis ({type(e).__name__}).") from e
+    if response.status_code != 200:
+        raise DiagnosisError(f"Could not fetch a diagnosis (HTTP {response.status_code}).")
+    response_json = response.json()
+    return response_json["choices"][0]["message"]["content"], response_json.get("citations", [])
+
+
+async def diagnose(vespa_output: str):
+    """
+    Async, cached sMaRTDiagnosis. Identical flag vectors are answered from
+    the diagnosis cache; concurrent identical requests share one LLM call.
+    Returns (response_text, response_links, first_diagnosis).
+    """
+    bits = flag_bits(vespa_output)
+    csv_line = build_csv_line(bits)
+    try:
+        text, links = await get_diagnosis_cache().get_or_compute(
+            diagnosis_key(bits), lambda: _fetch_diagnosis(csv_line))
+    except DiagnosisError as e:
+        # If the Perplexity call fails, just return a fallback (not cached)
+        return str(e), [], first_flag(bits)
+    return text, links, first_flag(bits)
+
+
+def sMaRTDiagnosis(vespa_output: str):
+    """
+    Takes in a string containing relevant doc data from Vespa.
+    Calls Perplexity "sonar-pro" API with that data to generate a diagnosis.
+    Returns:
+      1) response_text: A string containing diagnosis & explanation
+         with bracket references [1], [2], ...
+      2) response_links_unprocessed: A list of citations for the bracket references
+      3) first_diagnosis: the first flagged condition
+    Blocking variant of `diagnose`; shares its cache.
+    """
+    bits = flag_bits(vespa_output)
+    first_diagnosis = first_flag(bits)
+    key = diagnosis_key(bits)
+    cache = get_diagnosis_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached[0], cached[1], first_diagnosis
+
+    try:
+        response = requests.post(PERPLEXITY_URL, json=build_payload(build_csv_line(bits)),
+                                 headers=_headers(), timeout=(TIMEOUT.connect, TIMEOUT.read))
+    except requests.RequestException as e:
+        return f"Could not fetch a diagnosis ({type(e).__name__}).", [], first_diagnosis
     if response.status_code != 200:
         # If the Perplexity call fails, just return a fallback
         return (
             f"Could not fetch a diagnosis (HTTP {response.status_code}).",
-            []
+            [],
+            first_diagnosis
         )
 
     response_json = response.json()
     response_text = response_json["choices"][0]["message"]["content"]
     response_links_unprocessed = response_json.get("citations", [])
-    print(response_links_unprocessed)
+    cache.put(key, (response_text, response_links_unprocessed))
     return response_text, response_links_unprocessed, first_diagnosis
+
+
+async def stream_diagnosis(vespa_output: str) -> AsyncIterator[Tuple[str, Any]]:
+    """
+    Streaming variant of `diagnose`. Yields ("token", text) pieces as the LLM
+    produces them, then ("citations", links) once. A cached diagnosis comes
+    back as a single token; a stream that reaches [DONE] is added to the cache.
+    On failure yields ("error", message) instead.
+    """
+    bits = flag_bits(vespa_output)
+    key = diagnosis_key(bits)
+    cache = get_diagnosis_cache()
+    cached = await cache.aget(key)
+    if cached is not None:
+        yield "token", cached[0]
+        yield "citations", cached[1]
+        return
+
+    parts: List[str] = []
+    links: List[str] = []
+    done = False
+    try:
+        async with _get_client().stream("POST", PERPLEXITY_URL, headers=_headers(),
+                                        json=build_payload(build_csv_line(bits), stream=True)) as response:
+            if response.status_code != 200:
+                yield "error", f"Could not fetch a diagnosis (HTTP {response.status_code})."
+                return
+            # Server-sent events: one "data: {chunk}" line per completion delta.
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    done = True
+                    break
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    yield "error", "Could not fetch a diagnosis (malformed stream)."
+                    return
+                links = chunk.get("citations", links)
+                choices = chunk.get("choices") or [{}]
+                token = (choices[0].get("delta") or {}).get("content")
+                if token:
+                    parts.append(token)
+                    yield "token", token
+    except httpx.HTTPError as e:
+        yield "error", f"Could not fetch a diagnosis ({type(e).__name__})."
+        return
+    # Only a stream that reached [DONE] is complete; one cut short by a dropped
+    # connection still gets its citations but isn't cached.
+    if done and parts:
+        await cache.aput(key, ("".join(parts), links))
+    yield "citations", links
@@ -0,0 +1,106 @@
+# tests/test_vespa_feeder.py
+#
+# BulkFeeder through pyvespa's real async client, against a local HTTP server
+# standing in for Vespa's /document/v1 API.
+
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from vespa.application import Vespa
+
+from vespa_feeder import BulkFeeder
+
+# http.server only speaks HTTP/1.1; pyvespa's async client defaults to HTTP/2.
+CLIENT_KWARGS = {"http2_only": False}
+
+
+class _DocumentApi(BaseHTTPRequestHandler):
+    """Answers each document's first write with 429, later ones with 200."""
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        path = self.path.split("?", 1)[0]
+        if not path.startswith("/document/v1/"):
+            return self._reply(404, {"message": "not found"})
+        doc_id = path.rsplit("/", 1)[-1]
+        with self.server.lock:
+            self.server.writes[doc_id] += 1
+            first = self.server.writes[doc_id] == 1
+        if first:
+            return self._reply(429, {"message": "Rejecting execution due to overload"})
+        return self._reply(200, {"pathId": path, "id": f"id:stub:stub::{doc_id}"})
+
+    do_PUT = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def document_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _DocumentApi)
+    server.lock = threading.Lock()
+    server.writes = Counter()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_retries_throttled_documents(document_api):
+    num_docs = 40
+    results = []
+    app = Vespa(url="http://127.0.0.1", port=document_api.server_address[1])
+    feeder = BulkFeeder(app, "stub", concurrency=8, backoff_base=0.001, on_result=results.append,
+                        client_kwargs=CLIENT_KWARGS)
+
+    summary = feeder.feed((f"doc{i}", {"i": i}) for i in range(num_docs))
+
+    assert summary["succeeded"] == num_docs
+    assert summary["failed"] == 0
+    assert summary["retries"] == num_docs
+    assert summary["status_codes"] == {"429": num_docs, "200": num_docs}
+    assert summary["in_flight"] == 0
+    assert summary["max_in_flight"] <= 8
+    assert sorted(r.doc_id for r in results) == sorted(f"doc{i}" for i in range(num_docs))
+    assert all(r.ok and r.attempts == 2 for r in results)
+    assert document_api.writes == Counter({f"doc{i}": 2 for i in range(num_docs)})
+
+
+def test_gives_up_after_max_retries(document_api):
+    # With no retries allowed, the first 429 is final.
+    results = []
+    app = Vespa(url="http://127.0.0.1", port=document_api.server_address[1])
+    feeder = BulkFeeder(app, "stub", max_retries=0, backoff_base=0.001, on_result=results.append,
+                        client_kwargs=CLIENT_KWARGS)
+
+    summary = feeder.feed([("doc0", {"i": 0})])
+
+    assert summary["succeeded"] == 0 and summary["failed"] == 1
+    assert summary["retries"] == 0
+    assert results[0].status_code == 429 and results[0].attempts == 1
+
+
+def test_context_comes_back_with_each_write(document_api):
+    # Two writes of one doc_id stay distinguishable through their context.
+    results = []
+    app = Vespa(url="http://127.0.0.1", port=document_api.server_address[1])
+    feeder = BulkFeeder(app, "stub", backoff_base=0.001, on_result=results.append,
+                        client_kwargs=CLIENT_KWARGS)
+
+    feeder.feed([("doc0", {"i": 0}, "first"), ("doc0", {"i": 1}, "second")])
+
+    assert sorted(r.context for r in results) == ["first", "second"]
+    assert all(r.ok and r.doc_id == "doc0" for r in results)
@@ -0,0 +1,283 @@
+# vector_index.py
+#
+# In-process mirror of the clinical_data image embeddings. The knowledge base
+# is a few thousand 512-d vectors, so scoring them all with one matrix-vector
+# product is far cheaper than an HTTP round trip to Vespa. Vespa stays the
+# source of truth: the index is bootstrapped from it, kept current by the
+# ingestion pipeline, and /upload falls back to Vespa whenever it isn't ready.
+#
+# Modes (VECTOR_INDEX_MODE): "off", "exact" (brute force over one contiguous
+# float32 matrix) or "hnsw" (hnswlib graph, for corpora where brute force
+# stops being cheap).
+
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:  # optional, only needed for mode="hnsw"
+    hnswlib = None
+
+DEFAULT_MODE = os.getenv("VECTOR_INDEX_MODE", "off")
+DEFAULT_METRIC = os.getenv("VECTOR_INDEX_METRIC", "angular")
+DIM = 512
+
+
+def _tensor_values(value) -> Optional[List[float]]:
+    """Dense tensor field from the document API, in either short ("values") or cells form."""
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return value
+    if "values" in value:
+        return value["values"]
+    if "cells" in value:
+        cells = sorted(value["cells"], key=lambda c: int(c["address"]["d"]))
+        return [c["value"] for c in cells]
+    return None
+
+
+class VectorIndex:
+    def __init__(self, dim: int = DIM, metric: str = DEFAULT_METRIC, mode: str = "exact",
+                 initial_capacity: int = 1024, hnsw_m: int = 16, hnsw_ef: int = 64):
+        if metric not in ("angular", "dot"):
+            raise ValueError(f"Unsupported metric: {metric}")
+        if mode not in ("exact", "hnsw"):
+            raise ValueError(f"Unsupported index mode: {mode}")
+        if mode == "hnsw" and hnswlib is None:
+            raise ImportError("VECTOR_INDEX_MODE=hnsw requires the hnswlib package")
+        self.dim = dim
+        self.metric = metric
+        self.mode = mode
+        self._lock = threading.RLock()
+        self._vectors = np.zeros((initial_capacity, dim), dtype=np.float32)
+        self._ids: List[str] = []
+        self._fields: List[Dict[str, Any]] = []
+        self._rows: Dict[str, int] = {}
+        # hnsw labels are never reused for another document (replace_deleted
+        # would otherwise let an upsert of a live label take a deleted slot
+        # and leave the label's old element in the graph), so rows and graph
+        # labels are mapped both ways.
+        self._labels: List[int] = []
+        self._label_rows: Dict[int, int] = {}
+        self._next_label = 0
+        self._graph = None
+        if mode == "hnsw":
+            self._graph = hnswlib.Index(space="cosine" if metric == "angular" else "ip", dim=dim)
+            self._graph.init_index(max_elements=initial_capacity, M=hnsw_m, ef_construction=200,
+                                   allow_replace_deleted=True)
+            self._graph.set_ef(hnsw_ef)
+        self.ready = False
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _prepare(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if self.metric == "angular":
+            # Store unit vectors so a dot product is the cosine.
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+        return vectors
+
+    def _grow(self, needed: int):
+        capacity = len(self._vectors)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        grown = np.zeros((capacity, self.dim), dtype=np.float32)
+        grown[:len(self._ids)] = self._vectors[:len(self._ids)]
+        self._vectors = grown
+        if self._graph is not None:
+            self._graph.resize_index(capacity)
+
+    def upsert(self, doc_id: str, vector, fields: Optional[Dict[str, Any]] = None):
+        """Insert or replace one document's vector (and the summary fields returned with hits)."""
+        row_vector = self._prepare(vector)[0]
+        with self._lock:
+            row = self._rows.get(doc_id)
+            if row is None:
+                row = len(self._ids)
+                self._grow(row + 1)
+                self._ids.append(doc_id)
+                self._fields.append({})
+                self._rows[doc_id] = row
+                if self._graph is not None:
+                    # A fresh label may take a deleted element's slot.
+                    label = self._next_label
+                    self._next_label += 1
+                    self._labels.append(label)
+                    self._label_rows[label] = row
+                    self._graph.add_items(row_vector[np.newaxis, :], np.array([label]), replace_deleted=True)
+            elif self._graph is not None:
+                # Updates the live element for the label in place.
+                self._graph.add_items(row_vector[np.newaxis, :], np.array([self._labels[row]]))
+            self._vectors[row] = row_vector
+            self._fields[row] = dict(fields or {})
+
+    def remove(self, doc_id: str):
+        """Drop a document by moving the last row into its slot."""
+        with self._lock:
+            row = self._rows.pop(doc_id, None)
+            if row is None:
+                return
+            last = len(self._ids) - 1
+            if self._graph is not None:
+                label = self._labels[row]
+                self._graph.mark_deleted(label)
+                del self._label_rows[label]
+            if row != last:
+                self._vectors[row] = self._vectors[last]
+                self._ids[row] = self._ids[last]
+                self._fields[row] = self._fields[last]
+                self._rows[self._ids[row]] = row
+                if self._graph is not None:
+                    self._labels[row] = self._labels[last]
+                    self._label_rows[self._labels[row]] = row
+            if self._graph is not None:
+                self._labels.pop()
+            self._ids.pop()
+            self._fields.pop()
+
+    def _relevance(self, scores: np.ndarray) -> np.ndarray:
+        if self.metric == "angular":
+            # Same as Vespa's closeness(image_embedding) with distance-metric: angular.
+            return 1.0 / (1.0 + np.arccos(np.clip(scores, -1.0, 1.0)))
+        return scores
+
+    def _exact(self, query: np.ndarray, k: int):
+        n = len(self._ids)
+        scores = self._vectors[:n] @ query
+        if k < n:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(n)
+        top = top[np.argsort(-scores[top])]
+        return top, scores[top]
+
+    def _hnsw(self, query: np.ndarray, k: int):
+        labels, distances = self._graph.knn_query(query[np.newaxis, :], k=k)
+        rows = np.array([self._label_rows[int(label)] for label in labels[0]], dtype=np.int64)
+        # hnswlib reports 1 - cos for "cosine" and 1 - dot for "ip".
+        return rows, 1.0 - distances[0]
+
+    def search(self, vector, k: int = 3, exact: Optional[bool] = None) -> List[Dict[str, Any]]:
+        """
+        Top-k documents for `vector`, as Vespa-style hits
+        ({"id", "relevance", "fields"}) sorted by descending relevance.
+        """
+        query = self._prepare(vector)[0]
+        with self._lock:
+            k = min(k, len(self._ids))
+            if k == 0:
+                return []
+            use_exact = self._graph is None if exact is None else exact
+            rows, scores = self._exact(query, k) if use_exact else self._hnsw(query, k)
+            relevance = self._relevance(scores)
+            return [
+                {"id": self._ids[r], "relevance": float(rel), "fields": dict(self._fields[r])}
+                for r, rel in zip(rows, relevance)
+            ]
+
+    def load_from_vespa(self, vespa_app, schema: str = "clinical_data",
+                        content_cluster: str = "clinical_data", field: str = "image_embedding") -> int:
+        """Visit every document in `schema` and mirror it. Returns the number of vectors loaded."""
+        count = 0
+        for slice_ in vespa_app.visit(content_cluster_name=content_cluster, schema=schema,
+                                      wanted_document_count=1000):
+            for response in slice_:
+                for doc in response.documents:
+                    fields = doc.get("fields", {})
+                    values = _tensor_values(fields.get(field))
+                    if values is None:
+                        continue
+                    doc_id = doc["id"].rsplit("::", 1)[-1]
+                    self.upsert(doc_id, values, {k: v for k, v in fields.items() if k != field})
+                    count += 1
+        self.ready = True
+        return count
+
+
+def benchmark(index: VectorIndex, queries, k: int = 10) -> Dict[str, Any]:
+    """
+    Latency of the index's default search mode and its recall@k against brute
+    force over the same vectors.
+    """
+    queries = np.asarray(queries, dtype=np.float32).reshape(-1, index.dim)
+    latencies_ms, recalls = [], []
+    for q in queries:
+        started = time.perf_counter()
+        hits = index.search(q, k)
+        latencies_ms.append((time.perf_counter() - started) * 1000.0)
+        truth = {h["id"] for h in index.search(q, k, exact=True)}
+        recalls.append(len(truth & {h["id"] for h in hits}) / max(1, len(truth)))
+    return {
+        "mode": index.mode,
+        "size": len(index),
+        "k": k,
+        "recall_at_k": float(np.mean(recalls)) if recalls else None,
+        "latency_ms_p50": float(np.percentile(latencies_ms, 50)) if latencies_ms else None,
+        "latency_ms_p99": float(np.percentile(latencies_ms, 99)) if latencies_ms else None,
+    }
+
+
+_index: Optional[VectorIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> Optional[VectorIndex]:
+    """Shared per-process index, or None when VECTOR_INDEX_MODE is "off"."""
+    global _index
+    if DEFAULT_MODE == "off":
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = VectorIndex(mode=DEFAULT_MODE)
+    return _index
+
+
+def load_in_background(vespa_app) -> Optional[threading.Thread]:
+    """Bootstrap the shared index from Vespa on a daemon thread; /upload uses Vespa until it's done."""
+    index = get_index()
+    if index is None:
+        return None
+
+    def _run():
+        started = time.perf_counter()
+        try:
+            count = index.load_from_vespa(vespa_app)
+        except Exception as e:
+            print(f"Vector index load failed, queries will go to Vespa: {e}")
+            return
+        print(f"Vector index ({index.mode}) loaded {count} vectors in {time.perf_counter() - started:.2f}s")
+
+    thread = threading.Thread(target=_run, name="vector-index-load", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the in-process index against brute force.")
+    parser.add_argument("--size", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((args.size, DIM)).astype(np.float32)
+    queries = rng.standard_normal((args.queries, DIM)).astype(np.float32)
+    for mode in ("exact", "hnsw"):
+        if mode == "hnsw" and hnswlib is None:
+            print("hnswlib not installed, skipping hnsw")
+            continue
+        index = VectorIndex(mode=mode)
+        for i, v in enumerate(data):
+            index.upsert(str(i), v)
+        print(benchmark(index, queries, args.k))
@@ -0,0 +1,244 @@
+# vespa_feeder.py
+#
+# Bulk document feeding for Vespa on top of pyvespa's async client. Documents
+# are pulled lazily from any iterable, at most `concurrency` are in flight at a
+# time (which also bounds memory), 429/503 responses and transport errors are
+# retried with jittered exponential backoff, and every document's outcome is
+# reported through a callback.
+#
+# Only depends on pyvespa and the standard library so the other apps in this
+# repo (api/, src/) can share it (pip install -e api2). Point the Vespa
+# client at any HTTP server implementing /document/v1 to exercise it without
+# a real Vespa, as tests/test_vespa_feeder.py does.
+
+import asyncio
+import inspect
+import os
+import random
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterable, Callable, Dict, Iterable, Optional, Tuple, Union
+
+from vespa.application import Vespa, VespaAsync
+
+try:
+    from vespa.retries import NO_RETRY
+except ImportError:  # pyvespa releases without built-in document/v1 retries
+    NO_RETRY = None
+
+DEFAULT_CONNECTIONS = int(os.getenv("VESPA_FEED_CONNECTIONS", "8"))
+DEFAULT_CONCURRENCY = int(os.getenv("VESPA_FEED_CONCURRENCY", "32"))
+DEFAULT_MAX_RETRIES = int(os.getenv("VESPA_FEED_MAX_RETRIES", "6"))
+
+# Vespa's "slow down" responses; anything else non-2xx fails the document.
+RETRYABLE_STATUS = (429, 503)
+
+# How many recent latencies we keep for the percentile stats.
+_STATS_WINDOW = 4096
+
+Doc = Tuple[str, Dict[str, Any]]
+_END = object()
+
+
+@dataclass
+class FeedResult:
+    doc_id: str
+    ok: bool
+    status_code: Optional[int]
+    attempts: int
+    latency_ms: float
+    body: Any = None
+    error: Optional[str] = None
+    # Whatever the caller paired with the document, handed back untouched.
+    context: Any = None
+
+
+def _percentile(samples, q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))]
+
+
+class FeedStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies_ms = deque(maxlen=_STATS_WINDOW)
+        self._status = Counter()
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._started: Optional[float] = None
+        self._finished: Optional[float] = None
+
+    def start(self):
+        with self._lock:
+            if self._started is None:
+                self._started = time.perf_counter()
+
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def retry(self, status_code: Optional[int]):
+        with self._lock:
+            self.retries += 1
+            self._status[str(status_code)] += 1
+
+    def end(self, result: FeedResult):
+        with self._lock:
+            self.in_flight -= 1
+            self._finished = time.perf_counter()
+            self._status[str(result.status_code)] += 1
+            self._latencies_ms.append(result.latency_ms)
+            if result.ok:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            elapsed = (self._finished or time.perf_counter()) - self._started if self._started else 0.0
+            latencies = list(self._latencies_ms)
+            done = self.succeeded + self.failed
+            return {
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "retries": self.retries,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "status_codes": dict(self._status),
+                "elapsed_seconds": elapsed,
+                "docs_per_sec": done / elapsed if elapsed > 0 else None,
+                "latency_ms_p50": _percentile(latencies, 50),
+                "latency_ms_p99": _percentile(latencies, 99),
+            }
+
+
+class BulkFeeder:
+    def __init__(self, app: Vespa, schema: str, namespace: Optional[str] = None,
+                 connections: int = DEFAULT_CONNECTIONS, concurrency: int = DEFAULT_CONCURRENCY,
+                 max_retries: int = DEFAULT_MAX_RETRIES, backoff_base: float = 0.1,
+                 backoff_max: float = 10.0,
+                 on_result: Optional[Callable[[FeedResult], Any]] = None,
+                 client_kwargs: Optional[Dict[str, Any]] = None):
+        """
+        `connections` is the HTTP connection pool size, `concurrency` the
+        number of documents in flight (requests plus retries waiting on
+        backoff). `on_result` is called on the feeder's event loop once per
+        document, so keep it cheap. `client_kwargs` go to `app.asyncio`, e.g.
+        http2_only=False for an endpoint that only speaks HTTP/1.1.
+        """
+        self.app = app
+        self.schema = schema
+        self.namespace = namespace
+        self.connections = max(1, connections)
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.on_result = on_result
+        self.client_kwargs = dict(client_kwargs or {})
+        self.stats = FeedStats()
+
+    def _client(self):
+        kwargs = {"connections": self.connections, **self.client_kwargs}
+        if NO_RETRY is not None and "docv1_retry_policy" in inspect.signature(VespaAsync).parameters:
+            # Newer pyvespa retries 429s itself, indefinitely; turn that off so
+            # our bounded backoff is the only retry layer and every throttled
+            # attempt shows up in the stats.
+            kwargs.setdefault("docv1_retry_policy", NO_RETRY)
+        return self.app.asyncio(**kwargs)
+
+    def _backoff(self, attempt: int) -> float:
+        # "Full jitter": spreads retries out so throttled clients don't stampede back together.
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def _feed_one(self, client, doc_id: str, fields: Dict[str, Any]) -> FeedResult:
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            status_code, body, error = None, None, None
+            try:
+                kwargs = {"namespace": self.namespace} if self.namespace else {}
+                response = await client.feed_data_point(
+                    schema=self.schema, data_id=doc_id, fields=fields, **kwargs)
+                status_code = response.status_code
+                body = getattr(response, "json", None)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+
+            if status_code is not None and 200 <= status_code < 300:
+                return FeedResult(doc_id, True, status_code, attempt,
+                                  (time.perf_counter() - started) * 1000.0, body)
+            retryable = error is not None or status_code in RETRYABLE_STATUS
+            if not retryable or attempt > self.max_retries:
+                return FeedResult(doc_id, False, status_code, attempt,
+                                  (time.perf_counter() - started) * 1000.0, body,
+                                  error or f"HTTP {status_code}")
+            self.stats.retry(status_code)
+            await asyncio.sleep(self._backoff(attempt - 1))
+
+    async def _next(self, docs):
+        if hasattr(docs, "__anext__"):
+            try:
+                return await docs.__anext__()
+            except StopAsyncIteration:
+                return _END
+        # Plain iterators may block (e.g. reading from a queue); keep that off the loop.
+        return await asyncio.get_running_loop().run_in_executor(None, next, docs, _END)
+
+    async def feed_async(self, docs: Union[Iterable[Doc], AsyncIterable[Doc]]) -> Dict[str, Any]:
+        """
+        Feed every (doc_id, fields) pair from `docs`; returns the stats summary.
+        A (doc_id, fields, context) triple also works, and its context comes
+        back on the FeedResult, e.g. to tell apart two writes of one doc_id.
+        """
+        docs = docs.__aiter__() if hasattr(docs, "__aiter__") else iter(docs)
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        self.stats.start()
+
+        async def run(client, doc_id, fields, context):
+            try:
+                result = await self._feed_one(client, doc_id, fields)
+                result.context = context
+                self.stats.end(result)
+                if self.on_result is not None:
+                    try:
+                        self.on_result(result)
+                    except Exception as e:
+                        print(f"Feed result callback failed for {doc_id}: {e}")
+            finally:
+                slots.release()
+
+        async with self._client() as client:
+            try:
+                while True:
+                    # Only pull the next document once there is room for it.
+                    await slots.acquire()
+                    doc = await self._next(docs)
+                    if doc is _END:
+                        slots.release()
+                        break
+                    doc_id, fields = doc[0], doc[1]
+                    context = doc[2] if len(doc) > 2 else None
+                    self.stats.begin()
+                    task = asyncio.ensure_future(run(client, doc_id, fields, context))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            finally:
+                # Let in-flight documents finish (and report) before the client closes.
+                if tasks:
+                    await asyncio.gather(*tasks, return_exceptions=True)
+        return self.stats.summary()
+
+    def feed(self, docs: Iterable[Doc]) -> Dict[str, Any]:
+        """Blocking wrapper around `feed_async` for synchronous callers."""
+        return asyncio.run(self.feed_async(docs))
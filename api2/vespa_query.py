@@ -0,0 +1,196 @@
+# vespa_query.py
+#
+# Non-blocking Vespa query client for the FastAPI endpoints. One keep-alive
+# httpx connection pool is shared by every request on the event loop, each
+# endpoint gets its own concurrency limit, slow requests are hedged (a second
+# copy is sent after `hedge_ms` and whichever answers first wins) and
+# 429/5xx/transport failures are retried with jittered backoff.
+#
+# Like vespa_feeder, this only needs httpx (a pyvespa dependency) and the
+# standard library, so api/ and src/ share it.
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+import httpx
+
+DEFAULT_URL = os.getenv("VESPA_URL", "http://localhost:8080")
+DEFAULT_TIMEOUT = float(os.getenv("VESPA_QUERY_TIMEOUT", "5"))
+DEFAULT_CONNECT_TIMEOUT = float(os.getenv("VESPA_QUERY_CONNECT_TIMEOUT", "1"))
+DEFAULT_HEDGE_MS = float(os.getenv("VESPA_QUERY_HEDGE_MS", "150"))
+DEFAULT_MAX_RETRIES = int(os.getenv("VESPA_QUERY_MAX_RETRIES", "2"))
+DEFAULT_CONCURRENCY = int(os.getenv("VESPA_QUERY_CONCURRENCY", "64"))
+DEFAULT_MAX_CONNECTIONS = int(os.getenv("VESPA_QUERY_MAX_CONNECTIONS", "100"))
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+
+# How many recent latencies we keep for the percentile stats.
+_STATS_WINDOW = 4096
+
+
+class VespaQueryError(Exception):
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _percentile(samples, q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q / 100.0 * (len(ordered) - 1))))]
+
+
+class VespaQueryClient:
+    def __init__(self, url: str = DEFAULT_URL, timeout: float = DEFAULT_TIMEOUT,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 hedge_ms: Optional[float] = DEFAULT_HEDGE_MS,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 endpoint_concurrency: Optional[Dict[str, int]] = None,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 cert: Optional[Any] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        """
+        `concurrency` is the default number of in-flight queries per endpoint
+        name; `endpoint_concurrency` overrides it for specific endpoints.
+        `hedge_ms=None` (or 0) disables hedging. `cert` is passed to httpx for
+        mTLS (e.g. Vespa Cloud); `transport` replaces the network, e.g. an
+        httpx.MockTransport standing in for Vespa in benchmarks.
+        """
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.hedge = (hedge_ms / 1000.0) if hedge_ms else None
+        self.max_retries = max(0, max_retries)
+        self.concurrency = max(1, concurrency)
+        self.endpoint_concurrency = dict(endpoint_concurrency or {})
+        self.max_connections = max_connections
+        self.cert = cert
+        self.transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop = None
+        self._limits: Dict[str, asyncio.Semaphore] = {}
+        self._stats_lock = threading.Lock()
+        self._latencies_ms = deque(maxlen=_STATS_WINDOW)
+        self._counters = {"queries": 0, "errors": 0, "retries": 0, "hedges": 0, "hedge_wins": 0}
+        self._in_flight: Dict[str, int] = {}
+
+    def _ensure_client(self) -> httpx.AsyncClient:
+        # The pool and semaphores belong to one event loop; rebuild them if
+        # we're called from another (e.g. a script using asyncio.run).
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            self._client = httpx.AsyncClient(
+                base_url=self.url,
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                cert=self.cert,
+                transport=self.transport,
+            )
+            self._loop = loop
+            self._limits = {}
+        return self._client
+
+    def _limit(self, endpoint: str) -> asyncio.Semaphore:
+        sem = self._limits.get(endpoint)
+        if sem is None:
+            sem = self._limits[endpoint] = asyncio.Semaphore(
+                self.endpoint_concurrency.get(endpoint, self.concurrency))
+        return sem
+
+    def _count(self, name: str, n: int = 1):
+        with self._stats_lock:
+            self._counters[name] += n
+
+    async def _send(self, client: httpx.AsyncClient, body: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            response = await client.post("/search/", json=body)
+        except httpx.HTTPError as e:
+            raise VespaQueryError(f"{type(e).__name__}: {e}") from e
+        if response.status_code != 200:
+            raise VespaQueryError(f"Vespa returned HTTP {response.status_code}: {response.text[:200]}",
+                                  response.status_code)
+        return response.json()
+
+    async def _hedged(self, client: httpx.AsyncClient, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Send `body`; if it hasn't answered within the hedge delay, race a second copy."""
+        primary = asyncio.ensure_future(self._send(client, body))
+        tasks = {primary}
+        try:
+            if self.hedge is not None:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge)
+                if not done:
+                    self._count("hedges")
+                    tasks.add(asyncio.ensure_future(self._send(client, body)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self._count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def query(self, body: Dict[str, Any], endpoint: str = "default", **params) -> Dict[str, Any]:
+        """
+        Run one query and return Vespa's JSON response. Extra keyword
+        arguments are merged into the request body, like pyvespa's query().
+        """
+        client = self._ensure_client()
+        request = {**body, **params}
+        # Let Vespa give up server-side when we would have anyway.
+        request.setdefault("timeout", f"{self.timeout}s")
+        async with self._limit(endpoint):
+            with self._stats_lock:
+                self._in_flight[endpoint] = self._in_flight.get(endpoint, 0) + 1
+            started = time.perf_counter()
+            try:
+                attempt = 0
+                while True:
+                    try:
+                        result = await self._hedged(client, request)
+                        break
+                    except VespaQueryError as e:
+                        retryable = e.status_code is None or e.status_code in RETRYABLE_STATUS
+                        if not retryable or attempt >= self.max_retries:
+                            self._count("errors")
+                            raise
+                        attempt += 1
+                        self._count("retries")
+                        await asyncio.sleep(random.uniform(0, min(1.0, 0.05 * (2 ** attempt))))
+            finally:
+                with self._stats_lock:
+                    self._in_flight[endpoint] -= 1
+        with self._stats_lock:
+            self._counters["queries"] += 1
+            self._latencies_ms.append((time.perf_counter() - started) * 1000.0)
+        return result
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            latencies = list(self._latencies_ms)
+            return {
+                **self._counters,
+                "in_flight": dict(self._in_flight),
+                "latency_ms_p50": _percentile(latencies, 50),
+                "latency_ms_p99": _percentile(latencies, 99),
+                "hedge_ms": self.hedge * 1000.0 if self.hedge else None,
+                "timeout_seconds": self.timeout,
+            }
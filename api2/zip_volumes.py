@@ -0,0 +1,127 @@
+# zip_volumes.py
+#
+# Read NIfTI volumes straight out of cropped.zip. Members are exposed under the
+# same layout decompress_zip + decompress_nii_files used to produce on disk
+# (<category>/<name>.nii), but .nii.gz entries are inflated in memory while
+# they're read, so nothing is ever extracted.
+
+import os
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from nifti_stream import NiftiBuffer, volume_from_buffer
+
+# Filename pattern -> category folder, checked in order (the longer patterns
+# contain the shorter ones). Mirrors decompress_nii_files.
+CATEGORIES = (
+    ("cropped_seg_endpoints.nii.gz", "cropped_seg_endpoints"),
+    ("cropped_seg.nii.gz", "cropped_seg"),
+    ("cropped.nii.gz", "cropped"),
+)
+
+
+@dataclass(frozen=True)
+class ZipMember:
+    """
+    Picklable reference to one volume inside a zip, usable as an ingestion
+    image source. `crc` and `file_size` are taken from the archive directory
+    the member was listed from, so they describe that version of the archive.
+    """
+    zip_path: str
+    member: str
+    crc: Optional[int] = None
+    file_size: Optional[int] = None
+
+
+# Open archives, per process and thread: ZipFile handles are cheap to keep
+# around but not safe to read from concurrently. Each handle is tagged with
+# the file's mtime and size, so an archive replaced or rewritten at the same
+# path is reopened (and the old handle closed) instead of read through a
+# stale central directory.
+_local = threading.local()
+
+
+def open_zip(path: str) -> zipfile.ZipFile:
+    handles = getattr(_local, "handles", None)
+    if handles is None:
+        handles = _local.handles = {}
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    entry = handles.get(path)
+    if entry is not None:
+        if entry[0] == stamp:
+            return entry[1]
+        entry[1].close()
+    zf = zipfile.ZipFile(path, "r")
+    handles[path] = (stamp, zf)
+    return zf
+
+
+def read_member(ref: ZipMember) -> memoryview:
+    """Return the decoded .nii bytes of a zip member, inflating .nii.gz on the fly."""
+    zf = open_zip(ref.zip_path)
+    info = zf.getinfo(ref.member)
+    # Our own data zip, so none of the upload size limits.
+    buffer = NiftiBuffer(info.file_size, max_body_bytes=None, max_nifti_bytes=None)
+    with zf.open(info) as f:
+        buffer.readfrom(f)
+    return buffer.finish()
+
+
+def read_member_volume(ref: ZipMember) -> np.ndarray:
+    """Decode a zip member straight to a float32 voxel array."""
+    return np.asarray(volume_from_buffer(read_member(ref)), dtype=np.float32)
+
+
+class ZipVolumeSource:
+    def __init__(self, zip_path: str):
+        self.zip_path = zip_path
+        self._layout: Dict[str, Dict[str, ZipMember]] = {category: {} for _, category in CATEGORIES}
+        with zipfile.ZipFile(zip_path, "r") as zf:
+            for info in zf.infolist():
+                filename = os.path.basename(info.filename)
+                if not filename.endswith(".nii.gz"):
+                    continue
+                for pattern, category in CATEGORIES:
+                    if pattern in filename:
+                        # First occurrence wins, like the "skip if it exists" check on disk.
+                        self._layout[category].setdefault(
+                            filename[:-3], ZipMember(zip_path, info.filename, info.CRC, info.file_size))
+                        break
+
+    def layout(self) -> Dict[str, List[str]]:
+        """Category -> sorted .nii names, i.e. what decompress_nii_files would have written."""
+        return {category: sorted(members) for category, members in self._layout.items()}
+
+    def member(self, category: str, name: str) -> Optional[ZipMember]:
+        """The zip member for `<category>/<name>` (e.g. "cropped", "pat0_cropped.nii"), or None."""
+        return self._layout.get(category, {}).get(name)
+
+    def read(self, category: str, name: str) -> np.ndarray:
+        ref = self.member(category, name)
+        if ref is None:
+            raise KeyError(f"{category}/{name} not in {self.zip_path}")
+        return read_member_volume(ref)
+
+    def iter_volumes(self, category: str, workers: int = 4) -> Iterator[Tuple[str, np.ndarray]]:
+        """
+        Yield (name, float32 volume) for every member of `category`, inflating
+        up to `workers` members in parallel (zlib releases the GIL). Results
+        come back in name order with at most 2 * workers volumes in memory.
+        """
+        names = sorted(self._layout.get(category, {}))
+        refs = self._layout.get(category, {})
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            window = []
+            for name in names:
+                window.append((name, pool.submit(read_member_volume, refs[name])))
+                if len(window) >= 2 * max(1, workers):
+                    done_name, future = window.pop(0)
+                    yield done_name, future.result()
+            for name, future in window:
+                yield name, future.result()
@@ -0,0 +1,194 @@
+# segmentation_dataset.py
+#
+# Preprocessed UNet3D training data on disk. `build` runs the notebook's
+# preprocessing (centre-pad to a cube, resize to 128^3) for image and labels
+# in one vectorized pass per patient, and writes fixed-size shards:
+#
+#   <out>/index.json               patients, shard sizes, grid
+#   <out>/images-<k>.npy           (n, 128, 128, 128) float32
+#   <out>/labels-<k>.npy           (n, 128, 128, 128) uint8, 0 = background, 1-8
+#
+# Labels are stored as class indices and expanded to the 8-channel one-hot
+# target per sample, so a shard costs 9 bytes per voxel instead of 36.
+# SegmentationShards memory-maps the shards, so training memory does not grow
+# with the number of patients.
+#
+#   python segmentation_dataset.py build data/25226366/cropped data/seg_shards
+
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+import nibabel as nib
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Dataset
+
+GRID = (128, 128, 128)
+NUM_LABELS = 8
+DEFAULT_SHARD_SIZE = 16
+
+_PATIENT = re.compile(r"^pat(\d+)_cropped\.nii\.gz$")
+
+
+def find_patients(data_dir: str) -> List[int]:
+    """Patients with both pat<N>_cropped.nii.gz and pat<N>_cropped_seg.nii.gz, in order."""
+    patients = []
+    for name in os.listdir(data_dir):
+        match = _PATIENT.match(name)
+        if match and os.path.exists(os.path.join(data_dir, f"pat{match.group(1)}_cropped_seg.nii.gz")):
+            patients.append(int(match.group(1)))
+    return sorted(patients)
+
+
+def _pad_to_cube(x: torch.Tensor) -> torch.Tensor:
+    """Centre zero-pad the last three dims of (C, D, H, W) to a cube."""
+    d, h, w = x.shape[-3:]
+    side = max(d, h, w)
+    pads = []
+    for size in (w, h, d):
+        pads += [(side - size) // 2, side - size - (side - size) // 2]
+    return F.pad(x, pads)
+
+
+def preprocess(image: np.ndarray, seg: np.ndarray, grid=GRID):
+    """
+    (float32 image, uint8 labels) on `grid`. The labels are one-hot encoded in
+    one step (background included), resized with the image's trilinear
+    interpolation and reduced back to the most likely class per voxel.
+    """
+    image = torch.from_numpy(np.asarray(image, dtype=np.float32))[None]
+    labels = torch.from_numpy(np.rint(seg).astype(np.int64)).clamp_(0, NUM_LABELS)
+    onehot = F.one_hot(labels, NUM_LABELS + 1).permute(3, 0, 1, 2).float()
+    # One interpolate call for the image and all nine label channels.
+    stacked = _pad_to_cube(torch.cat([image, onehot]))[None]
+    resized = F.interpolate(stacked, size=grid, mode="trilinear", align_corners=False)[0]
+    return resized[0].numpy(), resized[1:].argmax(dim=0).to(torch.uint8).numpy()
+
+
+def _load_patient(args):
+    data_dir, patient = args
+    # One thread per worker process; the pool provides the parallelism.
+    torch.set_num_threads(1)
+    image = nib.load(os.path.join(data_dir, f"pat{patient}_cropped.nii.gz")).get_fdata(dtype=np.float32)
+    seg = nib.load(os.path.join(data_dir, f"pat{patient}_cropped_seg.nii.gz")).get_fdata(dtype=np.float32)
+    return preprocess(image, seg)
+
+
+def build(data_dir: str, out_dir: str, patients: Optional[Sequence[int]] = None,
+          shard_size: int = DEFAULT_SHARD_SIZE, workers: int = 4) -> Dict:
+    """
+    Preprocess `patients` (default: all found in `data_dir`) into shards under
+    `out_dir`. Only `workers` volumes are in flight at a time.
+    """
+    patients = list(patients) if patients is not None else find_patients(data_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    shards = []
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        for k, start in enumerate(range(0, len(patients), shard_size)):
+            chunk = patients[start:start + shard_size]
+            images = np.lib.format.open_memmap(os.path.join(out_dir, f"images-{k}.npy"), mode="w+",
+                                               dtype=np.float32, shape=(len(chunk), *GRID))
+            labels = np.lib.format.open_memmap(os.path.join(out_dir, f"labels-{k}.npy"), mode="w+",
+                                               dtype=np.uint8, shape=(len(chunk), *GRID))
+            for row, (image, label) in enumerate(pool.map(_load_patient, [(data_dir, p) for p in chunk])):
+                images[row] = image
+                labels[row] = label
+            images.flush()
+            labels.flush()
+            del images, labels
+            shards.append(len(chunk))
+            print(f"Shard {k}: patients {chunk[0]}-{chunk[-1]}")
+    index = {"grid": list(GRID), "num_labels": NUM_LABELS, "patients": patients, "shards": shards}
+    with open(os.path.join(out_dir, "index.json"), "w") as f:
+        json.dump(index, f)
+    return index
+
+
+class SegmentationShards(Dataset):
+    """
+    (image (1, D, H, W) float32, target) samples read from memory-mapped
+    shards. `target` is "onehot" for an 8-channel float target laid out like
+    the notebook's (channel c is label c + 1, but 1.0 rather than the label
+    value), or "index" for (D, H, W) int64 class indices (0 = background).
+    """
+
+    def __init__(self, root: str, patients: Optional[Sequence[int]] = None, target: str = "onehot"):
+        if target not in ("onehot", "index"):
+            raise ValueError("target must be 'onehot' or 'index'")
+        self.root = root
+        self.target = target
+        with open(os.path.join(root, "index.json")) as f:
+            self.index = json.load(f)
+        rows = []
+        for k, n in enumerate(self.index["shards"]):
+            rows += [(k, r) for r in range(n)]
+        by_patient = dict(zip(self.index["patients"], rows))
+        self.patients = list(patients) if patients is not None else list(self.index["patients"])
+        self.rows = [by_patient[p] for p in self.patients]
+        # Opened lazily, so each DataLoader worker maps the files itself.
+        self._images: Dict[int, np.ndarray] = {}
+        self._labels: Dict[int, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def _shard(self, k: int):
+        if k not in self._images:
+            self._images[k] = np.load(os.path.join(self.root, f"images-{k}.npy"), mmap_mode="r")
+            self._labels[k] = np.load(os.path.join(self.root, f"labels-{k}.npy"), mmap_mode="r")
+        return self._images[k], self._labels[k]
+
+    def __getitem__(self, i: int):
+        k, row = self.rows[i]
+        images, labels = self._shard(k)
+        image = torch.from_numpy(np.array(images[row]))[None]
+        label = torch.from_numpy(np.array(labels[row])).long()
+        if self.target == "index":
+            return image, label
+        # Channel c is label c + 1; background voxels are all zeros.
+        onehot = F.one_hot(label, NUM_LABELS + 1)[..., 1:]
+        return image, onehot.permute(3, 0, 1, 2).float()
+
+
+def make_loader(dataset: Dataset, batch_size: int = 2, shuffle: bool = True, workers: int = 4) -> DataLoader:
+    """DataLoader reading shards in `workers` processes into pinned buffers when training on a GPU."""
+    return DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=workers,
+        pin_memory=torch.cuda.is_available(),
+        persistent_workers=workers > 0,
+        prefetch_factor=2 if workers > 0 else None,
+        drop_last=shuffle,
+    )
+
+
+def train_test_split(root: str, split: int = 50, **kwargs):
+    """First `split` patients for training, the rest for testing, like the notebook."""
+    with open(os.path.join(root, "index.json")) as f:
+        patients = json.load(f)["patients"]
+    return (SegmentationShards(root, patients[:split], **kwargs),
+            SegmentationShards(root, patients[split:], **kwargs))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build memory-mapped UNet3D training shards.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("build")
+    p.add_argument("data_dir", help="directory with pat<N>_cropped(.seg).nii.gz files")
+    p.add_argument("out_dir")
+    p.add_argument("--patients", type=int, default=None, help="only the first N patients")
+    p.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE)
+    p.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    found = find_patients(args.data_dir)
+    index = build(args.data_dir, args.out_dir, found[:args.patients] if args.patients else found,
+                  shard_size=args.shard_size, workers=args.workers)
+    print(f"{len(index['patients'])} patients in {len(index['shards'])} shards under {args.out_dir}")
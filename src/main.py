@@ -9,10 +9,16 @@ import os
 from typings import MedicalRecord
 from typing import List
 
+# Shared with the main API; installed from api2/ (pip install -e api2).
+from vespa_feeder import BulkFeeder
+from vespa_query import VespaQueryClient, VespaQueryError
+
 app = FastAPI()
 
 # IMPORTANT: Change the port so you’re not conflicting with the FastAPI port.
 vespa_app = Vespa(url="http://localhost", port=8080)
+# Non-blocking, pooled client for the query endpoint.
+vespa_query = VespaQueryClient(os.getenv("VESPA_URL", "http://localhost:8080"))
 
 tenant_name = "socrates"
 application = "heartaivespa"
@@ -57,25 +63,23 @@ vespa_connection = vespa_container.deploy(application_package=package)
 
 @app.post("/insert_records/")
 async def insert_records(records: List[MedicalRecord]):
-    print("Inserting records...")
-    print(records)
+    print(f"Inserting {len(records)} records...")
     responses = []
     try:
-        # If you want to use vespa_app.syncio, do so here.
-        with vespa_app.syncio() as sync_app:
-            for record in records:
-                print("data_id: ", str(record.Pat))
-                print("dict: ", record.dict)
-                response = sync_app.feed_data_point(
-                    schema="medical_records",
-                    data_id=str(record.Pat),
-                    fields=record.dict()
-                )
-                print(response.json())
-                print("byeee")
-                responses.append(response.json())
+        feeder = BulkFeeder(vespa_app, schema="medical_records", on_result=responses.append)
+        stats = await feeder.feed_async((str(record.Pat), record.dict()) for record in records)
+        # Results arrive in completion order; report them in request order.
+        position = {}
+        for i, record in enumerate(records):
+            position.setdefault(str(record.Pat), i)
+        responses.sort(key=lambda r: position[r.doc_id])
+        failed = [r for r in responses if not r.ok]
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {len(records)} records failed, first: "
+                               f"{failed[0].doc_id} ({failed[0].error})")
         # CRITICAL: Return at the end so FastAPI can finish the request
-        return {"message": "Records inserted successfully", "responses": responses}
+        return {"message": "Records inserted successfully",
+                "responses": [r.body for r in responses], "stats": stats}
     except Exception as e:
         print(f"An error occurred: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -94,5 +98,7 @@ async def query_vespa(embedding: List[float], top_k: int = 5):
             "value": embedding
         }
     }
-    response = vespa_app.query(body=query_body)
-    return response.json()
+    try:
+        return await vespa_query.query(query_body, endpoint="query")
+    except VespaQueryError as e:
+        raise HTTPException(status_code=502, detail=str(e))
@@ -0,0 +1,3 @@
+// Base URL of the FastAPI backend (api2/main.py), shared by every page and
+// component that talks to it.
+export const API_URL = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8000';
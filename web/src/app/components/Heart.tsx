@@ -1,10 +1,186 @@
-import React from "react";
+'use client'
+
+import React, { useEffect, useRef, useState } from "react";
+import * as THREE from "three";
+import { GLTFLoader } from "three/examples/jsm/loaders/GLTFLoader.js";
+import { OrbitControls } from "three/examples/jsm/controls/OrbitControls.js";
+import { API_URL } from "../api";
 
 interface HeartProps {
-        path: string;
+    path: string;
+    // When set, the patient's precomputed meshes are fetched region by
+    // region from /meshes/{id}; `path` (a Plotly HTML export) is the fallback.
+    meshPatient?: string;
+    // Stop refining a region past this many triangles (e.g. on phones).
+    maxTriangles?: number;
+  }
+
+interface MeshLevel {
+  url: string;
+  triangles: number;
+}
+
+interface MeshRegion extends MeshLevel {
+  label: number;
+  // Decimated levels, coarsest first
+  lods: MeshLevel[];
+}
+
+// One region's glTF scene. GLTFLoader handles our KHR_mesh_quantization
+// attributes and the node transform back to voxel coordinates.
+interface RegionMesh {
+  label: number;
+  object: THREE.Object3D;
+  color: THREE.Color;
+}
+
+const loader = new GLTFLoader();
+
+async function loadRegion(label: number, url: string): Promise<RegionMesh> {
+  const gltf = await loader.loadAsync(`${API_URL}${url}`);
+  let color = new THREE.Color(0.8, 0.8, 0.8);
+  gltf.scene.traverse((node) => {
+    const material = (node as THREE.Mesh).material as THREE.MeshStandardMaterial | undefined;
+    if (material?.color) color = material.color;
+  });
+  return { label, object: gltf.scene, color };
+}
+
+function dispose(object: THREE.Object3D) {
+  object.traverse((node) => {
+    const mesh = node as THREE.Mesh;
+    if (!mesh.isMesh) return;
+    mesh.geometry.dispose();
+    (Array.isArray(mesh.material) ? mesh.material : [mesh.material]).forEach((m) => m.dispose());
+  });
+}
+
+function MeshViewer({regions}: {regions: RegionMesh[]}) {
+  const containerRef = useRef<HTMLDivElement>(null);
+  const viewRef = useRef<{ scene: THREE.Scene; camera: THREE.PerspectiveCamera;
+                           controls: OrbitControls; render: () => void } | null>(null);
+  const shownRef = useRef<RegionMesh[]>([]);
+  const [hidden, setHidden] = useState<Set<number>>(new Set());
+
+  useEffect(() => {
+    const container = containerRef.current;
+    if (!container) return;
+    const renderer = new THREE.WebGLRenderer({ antialias: true, alpha: true });
+    renderer.setPixelRatio(window.devicePixelRatio);
+    renderer.setSize(600, 600);
+    container.appendChild(renderer.domElement);
+
+    const scene = new THREE.Scene();
+    scene.add(new THREE.AmbientLight(0xffffff, 0.6));
+    const camera = new THREE.PerspectiveCamera(45, 1, 0.1, 10000);
+    const light = new THREE.DirectionalLight(0xffffff, 1.2);
+    camera.add(light);
+    scene.add(camera);
+
+    const controls = new OrbitControls(camera, renderer.domElement);
+    const render = () => renderer.render(scene, camera);
+    controls.addEventListener('change', render);
+    viewRef.current = { scene, camera, controls, render };
+    return () => {
+      viewRef.current = null;
+      shownRef.current.forEach((r) => dispose(r.object));
+      shownRef.current = [];
+      controls.dispose();
+      renderer.dispose();
+      container.removeChild(renderer.domElement);
+    };
+  }, []);
+
+  // Swap in each refinement, disposing only the regions it replaced; the
+  // camera is framed on the first one only.
+  useEffect(() => {
+    const view = viewRef.current;
+    if (!view) return;
+    const current = new Set(regions.map((r) => r.object));
+    shownRef.current.forEach((r) => {
+      if (current.has(r.object)) return;
+      view.scene.remove(r.object);
+      dispose(r.object);
+    });
+    regions.forEach((r) => view.scene.add(r.object));
+    if (!shownRef.current.length) {
+      const box = new THREE.Box3();
+      regions.forEach((r) => box.expandByObject(r.object));
+      const sphere = box.getBoundingSphere(new THREE.Sphere());
+      view.controls.target.copy(sphere.center);
+      view.camera.position.copy(sphere.center).add(new THREE.Vector3(0, 0, sphere.radius * 2.5));
+      view.camera.near = sphere.radius / 100;
+      view.camera.far = sphere.radius * 100;
+      view.camera.updateProjectionMatrix();
+      view.controls.update();
     }
+    shownRef.current = regions;
+    view.render();
+  }, [regions]);
+
+  useEffect(() => {
+    regions.forEach((r) => { r.object.visible = !hidden.has(r.label); });
+    viewRef.current?.render();
+  }, [regions, hidden]);
+
+  const toggle = (label: number) => setHidden((prev) => {
+    const next = new Set(prev);
+    if (next.has(label)) next.delete(label); else next.add(label);
+    return next;
+  });
 
-export default function Heart({path}: HeartProps) {
+  return (
+    <div>
+      <div ref={containerRef} style={{ width: 600, height: 600, touchAction: 'none', cursor: 'grab' }} />
+      <div className="flex flex-wrap gap-3 mt-2 text-sm">
+        {regions.map((r) => (
+          <label key={r.label} className="flex items-center gap-1">
+            <input type="checkbox" checked={!hidden.has(r.label)} onChange={() => toggle(r.label)} />
+            <span style={{ color: `#${r.color.getHexString()}` }}>■</span>
+            Region {r.label}
+          </label>
+        ))}
+      </div>
+    </div>
+  );
+}
+
+export default function Heart({path, meshPatient, maxTriangles}: HeartProps) {
+    const [regions, setRegions] = useState<RegionMesh[] | null>(null);
+
+    useEffect(() => {
+      if (!meshPatient) return;
+      let cancelled = false;
+      (async () => {
+        try {
+          const index = await fetch(`${API_URL}/meshes/${meshPatient}`);
+          if (!index.ok) return;
+          const { regions: listed }: { regions: MeshRegion[] } = await index.json();
+          // Each region's levels, coarsest first; the first is always kept.
+          const levels = listed.map((r) => [...r.lods, r].filter(
+            (level, i) => i === 0 || !maxTriangles || level.triangles <= maxTriangles));
+          // Show the coarsest level of every region first, then refine one
+          // level at a time. Regions are fetched separately and in parallel;
+          // the browser revalidates each one with its ETag.
+          let meshes: RegionMesh[] = [];
+          const steps = Math.max(0, ...levels.map((l) => l.length));
+          for (let step = 0; step < steps && !cancelled; step++) {
+            meshes = await Promise.all(listed.map(async (r, i) => {
+              if (step >= levels[i].length) return meshes[i];
+              return loadRegion(r.label, levels[i][step].url);
+            }));
+            if (!cancelled) setRegions(meshes);
+          }
+        } catch (error) {
+          console.error('Error loading heart meshes:', error);
+        }
+      })();
+      return () => { cancelled = true; };
+    }, [meshPatient, maxTriangles]);
+
+    if (regions && regions.length) {
+      return <MeshViewer regions={regions} />;
+    }
     return (
       <div>
         <iframe
@@ -16,4 +192,3 @@ export default function Heart({path}: HeartProps) {
       </div>
     );
   }
-  
\ No newline at end of file
@@ -9,6 +9,8 @@ import Script from 'next/script'
 
 interface ResultsDashboardProps {
   diagnosis: Diagnosis
+  // The explanation is still arriving token by token
+  streaming?: boolean
 }
 
 function labelsToString(labels: string[]) {
@@ -51,7 +53,7 @@ function parseSuggestionText(text: string, links: string[]): (string | JSX.Eleme
   return parts;
 }
 
-export function ResultsDashboard({ diagnosis }: ResultsDashboardProps) {
+export function ResultsDashboard({ diagnosis, streaming }: ResultsDashboardProps) {
   const [showAgent, setShowAgent] = useState(false);
 
   const handleAgentToggle = () => {
@@ -89,6 +91,11 @@ export function ResultsDashboard({ diagnosis }: ResultsDashboardProps) {
               {diagnosis.suggestionLinks
                 ? parseSuggestionText(diagnosis.explanation, diagnosis.suggestionLinks)
                 : diagnosis.explanation}
+              {streaming && (
+                <span className="text-slate-400 animate-pulse">
+                  {diagnosis.explanation ? ' ▍' : 'Generating explanation...'}
+                </span>
+              )}
             </p>
           </div>
           {/* Feedback Form */}
@@ -123,9 +130,35 @@ export function ResultsDashboard({ diagnosis }: ResultsDashboardProps) {
             </div>
           </div>
 
+          {/* Similar Patients */}
+          {diagnosis.neighbours && diagnosis.neighbours.length > 0 && (
+            <div className="bg-white rounded-xl p-6 shadow-sm border border-slate-200">
+              <h2 className="text-xl font-semibold text-slate-900 mb-4">
+                Similar Patients
+              </h2>
+              <ul className="space-y-2">
+                {diagnosis.neighbours.map((n) => (
+                  <li key={n.id} className="flex items-center justify-between">
+                    <span className="text-slate-800">Patient {n.pat ?? n.id}</span>
+                    <span className="font-medium text-blue-600">
+                      {(n.relevance * 100).toFixed(1)}%
+                    </span>
+                  </li>
+                ))}
+              </ul>
+            </div>
+          )}
+
           {/* Visualization */}
           <div className="bg-white rounded-xl p-6 shadow-sm border border-slate-150 overflow-hidden flex items-center justify-center">
-            <Heart path={diagnosis.path} />
+            <div>
+              <Heart path={diagnosis.path} meshPatient={diagnosis.meshPatient} />
+              {diagnosis.meshPatient && (
+                <p className="text-sm text-slate-500 mt-2">
+                  Closest match: Patient {diagnosis.meshPatient}
+                </p>
+              )}
+            </div>
           </div>
         </div>
       </div>
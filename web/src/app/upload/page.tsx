@@ -1,14 +1,15 @@
 'use client'
 
-import { useState } from 'react'
+import { useEffect, useState } from 'react'
 import { useDropzone } from 'react-dropzone'
-import { useRouter } from 'next/navigation'
 import Link from 'next/link'
-import { Diagnosis } from '../../../types/cmr'
+import { Diagnosis, Neighbour } from '../../../types/cmr'
+import { API_URL } from '../api'
+import { ResultsDashboard } from '../components/ResultsDashboard'
 import React from 'react'
 
 type AnalysisState = {
-  status: 'idle' | 'uploading' | 'processing' | 'complete'
+  status: 'idle' | 'uploading' | 'processing' | 'streaming' | 'complete'
   currentStep: 'embeddings' | 'retrieval' | 'explanation' | ''
   files: File[]
   diagnosis: Diagnosis | null
@@ -16,44 +17,65 @@ type AnalysisState = {
   suggestionLinks?: string[]
 }
 
-// Link formatter: converts bracket references like [1] into clickable links.
-function parseSuggestionText(text: string, links: string[]): (string | JSX.Element)[] {
-  const regex = /\[(\d+)\]/g;
-  const parts: (string | JSX.Element)[] = [];
-  let lastIndex = 0;
-  let match;
-  while ((match = regex.exec(text)) !== null) {
-    const index = match.index;
-    if (index > lastIndex) {
-      parts.push(text.slice(lastIndex, index));
-    }
-    const linkNumber = parseInt(match[1], 10);
-    const linkUrl = links[linkNumber - 1];
-    if (linkUrl) {
-      parts.push(
-        <a
-          key={index}
-          href={linkUrl}
-          target="_blank"
-          rel="noopener noreferrer"
-          className="text-blue-600 underline mx-1"
-        >
-          {match[0]}
-        </a>
-      );
-    } else {
-      parts.push(match[0]);
-    }
-    lastIndex = regex.lastIndex;
+// One event of /upload/stream (see _stream_analysis in api2/main.py).
+type StreamEvent =
+  | { event: 'neighbours'; hits: Neighbour[]; confidence: number; num_hits: number }
+  | { event: 'token'; text: string }
+  | { event: 'citations'; links: string[]; first_diagnosis: string | null }
+  | { event: 'done'; diagnosis_text: string }
+  | { event: 'error'; detail: string }
+
+// Posts the base64 volume to /upload/stream and hands each NDJSON event to
+// `onEvent` as soon as its line arrives.
+async function streamAnalysis(base64String: string, onEvent: (event: StreamEvent) => void) {
+  const response = await fetch(`${API_URL}/upload/stream`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({ nii_path: base64String }),
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`Server returned status ${response.status}`);
   }
-  if (lastIndex < text.length) {
-    parts.push(text.slice(lastIndex));
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let pending = '';
+  for (;;) {
+    const { done, value } = await reader.read();
+    pending += decoder.decode(value, { stream: !done });
+    const lines = pending.split('\n');
+    pending = done ? '' : lines.pop() ?? '';
+    for (const line of lines) {
+      if (!line.trim()) continue;
+      const event: StreamEvent = JSON.parse(line);
+      if (event.event === 'error') throw new Error(event.detail);
+      onEvent(event);
+    }
+    if (done) return;
   }
-  return parts;
+}
+
+// Reads a file as base64 (without the Data URL prefix).
+function readBase64(file: File): Promise<string> {
+  return new Promise((resolve, reject) => {
+    const reader = new FileReader();
+    reader.onload = () => {
+      const base64String = reader.result?.toString().split(',')[1]; // Extract base64 from Data URL
+      if (!base64String) {
+        reject('Failed to extract Base64 from Data URL');
+        return;
+      }
+      resolve(base64String);
+    };
+    reader.onerror = () => {
+      reject('Error reading file');
+    };
+    reader.readAsDataURL(file);
+  });
 }
 
 export default function UploadPage() {
-  const router = useRouter();
   const [analysisState, setAnalysisState] = useState<AnalysisState>({
     status: 'idle',
     currentStep: '',
@@ -61,56 +83,81 @@ export default function UploadPage() {
     diagnosis: null,
   });
 
-  // Sends the base64 string to our FastAPI backend.
-  const sendBase64ToServer = async (base64String: string): Promise<any> => {
-    try {
-      const response = await fetch('http://localhost:8000/upload', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ nii_path: base64String }),
-      });
-      if (!response.ok) {
-        throw new Error(`Server returned status ${response.status}`);
-      }
-      const responseData = await response.json();
-      console.log('Server response:', responseData);
-      return responseData;
-    } catch (error) {
-      console.error('Error uploading file:', error);
-      throw error;
-    }
+  // Updates the diagnosis shown while the stream is still coming in.
+  const updateDiagnosis = (update: (diagnosis: Diagnosis) => Partial<Diagnosis>) => {
+    setAnalysisState((prev) => prev.diagnosis
+      ? { ...prev, diagnosis: { ...prev.diagnosis, ...update(prev.diagnosis) } }
+      : prev);
   };
 
-  // Reads the file as base64, sends it to the server, and returns the diagnosis data.
-  const handleFileUpload = async (file: File): Promise<any> => {
-    if (!file) {
-      throw new Error('No file selected');
+  const analyze = async (file: File) => {
+    let path = '';
+    if (file.name[3] == '1') {
+      path = 'pat1_healthy_11yo_segmented.html'
+    }
+    if (file.name[3] == '3') {
+      path = 'pat3_unhealthy_52yo_segmented.html'
     }
+    const fileUrl = URL.createObjectURL(file)
 
-    return new Promise((resolve, reject) => {
-      const reader = new FileReader();
-      reader.onload = async () => {
-        const base64String = reader.result?.toString().split(',')[1]; // Extract base64 from Data URL
-        if (!base64String) {
-          reject('Failed to extract Base64 from Data URL');
-          return;
-        }
-        try {
-          const response = await sendBase64ToServer(base64String);
-          resolve(response);
-        } catch (error) {
-          reject(error);
+    try {
+      const base64String = await readBase64(file);
+      setAnalysisState((prev) => ({ ...prev, status: 'processing', currentStep: 'retrieval' }));
+      await streamAnalysis(base64String, (event) => {
+        switch (event.event) {
+          case 'neighbours':
+            // The dashboard goes up as soon as the search is done; the
+            // explanation fills in below as it streams.
+            setAnalysisState((prev) => ({
+              ...prev,
+              status: 'streaming',
+              currentStep: 'explanation',
+              diagnosis: {
+                labels: [],
+                imageUrl: fileUrl,
+                confidence: event.confidence * 1.5,
+                explanation: '',
+                severity: event.confidence * 1.5 > 0.5 ? 'Moderate' : 'Mild',
+                suggestionLinks: [],
+                path: path,
+                neighbours: event.hits,
+                // The upload itself has no meshes; show its closest match's.
+                meshPatient: event.hits[0]?.pat
+              },
+            }));
+            break;
+          case 'token':
+            updateDiagnosis((d) => ({ explanation: d.explanation + event.text }));
+            break;
+          case 'citations':
+            updateDiagnosis(() => ({
+              labels: event.first_diagnosis ? [event.first_diagnosis] : [],
+              suggestionLinks: event.links || [],
+            }));
+            break;
+          case 'done':
+            setAnalysisState((prev) => prev.diagnosis ? {
+              ...prev,
+              status: 'complete',
+              currentStep: '',
+              diagnosis: { ...prev.diagnosis, explanation: event.diagnosis_text },
+              suggestionText: event.diagnosis_text,
+              suggestionLinks: prev.diagnosis.suggestionLinks,
+            } : prev);
+            break;
         }
-      };
-
-      reader.onerror = () => {
-        reject('Error reading file');
-      };
-
-      reader.readAsDataURL(file);
-    });
+      });
+    } catch (error) {
+      console.error('Error uploading file:', error);
+      setAnalysisState((prev) => ({
+        ...prev,
+        status: 'idle',
+        currentStep: '',
+        files: [],
+        diagnosis: null,
+      }));
+      alert('There was an error processing your file. See console.');
+    }
   };
 
   const { getRootProps, getInputProps, isDragActive } = useDropzone({
@@ -125,87 +172,31 @@ export default function UploadPage() {
         ...prev,
         status: 'uploading',
         files: acceptedFiles,
+        diagnosis: null,
       }));
-
-      // Simulate a multi-step process.
-      setTimeout(() => {
-        setAnalysisState((prev) => ({
-          ...prev,
-          status: 'processing',
-          currentStep: 'embeddings',
-        }));
-
-        setTimeout(() => {
-          setAnalysisState((prev) => ({ ...prev, currentStep: 'retrieval' }));
-          setTimeout(async () => {
-            setAnalysisState((prev) => ({ ...prev, currentStep: 'explanation' }));
-            try {
-              const file = acceptedFiles[0];
-              const response: any = await handleFileUpload(file);
-              console.log('conf', response.confidence);
-            //   const fileUrl = URL.createObjectURL(file);
-              console.log(file.name[3])
-              let path = '';
-              if (file.name[3] == '1') {
-                path = 'pat1_healthy_11yo_segmented.html'
-              }
-              if (file.name[3] == '3') {
-                path = 'pat3_unhealthy_52yo_segmented.html'
-              }
-              // try{
-              //   const response = handleFileUpload(file);
-              //   console.log("Server response:", response);
-              // } catch (error) {
-              //   console.error("Error uploading file:", error);
-              // }
-              console.log("file: ", file)
-              
-              const fileUrl = URL.createObjectURL(acceptedFiles[0])
-
-              // Optionally, you can parse the text here.
-              let replacedTextElements: (string | JSX.Element)[] = [];
-              if (response.diagnosis_text && response.links) {
-                replacedTextElements = parseSuggestionText(response.diagnosis_text, response.links);
-              }
-            
-              setAnalysisState((prev) => ({
-                ...prev,
-                status: 'complete',
-                diagnosis: {
-                  labels: [response.first_diagnosis],
-                  imageUrl: fileUrl,
-                  confidence: response.confidence * 1.5,
-                  explanation: response.diagnosis_text || '',
-                  severity: response.confidence * 1.5 > 0.5 ? 'Moderate' : 'Mild',
-                  suggestionLinks: response.links || [],
-                  path: path
-                },
-                suggestionText: response.diagnosis_text || '',
-                suggestionLinks: response.links || [],
-                currentStep: '',
-              }));
-            } catch (error) {
-              console.error('Error uploading file:', error);
-              setAnalysisState((prev) => ({
-                ...prev,
-                status: 'idle',
-                currentStep: '',
-                files: [],
-              }));
-              alert('There was an error processing your file. See console.');
-            }
-          }, 1500);
-        }, 1500);
-      }, 1000);
+      analyze(acceptedFiles[0]);
     },
   });
 
-  const handleViewResults = () => {
-    if (!analysisState.diagnosis) return;
-    // Store the analysis state in sessionStorage so the /results page can read it.
-    sessionStorage.setItem('ecgData', JSON.stringify(analysisState));
-    router.push('/results');
-  };
+  // Keep the finished analysis for the /results page.
+  useEffect(() => {
+    if (analysisState.status === 'complete' && analysisState.diagnosis) {
+      sessionStorage.setItem('ecgData', JSON.stringify(analysisState));
+    }
+  }, [analysisState]);
+
+  if (analysisState.diagnosis) {
+    return (
+      <div className="bg-gray-50 min-h-screen py-10">
+        <div className="max-w-7xl mx-auto px-4">
+          <ResultsDashboard
+            diagnosis={analysisState.diagnosis}
+            streaming={analysisState.status === 'streaming'}
+          />
+        </div>
+      </div>
+    );
+  }
 
   return (
     <div className="flex items-center justify-center h-screen w-screen">
@@ -238,20 +229,6 @@ export default function UploadPage() {
           </div>
         )}
 
-        {analysisState.status === 'complete' && analysisState.diagnosis && (
-          <div className="bg-white rounded-lg shadow p-6 text-center space-y-4">
-            <h2 className="text-xl font-semibold text-green-700">
-              Analysis Complete!
-            </h2>
-            <button
-              onClick={handleViewResults}
-              className="bg-blue-600 text-white px-4 py-2 rounded-lg hover:bg-blue-700 transition-colors"
-            >
-              View Results
-            </button>
-          </div>
-        )}
-
         <div className="pt-6 border-t border-slate-200 flex justify-between">
           <Link
             href="/"
@@ -16,6 +16,17 @@ export interface CMRMarker {
     severity: string
     suggestionLinks: string[]
     path: string
+    // Patient whose precomputed meshes the viewer should load, if any
+    // (the top neighbour hit, not the uploaded volume)
+    meshPatient?: string
+    // Nearest knowledge-base patients, best first
+    neighbours?: Neighbour[]
+  }
+
+  export interface Neighbour {
+    id: string
+    relevance: number
+    pat?: string
   }
   
   // export interface SimilarECG {